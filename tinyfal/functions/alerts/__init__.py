@@ -0,0 +1 @@
+# Alerts package for Tinyfal Firebase Functions
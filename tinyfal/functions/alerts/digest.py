@@ -0,0 +1,190 @@
+"""
+Per-user coalescing of alert transitions into digests.
+
+When a fleet-wide event (a backup window, a noisy neighbour) trips the same rule on many
+resources at once, the transitions of a user that happen within ALERT_DIGEST_WINDOW_SECONDS are
+collected in users/{user_id}/alert_digests/current and delivered as a single push and a single
+history document. The first transition of a window opens the digest and schedules its delivery;
+every transition is kept as an event on the history document for drill-down.
+
+Delivery is scheduled on the Cloud Tasks queue of the deliver_alert_digest function, or with a
+timer in this process when ALERT_DISPATCH is 'inprocess'. A window of 0 disables digests.
+A digest still open ALERT_DIGEST_OVERDUE_SECONDS past its delivery time lost its delivery (the
+schedule failed or the instance holding the timer went away): the next transition schedules it
+again, and the deliver_overdue_digests sweep delivers it otherwise.
+"""
+import os
+import threading
+from typing import Any, Callable, Dict, List
+
+from firebase_admin import firestore
+from firebase_functions import logger
+
+from alerts.rules import OPERATORS, CompiledRule
+from instrumentation.instrumentation import record_read, record_write
+
+
+DIGEST_WINDOW_SECONDS = float(os.environ.get('ALERT_DIGEST_WINDOW_SECONDS', '60'))
+DIGEST_OVERDUE_SECONDS = float(os.environ.get('ALERT_DIGEST_OVERDUE_SECONDS', '120'))
+
+DIGESTS_COLLECTION = 'alert_digests'
+OPEN_DIGEST = 'current'
+
+# Name of the task queue function that delivers digests (see main.py)
+DELIVERY_FUNCTION = 'deliver_alert_digest'
+
+
+def digest_event(resource_id: str, resource_name: str, rule: CompiledRule, value: float, resolved: bool, now: float) -> Dict[str, Any]:
+    """
+    Build the record of one alert transition
+
+    Args:
+        resource_id: The resource the rule changed state on
+        resource_name: Resource title used in notifications
+        rule: The rule that fired or resolved
+        value: Metric value at the transition
+        resolved: Whether the rule resolved (otherwise it fired)
+        now: Time of the transition (unix seconds)
+
+    Returns:
+        The event, self-contained so the digest can be rendered without the rule set
+    """
+    return {
+        'resource_id': resource_id,
+        'resource_name': resource_name,
+        'rule_id': rule.id,
+        'type': rule.type,
+        'metric': rule.metric,
+        'label': rule.spec.label,
+        'unit': rule.spec.unit,
+        'wording': OPERATORS[rule.op][1],
+        'threshold': rule.threshold,
+        'value': value,
+        'resolved': resolved,
+        'at': now,
+    }
+
+
+def digest_ref(db, user_id: str):
+    """Get the open digest document of a user."""
+    return db.collection('users').document(user_id).collection(DIGESTS_COLLECTION).document(OPEN_DIGEST)
+
+
+def add_events(db, user_id: str, events: List[Dict[str, Any]], now: float) -> bool:
+    """
+    Append transitions to the open digest of a user, opening one if needed
+
+    Args:
+        db: Firestore client
+        user_id: The user
+        events: Events built with digest_event
+        now: Current time (unix seconds)
+
+    Returns:
+        True if a new digest was opened or the open one is overdue, in which case its delivery
+        must be scheduled
+    """
+    ref = digest_ref(db, user_id)
+
+    @firestore.transactional
+    def append(transaction) -> bool:
+        snapshot = ref.get(transaction=transaction)
+        if snapshot.exists:
+            deliver_at = (snapshot.to_dict() or {}).get('deliver_at') or 0
+            if now - deliver_at < DIGEST_OVERDUE_SECONDS:
+                transaction.update(ref, {'events': firestore.ArrayUnion(events)})
+                return False
+            transaction.update(ref, {
+                'deliver_at': now + DIGEST_WINDOW_SECONDS,
+                'events': firestore.ArrayUnion(events),
+            })
+            logger.warn(f"Alert digest of user {user_id} is overdue since {deliver_at}, scheduling it again")
+            return True
+        transaction.set(ref, {
+            'opened_at': now,
+            'deliver_at': now + DIGEST_WINDOW_SECONDS,
+            'events': events,
+        })
+        return True
+
+    opened = append(db.transaction())
+    record_read()
+    record_write()
+    return opened
+
+
+def take_digest(db, user_id: str) -> List[Dict[str, Any]]:
+    """
+    Close the open digest of a user and get its events
+
+    Args:
+        db: Firestore client
+        user_id: The user
+
+    Returns:
+        The events in transition order (empty if there was no open digest)
+    """
+    ref = digest_ref(db, user_id)
+
+    @firestore.transactional
+    def take(transaction) -> List[Dict[str, Any]]:
+        snapshot = ref.get(transaction=transaction)
+        if not snapshot.exists:
+            return []
+        transaction.delete(ref)
+        return (snapshot.to_dict() or {}).get('events') or []
+
+    events = take(db.transaction())
+    record_read()
+    return sorted(events, key=lambda event: event.get('at') or 0)
+
+
+def overdue_digests(db, now: float) -> List[str]:
+    """
+    Find the users whose open digest is overdue
+
+    Args:
+        db: Firestore client
+        now: Current time (unix seconds)
+
+    Returns:
+        The user ids
+    """
+    query = (
+        db.collection_group(DIGESTS_COLLECTION)
+        .where('deliver_at', '<', now - DIGEST_OVERDUE_SECONDS)
+        .select(['deliver_at'])
+    )
+    user_ids = []
+    for snapshot in query.stream():
+        record_read()
+        if snapshot.id == OPEN_DIGEST:
+            user_ids.append(snapshot.reference.parent.parent.id)
+    return user_ids
+
+
+def schedule_delivery(user_id: str, deliver: Callable[[str], None]) -> None:
+    """
+    Deliver the digest of a user once the window has passed
+
+    Args:
+        user_id: The user
+        deliver: Delivery function, used directly when digests are delivered in process
+    """
+    if os.environ.get('ALERT_DISPATCH', 'trigger') == 'inprocess':
+        timer = threading.Timer(DIGEST_WINDOW_SECONDS, deliver, args=(user_id,))
+        timer.daemon = True
+        timer.start()
+        return
+
+    from firebase_admin import functions
+
+    functions.task_queue(DELIVERY_FUNCTION).enqueue(
+        {'user_id': user_id},
+        functions.TaskOptions(schedule_delay_seconds=int(DIGEST_WINDOW_SECONDS)),
+    )
+    logger.info(f"Alert digest opened for user {user_id}, delivery in {DIGEST_WINDOW_SECONDS:g}s")
+
+
+def digest_enabled() -> bool:
+    return DIGEST_WINDOW_SECONDS > 0
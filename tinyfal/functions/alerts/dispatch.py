@@ -0,0 +1,208 @@
+"""
+Alert evaluation and delivery, decoupled from the ingest request.
+
+Ingest only stores the sample, and alerts are evaluated by the stage ALERT_DISPATCH selects:
+
+    trigger    (default) nothing to enqueue: ingest extracts the alert values of every batch
+               (alerts.rules.alert_values) and writes them with the window as `alert_samples`.
+               The write fires on_resource_written, which runs one job per new sample, in order
+               (jobs_from_write), so batches coalesced into one write are all evaluated
+    inprocess  ingest hands an AlertJob to a background worker pool in this process, for local
+               runs and the emulator
+
+Either way the Telegraf request never waits on the user settings read or on FCM.
+"""
+import os
+import queue
+import threading
+import time
+from abc import ABC, abstractmethod
+from typing import Any, Callable, Dict, List, Optional, Union
+
+from firebase_functions import logger
+
+from database.database import get_db
+from ingestion.coalescing import ALERT_SAMPLES_FIELD
+from instrumentation.instrumentation import start_timer, finish_timer, span
+from notifications.notifications import check_and_send_threshold_alerts
+from retry.retry import backoff_delays
+from users.settings import get_user_settings
+
+
+ALERT_DISPATCH = os.environ.get('ALERT_DISPATCH', 'trigger')
+
+ALERT_QUEUE_WORKERS = int(os.environ.get('ALERT_QUEUE_WORKERS', '2'))
+ALERT_JOB_ATTEMPTS = int(os.environ.get('ALERT_JOB_ATTEMPTS', '4'))
+
+
+class AlertJob:
+    """
+    One batch of resource metrics to evaluate alert rules against
+
+    Attributes:
+        user_id: Owner of the resource
+        resource_id: The resource
+        resource_name: Resource title used in notifications
+        metrics: Telegraf metric dictionaries, or the alert values extracted from them at ingest
+        now: Time of the sample (unix seconds)
+        settings_version: `settings_version` of the resource document, when known
+    """
+
+    __slots__ = ('user_id', 'resource_id', 'resource_name', 'metrics', 'now', 'settings_version')
+
+    def __init__(self, user_id: str, resource_id: str, resource_name: str, metrics: Union[List[Dict[str, Any]], Dict[str, float]],
+                 now: float, settings_version: Any = None):
+        self.user_id = user_id
+        self.resource_id = resource_id
+        self.resource_name = resource_name
+        self.metrics = metrics
+        self.now = now
+        self.settings_version = settings_version
+
+
+def process_alert_job(job: AlertJob) -> None:
+    """
+    Get the user settings (cached) and evaluate the alert rules of a job
+
+    Args:
+        job: The job to process
+
+    Raises:
+        Any Firestore error reading the user settings, so the queue can retry the job
+    """
+    start_timer('alert_job')
+    try:
+        with span('settings'):
+            user_settings = get_user_settings(get_db(), job.user_id, job.settings_version)
+        if user_settings is None:
+            return
+
+        check_and_send_threshold_alerts(
+            user_id=job.user_id,
+            resource_id=job.resource_id,
+            resource_name=job.resource_name,
+            metrics=job.metrics,
+            user_settings=user_settings,
+            now=job.now,
+        )
+    finally:
+        finish_timer()
+
+
+class AlertQueue(ABC):
+    """
+    Where ingest hands alert jobs to
+    """
+
+    @abstractmethod
+    def enqueue(self, job: AlertJob) -> None:
+        """Hand over a job; must not block on its processing."""
+
+
+class InProcessQueue(AlertQueue):
+    """
+    Worker threads processing jobs in the background, retrying failed jobs with
+    jittered exponential backoff
+
+    Args:
+        handler: Function processing one job
+        workers: Number of worker threads
+        attempts: Maximum number of attempts per job
+        base_delay: Delay bound before the first retry, in seconds
+    """
+
+    def __init__(
+        self,
+        handler: Callable[[AlertJob], None] = process_alert_job,
+        workers: int = ALERT_QUEUE_WORKERS,
+        attempts: int = ALERT_JOB_ATTEMPTS,
+        base_delay: float = 0.5
+    ):
+        self._handler = handler
+        self._attempts = attempts
+        self._base_delay = base_delay
+        self._jobs: "queue.Queue[AlertJob]" = queue.Queue()
+        for index in range(workers):
+            threading.Thread(target=self._work, name=f'alert-worker-{index}', daemon=True).start()
+
+    def enqueue(self, job: AlertJob) -> None:
+        self._jobs.put(job)
+
+    def join(self) -> None:
+        """Block until every enqueued job was processed."""
+        self._jobs.join()
+
+    def _work(self) -> None:
+        while True:
+            job = self._jobs.get()
+            try:
+                self._run(job)
+            finally:
+                self._jobs.task_done()
+
+    def _run(self, job: AlertJob) -> None:
+        delays = backoff_delays(self._attempts, self._base_delay)
+        while True:
+            try:
+                self._handler(job)
+                return
+            except Exception as e:
+                delay = next(delays, None)
+                if delay is None:
+                    logger.error(f"Alert job failed for user_id: {job.user_id}, resource_id: {job.resource_id}. Error: {str(e)}")
+                    return
+                time.sleep(delay)
+
+
+_alert_queue: Optional[AlertQueue] = None
+
+
+def get_alert_queue() -> AlertQueue:
+    """Get the queue ingest hands jobs to when ALERT_DISPATCH is 'inprocess', created on first use."""
+    global _alert_queue
+    if _alert_queue is None:
+        _alert_queue = InProcessQueue()
+    return _alert_queue
+
+
+def dispatches_from_trigger() -> bool:
+    """Whether on_resource_written is the stage that runs alert jobs."""
+    return ALERT_DISPATCH != 'inprocess'
+
+
+def _sample_time(sample: Any) -> Optional[float]:
+    at = sample.get('at') if isinstance(sample, dict) else None
+    return float(at) if isinstance(at, (int, float)) and not isinstance(at, bool) else None
+
+
+def jobs_from_write(user_id: str, resource_id: str, before: Dict[str, Any], after: Dict[str, Any]) -> List[AlertJob]:
+    """
+    Get the alert jobs of an ingest write of a resource: one per alert sample the write added,
+    oldest first. A write that added none comes from an instance that does not write alert
+    samples, and gets one job from the stored metrics.
+
+    Args:
+        user_id: Owner of the resource
+        resource_id: The resource
+        before: Resource data before the write
+        after: Resource data after the write
+
+    Returns:
+        The jobs to process, in order
+    """
+    resource_name = after.get('title', resource_id)
+    settings_version = after.get('settings_version')
+    samples = after.get(ALERT_SAMPLES_FIELD)
+    if not isinstance(samples, list) or samples == before.get(ALERT_SAMPLES_FIELD):
+        return [AlertJob(user_id, resource_id, resource_name, after.get('metrics') or [], after['last_update'].timestamp(), settings_version)]
+
+    # Every write replaces the samples, so those still there from the previous write were evaluated with it
+    evaluated = before.get(ALERT_SAMPLES_FIELD)
+    evaluated = evaluated if isinstance(evaluated, list) else []
+    jobs = []
+    for sample in samples:
+        at = _sample_time(sample)
+        if at is None or not isinstance(sample.get('values'), dict) or sample in evaluated:
+            continue
+        jobs.append(AlertJob(user_id, resource_id, resource_name, sample['values'], at, settings_version))
+    return jobs
@@ -0,0 +1,231 @@
+"""
+Detection of resources that stopped reporting.
+
+Every ingest write moves `offline_at` on the resource: the write time plus the resource deadline
+(see ingestion/coalescing.py). The sweep reads the resources whose offline_at fell between the
+previous sweep and now, with an indexed range query over the resources collection group paged by
+a cursor. Each outage therefore falls into exactly one sweep window, and resources that stay
+offline are never read again. Newly offline resources are marked `offline: true` in batched
+writes, each conditioned on the resource not having been written since it was read, and every
+user gets one offline notification per sweep. Writes that do not move the deadline (settings
+stamps, the daily summary, token changes) also break that condition, so when a batch is refused
+each of its resources is re-checked in a transaction and marked if its offline_at is still past.
+
+The first ingest write after an outage clears the flag in a transaction from on_resource_written,
+which sends the single back online notification of the outage.
+"""
+import os
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+from firebase_admin import firestore
+from firebase_functions import logger
+from google.api_core.exceptions import FailedPrecondition, NotFound
+
+from instrumentation.instrumentation import record_read, record_write
+from notifications.dispatcher import NotificationDispatcher
+from notifications.notifications import build_offline_notification, build_online_notification, offline_notifications_enabled
+from users.settings import get_user_settings
+
+
+OFFLINE_SWEEP_PAGE_SIZE = 500
+OFFLINE_SWEEP_WORKERS = int(os.environ.get('OFFLINE_SWEEP_WORKERS', '16'))
+
+# Window examined by the very first sweep, before there is a watermark
+OFFLINE_SWEEP_LOOKBACK_SECONDS = float(os.environ.get('OFFLINE_SWEEP_LOOKBACK_SECONDS', '3600'))
+
+SWEEP_STATE_COLLECTION = 'system'
+SWEEP_STATE_DOCUMENT = 'offline_sweep'
+
+
+def _offline_pages(db, since: datetime, until: datetime) -> Iterator[List[Any]]:
+    """Yield pages of resources whose offline_at is in (since, until], following an offline_at cursor."""
+    base_query = (
+        db.collection_group('resources')
+        .where('offline_at', '>', since)
+        .where('offline_at', '<=', until)
+        .order_by('offline_at')
+        .select(['offline_at', 'offline', 'title', 'last_update'])
+        .limit(OFFLINE_SWEEP_PAGE_SIZE)
+    )
+
+    cursor = None
+    while True:
+        page_query = base_query.start_after(cursor) if cursor is not None else base_query
+        page = list(page_query.stream())
+        record_read(max(1, len(page)))
+        if not page:
+            return
+        yield page
+        if len(page) < OFFLINE_SWEEP_PAGE_SIZE:
+            return
+        cursor = page[-1]
+
+
+def _offline_update(db, resource_doc) -> Tuple[Dict[str, Any], Any]:
+    data = resource_doc.to_dict() or {}
+    update = {'offline': True, 'offline_since': data.get('last_update')}
+    # A write that landed after the query means the resource is reporting again
+    return update, db.write_option(last_update_time=resource_doc.update_time)
+
+
+def _mark_one_offline(db, resource_doc, now: datetime) -> bool:
+    """Mark a resource offline if, read again in a transaction, its deadline is still past and it is not flagged."""
+    ref = resource_doc.reference
+
+    @firestore.transactional
+    def mark(transaction) -> bool:
+        snapshot = ref.get(transaction=transaction, field_paths=['offline_at', 'offline', 'last_update'])
+        if not snapshot.exists:
+            return False
+        data = snapshot.to_dict() or {}
+        offline_at = data.get('offline_at')
+        if data.get('offline') or offline_at is None or offline_at > now:
+            return False
+        transaction.update(ref, {'offline': True, 'offline_since': data.get('last_update')})
+        return True
+
+    marked = mark(db.transaction())
+    record_read()
+    if marked:
+        record_write()
+    return marked
+
+
+def _mark_offline(db, resource_docs: List[Any], now: datetime) -> List[Any]:
+    """
+    Mark resources offline in one batch. If any of them changed or was deleted since it was
+    read, the batch fails as a whole and every resource is re-checked and marked on its own.
+
+    Returns:
+        The resources that were marked
+    """
+    write_batch = db.batch()
+    for resource_doc in resource_docs:
+        update, option = _offline_update(db, resource_doc)
+        write_batch.update(resource_doc.reference, update, option=option)
+    try:
+        write_batch.commit()
+        record_write(len(resource_docs))
+        return resource_docs
+    except (FailedPrecondition, NotFound):
+        pass
+
+    return [resource_doc for resource_doc in resource_docs if _mark_one_offline(db, resource_doc, now)]
+
+
+def _notify_offline(db, offline: Dict[str, List[Tuple[str, str]]]) -> None:
+    """Send one offline notification per user."""
+    dispatcher = NotificationDispatcher(db=db)
+    for user_id, resources in offline.items():
+        try:
+            user_settings = get_user_settings(db, user_id)
+        except Exception as e:
+            logger.error(f"Failed to get settings of user {user_id} for offline notification: {str(e)}")
+            continue
+        if user_settings and offline_notifications_enabled(user_settings):
+            dispatcher.add(build_offline_notification(user_id, resources), user_settings)
+    if len(dispatcher):
+        dispatcher.flush()
+
+
+def sweep_offline(db, now: datetime) -> int:
+    """
+    Mark the resources whose deadline passed since the previous sweep offline and notify their owners
+
+    Args:
+        db: Firestore client
+        now: Current time (timezone aware)
+
+    Returns:
+        Number of resources marked offline
+    """
+    state_ref = db.collection(SWEEP_STATE_COLLECTION).document(SWEEP_STATE_DOCUMENT)
+    state = state_ref.get()
+    record_read()
+    since = (state.to_dict() or {}).get('swept_until') if state.exists else None
+    if since is None:
+        since = now - timedelta(seconds=OFFLINE_SWEEP_LOOKBACK_SECONDS)
+
+    offline: Dict[str, List[Tuple[str, str]]] = {}
+    marked = 0
+    with ThreadPoolExecutor(max_workers=OFFLINE_SWEEP_WORKERS) as executor:
+        futures = []
+        for page in _offline_pages(db, since, now):
+            # Resources already flagged are in an outage that was notified before
+            fresh = [resource_doc for resource_doc in page if not (resource_doc.to_dict() or {}).get('offline')]
+            if fresh:
+                futures.append(executor.submit(_mark_offline, db, fresh, now))
+        # Any failure leaves the watermark in place, so the next sweep retries the window
+        for future in futures:
+            for resource_doc in future.result():
+                user_id = resource_doc.reference.parent.parent.id
+                title = (resource_doc.to_dict() or {}).get('title') or resource_doc.id
+                offline.setdefault(user_id, []).append((resource_doc.id, title))
+                marked += 1
+
+    if offline:
+        _notify_offline(db, offline)
+
+    state_ref.set({'swept_until': now, 'marked': marked})
+    record_write()
+    return marked
+
+
+def mark_online(db, user_id: str, resource_id: str) -> Tuple[bool, Optional[datetime]]:
+    """
+    Clear the offline flag of a resource if it is still set
+
+    Args:
+        db: Firestore client
+        user_id: Owner of the resource
+        resource_id: The resource
+
+    Returns:
+        Whether this call cleared the flag, and when the outage started (last write before it)
+    """
+    ref = db.collection('users').document(user_id).collection('resources').document(resource_id)
+
+    @firestore.transactional
+    def clear(transaction) -> Tuple[bool, Optional[datetime]]:
+        snapshot = ref.get(transaction=transaction, field_paths=['offline', 'offline_since'])
+        data = (snapshot.to_dict() or {}) if snapshot.exists else {}
+        if not data.get('offline'):
+            return False, None
+        transaction.update(ref, {'offline': False, 'offline_since': firestore.DELETE_FIELD})
+        return True, data.get('offline_since')
+
+    cleared, offline_since = clear(db.transaction())
+    record_read()
+    if cleared:
+        record_write()
+    return cleared, offline_since
+
+
+def notify_back_online(db, user_id: str, resource_id: str, resource_name: str, now: datetime) -> bool:
+    """
+    End the outage of a resource that reports again, notifying its owner once
+
+    Args:
+        db: Firestore client
+        user_id: Owner of the resource
+        resource_id: The resource
+        resource_name: Resource title used in the notification
+        now: Time of the write that ended the outage (timezone aware)
+
+    Returns:
+        Whether this call ended the outage
+    """
+    cleared, offline_since = mark_online(db, user_id, resource_id)
+    if not cleared:
+        return False
+
+    user_settings = get_user_settings(db, user_id)
+    if user_settings and offline_notifications_enabled(user_settings):
+        offline_seconds = (now - offline_since).total_seconds() if offline_since is not None else None
+        dispatcher = NotificationDispatcher(db=db)
+        if dispatcher.add(build_online_notification(user_id, resource_id, resource_name, offline_seconds), user_settings):
+            dispatcher.flush()
+    logger.info(f"Resource back online for user_id: {user_id}, resource_id: {resource_id}")
+    return True
@@ -0,0 +1,441 @@
+"""
+Compiled alert rules evaluated against ingest batches.
+
+Users define rules in the `alertRules` array of their user document, e.g.
+
+    {'id': 'root-disk', 'metric': 'disk_used', 'op': '>', 'threshold': 90,
+     'for': 300, 'resources': ['<resource_id>'], 'enabled': true}
+
+`for` is how long (seconds) the condition must hold before the rule fires and `resources`
+limits the rule to some resources (all of them when omitted). Optional `hysteresis` (in metric
+units) is how far back past the threshold the value must go before a firing rule resolves, and
+`cooldown` (seconds) is how long after resolving the rule cannot fire again. The legacy
+cpuThreshold and ramThreshold settings are compiled into two equivalent rules, so existing users
+keep their alerts. The network and disk I/O rate metrics (net_rx_rate, disk_write_rate, ...) read
+the rates ingest derives from the Telegraf counters (models/rates.py) and are missing from the
+first batch after a cold start. `anomaly_score` is the highest score of the batch in standard
+deviations from the usual values of the resource (history/streaming.py).
+
+Rule sets are compiled once per user and cached. Evaluation extracts every metric at most once
+per batch, however many rules read it, and each rule is then a single comparison. When alerts are
+evaluated from the resource write trigger, ingest extracts every metric of a batch up front
+(alert_values) and the trigger evaluates those values (RuleSet.evaluate_values).
+"""
+import operator
+import os
+from functools import partial
+from typing import Any, Callable, Dict, FrozenSet, List, Optional, Tuple
+
+from firebase_functions import logger
+
+from cache.cache import TTLCache
+from models.models import (
+    MetricsBatch,
+    extract_available_memory_percent,
+    extract_cpu_available_percent,
+    extract_cpu_usage_percent,
+    extract_used_memory_percent,
+    extract_swap_used_percent,
+    extract_disk_usage_percent,
+    extract_load_average,
+    extract_process_count,
+    extract_zombie_processes,
+    extract_docker_containers,
+    extract_network_rates,
+    extract_disk_io_rates,
+    extract_anomaly_score,
+)
+
+
+RULE_CACHE_MAX_SIZE = int(os.environ.get('RULE_CACHE_MAX_SIZE', '5000'))
+RULE_CACHE_TTL_SECONDS = float(os.environ.get('RULE_CACHE_TTL_SECONDS', '3600'))
+
+# Defaults for rules that do not set them (the legacy CPU/RAM rules never do)
+DEFAULT_HYSTERESIS = float(os.environ.get('ALERT_DEFAULT_HYSTERESIS', '2'))
+DEFAULT_COOLDOWN_SECONDS = float(os.environ.get('ALERT_DEFAULT_COOLDOWN_SECONDS', '300'))
+
+# Ids of the rules compiled from the legacy settings, which user rules cannot take
+LEGACY_RULE_IDS = ('cpu', 'ram')
+
+# User settings a rule set is compiled from; any change to them recompiles it
+RULE_SETTINGS = (
+    'alertRules',
+    'cpuNotificationsEnabled',
+    'cpuThreshold',
+    'ramNotificationsEnabled',
+    'ramThreshold',
+)
+
+
+class RuleError(ValueError):
+    """
+    Raised when a rule definition cannot be compiled
+    """
+
+
+class MetricSpec:
+    """
+    A metric rules can be written against
+
+    Attributes:
+        label: Human readable name used in notifications
+        unit: Unit suffix used in notifications
+        extract: Function returning the metric value from a MetricsBatch (None if missing)
+    """
+
+    __slots__ = ('label', 'unit', 'extract')
+
+    def __init__(self, label: str, unit: str, extract: Callable[[MetricsBatch], Optional[float]]):
+        self.label = label
+        self.unit = unit
+        self.extract = extract
+
+
+def _mem_available(batch: MetricsBatch) -> Optional[int]:
+    used = extract_used_memory_percent(batch)
+    return 100 - used if used is not None else None
+
+
+def _legacy_mem_used(batch: MetricsBatch) -> Optional[int]:
+    # Rounded like the RAM check the legacy settings were written for: 100 - ceil(available_percent)
+    available = extract_available_memory_percent(batch)
+    return 100 - available if available is not None else None
+
+
+def _pair_element(extract: Callable[[MetricsBatch], Optional[Tuple[float, float]]], index: int) -> Callable[[MetricsBatch], Optional[float]]:
+    def element(batch: MetricsBatch) -> Optional[float]:
+        pair = extract(batch)
+        return round(pair[index], 2) if pair is not None else None
+    return element
+
+
+METRICS: Dict[str, MetricSpec] = {
+    'cpu_available': MetricSpec('CPU available', '%', extract_cpu_available_percent),
+    'cpu_used': MetricSpec('CPU usage', '%', extract_cpu_usage_percent),
+    'mem_available': MetricSpec('RAM available', '%', _mem_available),
+    'mem_used': MetricSpec('RAM usage', '%', extract_used_memory_percent),
+    'swap_used': MetricSpec('Swap usage', '%', extract_swap_used_percent),
+    'disk_used': MetricSpec('Disk usage', '%', extract_disk_usage_percent),
+    'load1': MetricSpec('Load (1m)', '', partial(extract_load_average, window='load1')),
+    'load5': MetricSpec('Load (5m)', '', partial(extract_load_average, window='load5')),
+    'load15': MetricSpec('Load (15m)', '', partial(extract_load_average, window='load15')),
+    'processes': MetricSpec('Processes', '', extract_process_count),
+    'zombies': MetricSpec('Zombie processes', '', extract_zombie_processes),
+    'containers': MetricSpec('Containers', '', extract_docker_containers),
+    'containers_running': MetricSpec('Running containers', '', partial(extract_docker_containers, state='n_containers_running')),
+    'containers_stopped': MetricSpec('Stopped containers', '', partial(extract_docker_containers, state='n_containers_stopped')),
+    'net_rx_rate': MetricSpec('Network receive', ' MB/s', _pair_element(extract_network_rates, 0)),
+    'net_tx_rate': MetricSpec('Network send', ' MB/s', _pair_element(extract_network_rates, 1)),
+    'disk_read_rate': MetricSpec('Disk read', ' MB/s', _pair_element(extract_disk_io_rates, 0)),
+    'disk_write_rate': MetricSpec('Disk write', ' MB/s', _pair_element(extract_disk_io_rates, 1)),
+    'anomaly_score': MetricSpec('Anomaly score', '', extract_anomaly_score),
+}
+
+# RAM usage as the legacy ramThreshold setting compares it; not available to user rules
+LEGACY_MEM_USED = MetricSpec('RAM usage', '%', _legacy_mem_used)
+LEGACY_MEM_USED_KEY = 'legacy_mem_used'
+
+# Value key -> spec of every value a rule can read
+ALERT_VALUES: Dict[str, MetricSpec] = {**METRICS, LEGACY_MEM_USED_KEY: LEGACY_MEM_USED}
+
+# Operator -> (comparison, wording used in notifications, direction of the breach)
+# The direction tells which way the hysteresis band extends: +1 breaches upwards, -1 downwards
+OPERATORS: Dict[str, Tuple[Callable[[float, float], bool], str, int]] = {
+    '>': (operator.gt, 'above', 1),
+    '>=': (operator.ge, 'at or above', 1),
+    '<': (operator.lt, 'below', -1),
+    '<=': (operator.le, 'at or below', -1),
+    '==': (operator.eq, 'equal to', 0),
+    '!=': (operator.ne, 'different from', 0),
+}
+
+
+class CompiledRule:
+    """
+    A validated alert rule ready for evaluation
+
+    Attributes:
+        id: Rule identifier, unique per user
+        metric: Metric name (key of METRICS)
+        spec: How the metric is extracted, METRICS[metric] unless given
+        key: Key of the value in ALERT_VALUES, the metric name unless given
+        op: Operator symbol (key of OPERATORS)
+        threshold: Value the metric is compared with
+        duration: Seconds the condition must hold before the rule fires
+        resources: Resource ids the rule applies to, or None for every resource
+        type: Notification type sent when the rule fires
+        hysteresis: Distance past the threshold needed to resolve a firing rule
+        cooldown: Seconds after resolving during which the rule cannot fire again
+    """
+
+    __slots__ = ('id', 'metric', 'spec', 'key', 'op', 'compare', 'threshold', 'duration', 'resources', 'type',
+                 'hysteresis', 'cooldown', 'clear_threshold')
+
+    def __init__(
+        self,
+        id: str,
+        metric: str,
+        op: str,
+        threshold: float,
+        duration: float = 0.0,
+        resources: Optional[FrozenSet[str]] = None,
+        type: Optional[str] = None,
+        hysteresis: float = DEFAULT_HYSTERESIS,
+        cooldown: float = DEFAULT_COOLDOWN_SECONDS,
+        spec: Optional[MetricSpec] = None,
+        key: Optional[str] = None
+    ):
+        self.id = id
+        self.metric = metric
+        self.spec = spec or METRICS[metric]
+        self.key = key or metric
+        self.op = op
+        self.compare = OPERATORS[op][0]
+        self.threshold = threshold
+        self.duration = duration
+        self.resources = resources
+        self.type = type or f"{metric}_alert"
+        self.hysteresis = hysteresis
+        self.cooldown = cooldown
+        self.clear_threshold = threshold - OPERATORS[op][2] * hysteresis
+
+    def cleared(self, value: float) -> bool:
+        """Whether a firing rule resolves at this value (back past the hysteresis band)."""
+        if self.hysteresis and OPERATORS[self.op][2]:
+            return not self.compare(value, self.clear_threshold)
+        return not self.compare(value, self.threshold)
+
+    def applies_to(self, resource_id: str) -> bool:
+        return self.resources is None or resource_id in self.resources
+
+    def describe(self, value: float) -> str:
+        """Get the notification sentence for a value that breaches the rule."""
+        unit = self.spec.unit
+        return f"{self.spec.label} is {value:g}{unit} ({OPERATORS[self.op][1]} {self.threshold:g}{unit} threshold)"
+
+
+class RuleResult:
+    """
+    Outcome of one rule for one batch
+
+    Attributes:
+        rule: The evaluated rule
+        value: The metric value
+        breached: Whether the condition holds
+    """
+
+    __slots__ = ('rule', 'value', 'breached')
+
+    def __init__(self, rule: CompiledRule, value: float, breached: bool):
+        self.rule = rule
+        self.value = value
+        self.breached = breached
+
+
+def compile_rule(definition: Dict[str, Any], index: int = 0) -> CompiledRule:
+    """
+    Compile one rule definition from the user document
+
+    Args:
+        definition: The rule map
+        index: Position of the rule, used as id when the rule has none
+
+    Returns:
+        The compiled rule
+
+    Raises:
+        RuleError: If the definition is invalid
+    """
+    if not isinstance(definition, dict):
+        raise RuleError("Rule must be a map")
+
+    metric = definition.get('metric')
+    if metric not in METRICS:
+        raise RuleError(f"Unknown metric '{metric}'. Use one of: {', '.join(METRICS)}")
+
+    op = definition.get('op', '>')
+    if op not in OPERATORS:
+        raise RuleError(f"Unknown operator '{op}'. Use one of: {', '.join(OPERATORS)}")
+
+    threshold = definition.get('threshold')
+    if isinstance(threshold, bool) or not isinstance(threshold, (int, float)):
+        raise RuleError("Rule threshold must be a number")
+
+    duration = definition.get('for', 0)
+    if isinstance(duration, bool) or not isinstance(duration, (int, float)) or duration < 0:
+        raise RuleError("Rule duration ('for') must be a non-negative number of seconds")
+
+    resources = definition.get('resources')
+    if resources is not None and not isinstance(resources, list):
+        raise RuleError("Rule resources must be a list of resource ids")
+
+    hysteresis = definition.get('hysteresis', DEFAULT_HYSTERESIS)
+    cooldown = definition.get('cooldown', DEFAULT_COOLDOWN_SECONDS)
+    for name, value in (('hysteresis', hysteresis), ('cooldown', cooldown)):
+        if isinstance(value, bool) or not isinstance(value, (int, float)) or value < 0:
+            raise RuleError(f"Rule {name} must be a non-negative number")
+
+    rule_id = str(definition.get('id') or index)
+    if rule_id in LEGACY_RULE_IDS:
+        raise RuleError(f"Rule id '{rule_id}' is reserved for the legacy CPU/RAM settings")
+
+    return CompiledRule(
+        id=rule_id,
+        metric=metric,
+        op=op,
+        threshold=float(threshold),
+        duration=float(duration),
+        resources=frozenset(str(resource) for resource in resources) if resources else None,
+        hysteresis=float(hysteresis),
+        cooldown=float(cooldown),
+    )
+
+
+def legacy_rules(user_settings: Dict[str, Any]) -> List[CompiledRule]:
+    """
+    Compile the cpuThreshold / ramThreshold preferences of the app into rules
+
+    Args:
+        user_settings: The user document data
+
+    Returns:
+        Zero, one or two rules
+    """
+    rules = []
+    if user_settings.get('cpuNotificationsEnabled', False):
+        rules.append(CompiledRule('cpu', 'cpu_available', '<', float(user_settings.get('cpuThreshold', 10.0)), type='cpu_alert'))
+    if user_settings.get('ramNotificationsEnabled', False):
+        rules.append(CompiledRule('ram', 'mem_used', '>', float(user_settings.get('ramThreshold', 85.0)), type='ram_alert',
+                                  spec=LEGACY_MEM_USED, key=LEGACY_MEM_USED_KEY))
+    return rules
+
+
+class RuleSet:
+    """
+    The compiled rules of one user, with the rules that apply to each resource memoized
+    """
+
+    __slots__ = ('rules', '_by_resource')
+
+    def __init__(self, rules: List[CompiledRule]):
+        self.rules = tuple(rules)
+        self._by_resource: Dict[str, Tuple[CompiledRule, ...]] = {}
+
+    def __len__(self) -> int:
+        return len(self.rules)
+
+    def for_resource(self, resource_id: str) -> Tuple[CompiledRule, ...]:
+        """Get the rules that apply to a resource."""
+        rules = self._by_resource.get(resource_id)
+        if rules is None:
+            rules = self._by_resource[resource_id] = tuple(rule for rule in self.rules if rule.applies_to(resource_id))
+        return rules
+
+    def evaluate(self, resource_id: str, batch: MetricsBatch) -> List[RuleResult]:
+        """
+        Evaluate every rule of a resource against a batch
+
+        Args:
+            resource_id: The resource the batch belongs to
+            batch: The indexed metrics batch
+
+        Returns:
+            One result per rule whose metric is present in the batch
+        """
+        values: Dict[str, Optional[float]] = {}
+        results = []
+        for rule in self.for_resource(resource_id):
+            key = rule.key
+            if key in values:
+                value = values[key]
+            else:
+                value = values[key] = rule.spec.extract(batch)
+            if value is None:
+                continue
+            results.append(RuleResult(rule, value, rule.compare(value, rule.threshold)))
+        return results
+
+    def evaluate_values(self, resource_id: str, values: Dict[str, float]) -> List[RuleResult]:
+        """
+        Evaluate every rule of a resource against values extracted at ingest
+
+        Args:
+            resource_id: The resource the values belong to
+            values: Value per key of ALERT_VALUES, as built by alert_values
+
+        Returns:
+            One result per rule whose value is present
+        """
+        results = []
+        for rule in self.for_resource(resource_id):
+            value = values.get(rule.key)
+            if value is None:
+                continue
+            results.append(RuleResult(rule, value, rule.compare(value, rule.threshold)))
+        return results
+
+
+def alert_values(batch: MetricsBatch) -> Dict[str, float]:
+    """
+    Extract every value alert rules can read from a batch
+
+    Args:
+        batch: The indexed metrics batch, including the derived rate and anomaly metrics
+
+    Returns:
+        Value per key of ALERT_VALUES, for the values present in the batch
+    """
+    values = {}
+    for key, spec in ALERT_VALUES.items():
+        value = spec.extract(batch)
+        if value is not None:
+            values[key] = value
+    return values
+
+
+def compile_rules(user_settings: Dict[str, Any]) -> RuleSet:
+    """
+    Compile the alert rules of a user. Invalid rules are logged and skipped.
+
+    Args:
+        user_settings: The user document data
+
+    Returns:
+        The compiled rule set
+    """
+    rules = legacy_rules(user_settings)
+    definitions = user_settings.get('alertRules') or []
+    for index, definition in enumerate(definitions if isinstance(definitions, list) else []):
+        if isinstance(definition, dict) and definition.get('enabled') is False:
+            continue
+        try:
+            rules.append(compile_rule(definition, index))
+        except RuleError as e:
+            logger.warn(f"Skipping invalid alert rule #{index}: {str(e)}")
+    return RuleSet(rules)
+
+
+# Maps user_id -> (settings the rule set was compiled from, RuleSet)
+rule_cache = TTLCache(max_size=RULE_CACHE_MAX_SIZE, ttl=RULE_CACHE_TTL_SECONDS)
+
+
+def rules_for_user(user_id: str, user_settings: Dict[str, Any]) -> RuleSet:
+    """
+    Get the compiled rule set of a user, compiling it only when its settings changed
+
+    Args:
+        user_id: The user's unique identifier
+        user_settings: The user document data
+
+    Returns:
+        The compiled rule set
+    """
+    source = tuple(user_settings.get(key) for key in RULE_SETTINGS)
+
+    found, cached = rule_cache.get(user_id)
+    if found and cached is not None and cached[0] == source:
+        return cached[1]
+
+    rule_set = compile_rules(user_settings)
+    rule_cache.set(user_id, (source, rule_set))
+    return rule_set
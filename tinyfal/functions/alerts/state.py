@@ -0,0 +1,230 @@
+"""
+Alert state per (resource, rule): ok -> pending -> firing -> ok.
+
+    pending  the condition holds, but not yet for the rule's `for` duration or the rule is cooling down
+    firing   the rule fired; nothing more is sent while the value stays inside the hysteresis band
+    ok       the rule is quiet; leaving firing sends a single resolve notification
+
+States live in an in-process cache, so steady-state ingests cost no Firestore reads, writes or
+FCM calls. Only transitions touch Firestore: they are confirmed in a transaction against the
+persisted copy in users/{user_id}/resources/{resource_id}/alerts/state, so two instances never
+notify the same transition twice.
+"""
+import os
+from typing import Any, Dict, List, Optional, Tuple
+
+from firebase_admin import firestore
+
+from alerts.rules import CompiledRule
+from cache.cache import TTLCache
+from instrumentation.instrumentation import record_read, record_write
+
+
+ALERTS_COLLECTION = 'alerts'
+STATE_DOCUMENT = 'state'
+
+ALERT_STATE_CACHE_MAX_SIZE = int(os.environ.get('ALERT_STATE_CACHE_MAX_SIZE', '20000'))
+ALERT_STATE_CACHE_TTL_SECONDS = float(os.environ.get('ALERT_STATE_CACHE_TTL_SECONDS', '3600'))
+
+OK = 'ok'
+PENDING = 'pending'
+FIRING = 'firing'
+
+# Transitions that send a notification
+FIRE = 'fire'
+RESOLVE = 'resolve'
+
+
+class AlertState:
+    """
+    State of one rule on one resource
+
+    Attributes:
+        status: OK, PENDING or FIRING
+        since: When the current status was entered (unix seconds)
+        fired_at: When the rule last fired
+        resolved_at: When the rule last resolved
+        value: Last evaluated metric value
+    """
+
+    __slots__ = ('status', 'since', 'fired_at', 'resolved_at', 'value')
+
+    def __init__(self, status: str = OK, since: float = 0.0, fired_at: Optional[float] = None,
+                 resolved_at: Optional[float] = None, value: Optional[float] = None):
+        self.status = status
+        self.since = since
+        self.fired_at = fired_at
+        self.resolved_at = resolved_at
+        self.value = value
+
+    def copy(self) -> 'AlertState':
+        return AlertState(self.status, self.since, self.fired_at, self.resolved_at, self.value)
+
+    def as_dict(self) -> Dict[str, Any]:
+        return {
+            'status': self.status,
+            'since': self.since,
+            'fired_at': self.fired_at,
+            'resolved_at': self.resolved_at,
+            'value': self.value,
+        }
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> 'AlertState':
+        # Pending is never persisted, so a persisted state is either ok or firing
+        return cls(
+            status=FIRING if data.get('status') == FIRING else OK,
+            since=data.get('since') or 0.0,
+            fired_at=data.get('fired_at'),
+            resolved_at=data.get('resolved_at'),
+            value=data.get('value'),
+        )
+
+
+def advance(state: AlertState, rule: CompiledRule, value: float, breached: bool, now: float) -> Optional[str]:
+    """
+    Move a state forward with a new evaluation
+
+    Args:
+        state: The state to update in place
+        rule: The evaluated rule
+        value: The metric value
+        breached: Whether the rule condition holds
+        now: Evaluation time (unix seconds)
+
+    Returns:
+        FIRE or RESOLVE when a notification is due, otherwise None
+    """
+    state.value = value
+
+    if state.status == FIRING:
+        # Inside the hysteresis band the rule keeps firing, so it does not flap near the threshold
+        if not rule.cleared(value):
+            return None
+        state.status = OK
+        state.since = now
+        state.resolved_at = now
+        return RESOLVE
+
+    if not breached:
+        if state.status == PENDING:
+            state.status = OK
+            state.since = now
+        return None
+
+    if state.status == OK:
+        state.status = PENDING
+        state.since = now
+
+    if now - state.since < rule.duration:
+        return None
+    if state.resolved_at is not None and now - state.resolved_at < rule.cooldown:
+        return None
+
+    state.status = FIRING
+    state.since = now
+    state.fired_at = now
+    return FIRE
+
+
+# Maps (user_id, resource_id) -> {rule_id: AlertState}
+state_cache = TTLCache(max_size=ALERT_STATE_CACHE_MAX_SIZE, ttl=ALERT_STATE_CACHE_TTL_SECONDS)
+
+
+def alert_state_ref(db, user_id: str, resource_id: str):
+    """Get the document holding the persisted alert states of a resource."""
+    return (
+        db.collection('users').document(user_id)
+        .collection('resources').document(resource_id)
+        .collection(ALERTS_COLLECTION).document(STATE_DOCUMENT)
+    )
+
+
+def _persisted_states(snapshot) -> Dict[str, AlertState]:
+    data = snapshot.to_dict() if snapshot.exists else None
+    rules = (data or {}).get('rules') or {}
+    return {rule_id: AlertState.from_dict(state) for rule_id, state in rules.items() if isinstance(state, dict)}
+
+
+def load_states(db, user_id: str, resource_id: str) -> Dict[str, AlertState]:
+    """
+    Get the alert states of a resource. Only a cold cache reads Firestore.
+
+    Args:
+        db: Firestore client
+        user_id: Owner of the resource
+        resource_id: The resource
+
+    Returns:
+        Mutable map of rule_id -> AlertState, shared through the cache
+    """
+    key = (user_id, resource_id)
+    found, states = state_cache.get(key)
+    if found and states is not None:
+        return states
+
+    states = _persisted_states(alert_state_ref(db, user_id, resource_id).get())
+    record_read()
+    state_cache.set(key, states)
+    return states
+
+
+def commit_transitions(
+    db,
+    user_id: str,
+    resource_id: str,
+    states: Dict[str, AlertState],
+    advanced: Dict[str, AlertState],
+    transitions: List[Tuple[str, str]]
+) -> List[Tuple[str, str]]:
+    """
+    Confirm transitions against the persisted states and persist them, in one transaction.
+    A transition another instance already made is dropped and its state adopted.
+    The cached states only change once the transaction committed; if it fails, the cache entry
+    of the resource is dropped so the next evaluation starts from the persisted states.
+
+    Args:
+        db: Firestore client
+        user_id: Owner of the resource
+        resource_id: The resource
+        states: The cached states the transitions were computed on
+        advanced: Copies of the states of the transitioning rules, moved forward by advance()
+        transitions: (rule_id, FIRE or RESOLVE) pairs
+
+    Returns:
+        The transitions that should be notified
+    """
+    ref = alert_state_ref(db, user_id, resource_id)
+
+    @firestore.transactional
+    def confirm(transaction) -> Tuple[List[Tuple[str, str]], Dict[str, AlertState]]:
+        persisted = _persisted_states(ref.get(transaction=transaction))
+        confirmed = []
+        adopted = {}
+        for rule_id, transition in transitions:
+            current = persisted.get(rule_id)
+            already_firing = current is not None and current.status == FIRING
+            if (transition == FIRE) != already_firing:
+                confirmed.append((rule_id, transition))
+            else:
+                adopted[rule_id] = current
+        if confirmed:
+            transaction.set(ref, {
+                'rules': {rule_id: advanced[rule_id].as_dict() for rule_id, _ in confirmed},
+                'updated_at': firestore.SERVER_TIMESTAMP,
+            }, merge=True)
+        return confirmed, adopted
+
+    try:
+        confirmed, adopted = confirm(db.transaction())
+    except Exception:
+        state_cache.invalidate((user_id, resource_id))
+        raise
+    record_read()
+    if confirmed:
+        record_write()
+    for rule_id, _ in confirmed:
+        states[rule_id] = advanced[rule_id]
+    for rule_id, state in adopted.items():
+        states[rule_id] = state if state is not None else advanced[rule_id]
+    return confirmed
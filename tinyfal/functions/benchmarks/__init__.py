@@ -0,0 +1 @@
+# Benchmarks for Tinyfal Firebase Functions
@@ -0,0 +1,92 @@
+"""
+Measure the cold-start import cost of every deployed function with `python -X importtime`.
+
+Run from the functions directory:
+
+    python -m benchmarks.import_benchmark [runs] [function ...]
+
+Each run starts a fresh interpreter that imports main.py, then the modules the function imports
+lazily on its first invocation (FIRST_CALL_IMPORTS). Times are the median over the runs; the
+slowest top-level imports are listed so regressions can be traced to a dependency.
+"""
+import statistics
+import subprocess
+import sys
+from pathlib import Path
+from typing import Dict, List, Tuple
+
+
+FUNCTIONS_DIR = Path(__file__).resolve().parent.parent
+
+# Function -> modules imported on its first invocation, deferred out of main.py's import.
+# Keep in sync with the lazy imports of the code each function runs.
+FIRST_CALL_IMPORTS: Dict[str, List[str]] = {
+    'ingest': [],
+    'ingest_batch': [],
+    'on_resource_created': ['jinja2', 'requests'],
+    'on_resource_written': ['firebase_admin.messaging', 'firebase_admin.functions'],
+    'on_plan_written': [],
+    'on_user_updated': [],
+    'deliver_alert_digest': ['firebase_admin.messaging'],
+    'deliver_overdue_digests': ['firebase_admin.messaging'],
+    'rollup_history': ['numpy'],
+    'compact_history': ['numpy'],
+    'send_daily_report': ['jinja2', 'requests'],
+}
+
+TOP_IMPORTS = 8
+
+
+def parse_importtime(stderr: str) -> Tuple[int, Dict[str, int]]:
+    """
+    Parse `-X importtime` output
+
+    Returns:
+        Total import time in microseconds, and the cumulative time of each top-level import
+    """
+    total = 0
+    top_level: Dict[str, int] = {}
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|', 2)
+        total += int(self_us)
+        # Top-level imports are not indented beyond the single separating space
+        if not name[1:].startswith(' '):
+            top_level[name.strip()] = int(cumulative_us)
+    return total, top_level
+
+
+def measure(modules: List[str]) -> Tuple[int, Dict[str, int]]:
+    """Import main and the given modules in a fresh interpreter."""
+    code = '; '.join(['import main'] + [f'import {module}' for module in modules])
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', code],
+        cwd=FUNCTIONS_DIR,
+        capture_output=True,
+        text=True,
+    )
+    if result.returncode != 0:
+        raise RuntimeError(result.stderr.strip().splitlines()[-1])
+    return parse_importtime(result.stderr)
+
+
+def report(function: str, runs: int) -> None:
+    totals = []
+    top_level: Dict[str, List[int]] = {}
+    for _ in range(runs):
+        total, modules = measure(FIRST_CALL_IMPORTS[function])
+        totals.append(total)
+        for name, cumulative in modules.items():
+            top_level.setdefault(name, []).append(cumulative)
+
+    slowest = sorted(((statistics.median(times), name) for name, times in top_level.items()), reverse=True)
+    print(f"{function}: {statistics.median(totals) / 1000:.1f} ms")
+    for cumulative, name in slowest[:TOP_IMPORTS]:
+        print(f"  {cumulative / 1000:8.1f} ms  {name}")
+
+
+if __name__ == "__main__":
+    run_count = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+    for name in sys.argv[2:] or list(FIRST_CALL_IMPORTS):
+        report(name, run_count)
@@ -0,0 +1,63 @@
+"""
+Report the Firestore storage size of recorded ingest payloads before and after projection.
+
+Run from the functions directory:
+
+    python -m benchmarks.projection_report [payload.json ...]
+
+Without arguments every file in benchmarks/payloads is reported.
+"""
+import json
+import sys
+from pathlib import Path
+from typing import Any
+
+from models.projection import DEFAULT_PROJECTION, project_payload
+
+
+PAYLOADS_DIR = Path(__file__).parent / 'payloads'
+
+# Fixed per-document overhead used by Firestore's storage size calculation
+DOCUMENT_OVERHEAD = 32
+
+
+def firestore_size(value: Any) -> int:
+    """
+    Approximate the storage size of a value following Firestore's documented rules
+
+    Args:
+        value: A JSON-compatible value
+
+    Returns:
+        Size in bytes
+    """
+    if value is None or isinstance(value, bool):
+        return 1
+    if isinstance(value, (int, float)):
+        return 8
+    if isinstance(value, str):
+        return len(value.encode('utf-8')) + 1
+    if isinstance(value, list):
+        return sum(firestore_size(item) for item in value)
+    if isinstance(value, dict):
+        return sum(firestore_size(str(key)) + firestore_size(item) for key, item in value.items())
+    return len(str(value).encode('utf-8')) + 1
+
+
+def report(path: Path) -> None:
+    payload = json.loads(path.read_text())
+    projected = project_payload(payload, DEFAULT_PROJECTION)
+
+    before = firestore_size(payload) + DOCUMENT_OVERHEAD
+    after = firestore_size(projected) + DOCUMENT_OVERHEAD
+    saved = 100.0 * (before - after) / before if before else 0.0
+
+    print(f"{path.name}")
+    print(f"  metrics: {len(payload.get('metrics', []))} -> {len(projected.get('metrics', []))}")
+    print(f"  stored bytes: {before} -> {after} ({saved:.1f}% smaller)")
+
+
+if __name__ == "__main__":
+    paths = [Path(arg) for arg in sys.argv[1:]] or sorted(PAYLOADS_DIR.glob('*.json'))
+    for payload_path in paths:
+        report(payload_path)
@@ -0,0 +1,59 @@
+"""
+Time the evaluation of compiled alert rules against a recorded ingest payload.
+
+Run from the functions directory:
+
+    python -m benchmarks.rules_benchmark [rule_count] [payload.json]
+
+Rules are spread over every metric and operator, half of them scoped to other resources.
+"""
+import json
+import sys
+import timeit
+from pathlib import Path
+
+from alerts.rules import METRICS, OPERATORS, compile_rules
+from models.models import MetricsBatch
+
+
+PAYLOADS_DIR = Path(__file__).parent / 'payloads'
+
+
+def build_settings(rule_count: int) -> dict:
+    metrics = list(METRICS)
+    operators = list(OPERATORS)
+    return {
+        'alertRules': [
+            {
+                'id': f"rule-{index}",
+                'metric': metrics[index % len(metrics)],
+                'op': operators[index % len(operators)],
+                'threshold': index % 100,
+                'resources': ['bench'] if index % 2 == 0 else ['other'],
+            }
+            for index in range(rule_count)
+        ],
+    }
+
+
+def report(rule_count: int, path: Path) -> None:
+    payload = json.loads(path.read_text())
+    rule_set = compile_rules(build_settings(rule_count))
+    batch = MetricsBatch(payload.get('metrics', []))
+
+    # The first call memoizes the rules of the resource, as on a warm instance
+    rule_set.evaluate('bench', batch)
+
+    runs = 2000
+    per_call = timeit.timeit(lambda: rule_set.evaluate('bench', MetricsBatch(payload['metrics'])), number=runs) / runs
+    per_eval = timeit.timeit(lambda: rule_set.evaluate('bench', batch), number=runs) / runs
+
+    print(f"{path.name}: {len(rule_set)} rules, {len(rule_set.for_resource('bench'))} apply to the resource")
+    print(f"  evaluate (indexed batch): {per_eval * 1e6:.1f} us")
+    print(f"  index batch + evaluate:   {per_call * 1e6:.1f} us")
+
+
+if __name__ == "__main__":
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 300
+    payload_path = Path(sys.argv[2]) if len(sys.argv) > 2 else PAYLOADS_DIR / 'host_docker_percpu.json'
+    report(count, payload_path)
@@ -0,0 +1 @@
+# Cache package for Tinyfal Firebase Functions
@@ -0,0 +1,108 @@
+"""
+Small in-process caches shared by warm Cloud Functions instances
+"""
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Hashable, Optional, Tuple
+
+
+class TTLCache:
+    """
+    Bounded LRU cache whose entries expire after a time-to-live.
+
+    Negative entries (a cached "not found") are stored with their own, usually
+    shorter, TTL so that bad or revoked keys do not hit the backend on every call
+    but recover quickly once they become valid.
+
+    The cache is thread safe, since a single instance may serve concurrent requests.
+    """
+
+    def __init__(
+        self,
+        max_size: int = 1024,
+        ttl: float = 300.0,
+        negative_ttl: float = 30.0,
+        clock: Callable[[], float] = time.monotonic
+    ):
+        """
+        Args:
+            max_size: Maximum number of entries kept before evicting the least recently used
+            ttl: Lifetime in seconds of positive entries
+            negative_ttl: Lifetime in seconds of negative entries
+            clock: Monotonic time source, injectable for testing
+        """
+        if max_size <= 0:
+            raise ValueError("max_size must be a positive integer")
+        self.max_size = max_size
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self._clock = clock
+        self._entries: "OrderedDict[Hashable, Tuple[float, Any]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable) -> Tuple[bool, Any]:
+        """
+        Look up a key
+
+        Args:
+            key: The cache key
+
+        Returns:
+            Tuple (found, value). A cached negative entry is returned as (True, None)
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return False, None
+
+            expires_at, value = entry
+            if expires_at <= self._clock():
+                del self._entries[key]
+                return False, None
+
+            self._entries.move_to_end(key)
+            return True, value
+
+    def set(self, key: Hashable, value: Any, ttl: Optional[float] = None) -> None:
+        """
+        Store a value, evicting the least recently used entry if the cache is full
+
+        Args:
+            key: The cache key
+            value: The value to store
+            ttl: Optional lifetime override in seconds
+        """
+        lifetime = self.ttl if ttl is None else ttl
+        with self._lock:
+            self._entries[key] = (self._clock() + lifetime, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def set_negative(self, key: Hashable) -> None:
+        """
+        Remember that a key does not exist for the negative TTL
+
+        Args:
+            key: The cache key
+        """
+        self.set(key, None, ttl=self.negative_ttl)
+
+    def invalidate(self, key: Hashable) -> None:
+        """
+        Drop a key from the cache if present
+
+        Args:
+            key: The cache key
+        """
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self) -> None:
+        """Drop every entry."""
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self) -> int:
+        return len(self._entries)
@@ -0,0 +1 @@
+# Database package for Tinyfal Firebase Functions
@@ -0,0 +1,24 @@
+"""
+Shared Firestore client of the process
+"""
+import threading
+from typing import Any, Optional
+
+from firebase_admin import firestore
+
+
+_client: Optional[Any] = None
+_client_lock = threading.Lock()
+
+
+def get_db():
+    """
+    Get the Firestore client, created on first use.
+    Requires the default Firebase app to be initialized.
+    """
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                _client = firestore.client()
+    return _client
@@ -0,0 +1 @@
+# History package for Tinyfal Firebase Functions
@@ -0,0 +1,230 @@
+"""
+Per-resource time-series history stored in fixed-window bucket documents.
+
+Samples live under users/{user_id}/resources/{resource_id}/history/{bucket_id}, one document
+per resource per hour. The bucket id is the UTC hour start as 'YYYYMMDDHH', so document ids
+sort chronologically and a time range maps to a single document-id range query.
+
+While a bucket is open, ingest appends with a blind merged write into a `samples` map keyed by
+the offset (in seconds) from the bucket start. That keeps ingest free of reads and lets
+concurrent writers coexist. Once closed, a bucket can be packed into parallel numeric arrays
+(`ts`, `cpu`, `mem`, ...) which is the shape returned by query_history.
+"""
+import os
+from datetime import datetime, timedelta, timezone
+from typing import Any, Dict, List, Optional, Tuple
+
+from google.cloud.firestore_v1.field_path import FieldPath
+
+from models.models import (
+    MetricsData,
+    as_batch,
+    extract_cpu_usage_percent,
+    extract_used_memory_percent,
+    extract_swap_used_percent,
+    extract_disk_usage_percent,
+    extract_network_rates,
+)
+
+
+HISTORY_COLLECTION = 'history'
+
+BUCKET_SECONDS = 3600
+
+# Raw buckets expire through a Firestore TTL policy on `expire_at`, once rolled up
+RAW_RETENTION_DAYS = int(os.environ.get('HISTORY_RAW_RETENTION_DAYS', '8'))
+
+# Order of the values stored for each sample. Network values are per-second rates in MB/s over
+# the interval since the previous batch (see models.rates), never the cumulative counters
+SAMPLE_FIELDS = ('cpu', 'mem', 'swap', 'disk', 'net_rx_rate', 'net_tx_rate')
+
+
+def bucket_start(ts: int) -> int:
+    """
+    Get the start of the bucket a timestamp falls in
+
+    Args:
+        ts: Unix timestamp in seconds
+
+    Returns:
+        Unix timestamp of the bucket start
+    """
+    return ts - ts % BUCKET_SECONDS
+
+
+def bucket_id(ts: int) -> str:
+    """
+    Get the id of the bucket document a timestamp falls in
+
+    Args:
+        ts: Unix timestamp in seconds
+
+    Returns:
+        Bucket id formatted as 'YYYYMMDDHH' (UTC)
+    """
+    return datetime.fromtimestamp(bucket_start(ts), tz=timezone.utc).strftime('%Y%m%d%H')
+
+
+def history_collection(db, user_id: str, resource_id: str):
+    """Get the history subcollection of a resource."""
+    return db.collection('users').document(user_id).collection('resources').document(resource_id).collection(HISTORY_COLLECTION)
+
+
+def extract_sample(data: MetricsData) -> Dict[str, Optional[float]]:
+    """
+    Build a compact history sample from a metrics batch
+
+    Args:
+        data: List of resource metric dictionaries or a MetricsBatch, including the rates
+            derived by models.rates
+
+    Returns:
+        Dictionary with one value (or None) per entry of SAMPLE_FIELDS
+    """
+    batch = as_batch(data)
+    network = extract_network_rates(batch)
+
+    return {
+        'cpu': extract_cpu_usage_percent(batch),
+        'mem': extract_used_memory_percent(batch),
+        'swap': extract_swap_used_percent(batch),
+        'disk': extract_disk_usage_percent(batch),
+        'net_rx_rate': network[0] if network else None,
+        'net_tx_rate': network[1] if network else None,
+    }
+
+
+def append_sample(db, write_batch, user_id: str, resource_id: str, ts: int, sample: Dict[str, Optional[float]]) -> None:
+    """
+    Queue the append of a sample to its bucket on a write batch.
+    This is a blind merged write: no read is needed and it commits together with the batch.
+
+    Args:
+        db: Firestore client
+        write_batch: Firestore WriteBatch the write is added to
+        user_id: Owner of the resource
+        resource_id: The resource the sample belongs to
+        ts: Unix timestamp of the sample in seconds
+        sample: Values keyed by SAMPLE_FIELDS
+    """
+    append_samples(db, write_batch, user_id, resource_id, [(ts, sample)])
+
+
+def append_samples(db, write_batch, user_id: str, resource_id: str, samples: List[Tuple[int, Dict[str, Optional[float]]]]) -> int:
+    """
+    Queue the append of several samples on a write batch, one blind merged write per bucket
+
+    Args:
+        db: Firestore client
+        write_batch: Firestore WriteBatch the writes are added to
+        user_id: Owner of the resource
+        resource_id: The resource the samples belong to
+        samples: (unix timestamp, values keyed by SAMPLE_FIELDS) pairs
+
+    Returns:
+        Number of writes queued
+    """
+    by_bucket: Dict[int, Dict[str, List[Optional[float]]]] = {}
+    for ts, sample in samples:
+        start = bucket_start(ts)
+        by_bucket.setdefault(start, {})[str(ts - start)] = [sample.get(field) for field in SAMPLE_FIELDS]
+
+    collection = history_collection(db, user_id, resource_id)
+    for start, bucket_samples in by_bucket.items():
+        start_time = datetime.fromtimestamp(start, tz=timezone.utc)
+        write_batch.set(collection.document(bucket_id(start)), {
+            'start': start_time,
+            'expire_at': start_time + timedelta(days=RAW_RETENTION_DAYS),
+            'fields': list(SAMPLE_FIELDS),
+            'samples': bucket_samples,
+        }, merge=True)
+
+    return len(by_bucket)
+
+
+def bucket_arrays(data: Dict[str, Any]) -> Dict[str, List[Any]]:
+    """
+    Get the samples of a bucket document as parallel arrays sorted by time.
+    Works for open buckets (samples map), packed buckets (arrays) and packed buckets
+    that received a late sample after packing.
+
+    Args:
+        data: The bucket document data
+
+    Returns:
+        Dictionary with a 'ts' array and one array per sample field
+    """
+    keys = ('ts',) + SAMPLE_FIELDS
+    rows = []
+
+    if 'ts' in data:
+        rows.extend(zip(*(data.get(key) or [] for key in keys)))
+
+    samples = data.get('samples')
+    if samples:
+        start = data.get('start')
+        start_ts = int(start.timestamp()) if start is not None else 0
+        fields = data.get('fields') or list(SAMPLE_FIELDS)
+        for offset, values in samples.items():
+            by_field = dict(zip(fields, values))
+            rows.append((start_ts + int(offset),) + tuple(by_field.get(field) for field in SAMPLE_FIELDS))
+        rows.sort(key=lambda row: row[0])
+
+    return {key: [row[index] for row in rows] for index, key in enumerate(keys)}
+
+
+def pack_bucket(data: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Convert a closed bucket into its array-backed form
+
+    Args:
+        data: The bucket document data
+
+    Returns:
+        Document data with parallel arrays and no samples map
+    """
+    packed = {
+        'start': data.get('start'),
+        'fields': list(SAMPLE_FIELDS),
+        **bucket_arrays(data),
+    }
+    if 'expire_at' in data:
+        packed['expire_at'] = data['expire_at']
+    return packed
+
+
+def query_history(db, user_id: str, resource_id: str, start: datetime, end: datetime) -> Dict[str, List[Any]]:
+    """
+    Get the samples of a resource within a time range.
+    Reads exactly one document per hour in the range with a single document-id range query.
+
+    Args:
+        db: Firestore client
+        user_id: Owner of the resource
+        resource_id: The resource to query
+        start: Range start (inclusive, timezone aware)
+        end: Range end (inclusive, timezone aware)
+
+    Returns:
+        Parallel arrays: 'ts' (unix seconds) and one array per entry of SAMPLE_FIELDS
+    """
+    start_ts = int(start.timestamp())
+    end_ts = int(end.timestamp())
+    collection = history_collection(db, user_id, resource_id)
+
+    query = (
+        collection
+        .where(FieldPath.document_id(), '>=', collection.document(bucket_id(start_ts)))
+        .where(FieldPath.document_id(), '<=', collection.document(bucket_id(end_ts)))
+        .order_by(FieldPath.document_id())
+    )
+
+    result: Dict[str, List[Any]] = {key: [] for key in ('ts',) + SAMPLE_FIELDS}
+    for bucket_doc in query.stream():
+        arrays = bucket_arrays(bucket_doc.to_dict() or {})
+        for index, ts in enumerate(arrays['ts']):
+            if start_ts <= ts <= end_ts:
+                for key in result:
+                    result[key].append(arrays[key][index])
+    return result
+
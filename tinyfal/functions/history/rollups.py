@@ -0,0 +1,415 @@
+"""
+Multi-resolution rollups of the resource history, computed with NumPy.
+
+Rollup points keep min, max, mean, p95 (nearest rank), last and count for every sample field,
+at 1m, 5m, 1h and 1d resolution. Points are grouped into window documents under
+users/{user_id}/resources/{resource_id}/rollups/{resolution}_{window_start}, sized so that a
+30 day chart reads a couple of 1h documents instead of hundreds of raw buckets.
+
+1m, 5m and 1h points are written by the hourly rollup once a raw bucket closes. 1d points are
+written by the daily compaction, which also packs the day's raw buckets into their array-backed form.
+"""
+import os
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from typing import TYPE_CHECKING, Any, Callable, Dict, Iterable, Iterator, List, Optional
+
+from google.cloud.firestore_v1.field_path import FieldPath
+from firebase_functions import logger
+
+from history.history import (
+    HISTORY_COLLECTION,
+    SAMPLE_FIELDS,
+    BUCKET_SECONDS,
+    bucket_arrays,
+    bucket_id,
+    history_collection,
+    pack_bucket,
+)
+
+if TYPE_CHECKING:
+    import numpy as np
+
+
+ROLLUPS_COLLECTION = 'rollups'
+
+# Resolution name -> point width in seconds
+RESOLUTIONS = {'1m': 60, '5m': 300, '1h': 3600, '1d': 86400}
+
+# Resolution name -> width in seconds of the document holding its points
+WINDOWS = {'1m': 6 * 3600, '5m': 86400, '1h': 32 * 86400, '1d': 366 * 86400}
+
+# Fine resolutions expire through a Firestore TTL policy on `expire_at`; None keeps them forever
+RETENTION_DAYS = {
+    '1m': int(os.environ.get('ROLLUP_1M_RETENTION_DAYS', '7')),
+    '5m': int(os.environ.get('ROLLUP_5M_RETENTION_DAYS', '35')),
+    '1h': int(os.environ.get('ROLLUP_1H_RETENTION_DAYS', '400')),
+    '1d': None,
+}
+
+# Order of the values stored for each field of a point
+STATS = ('min', 'max', 'mean', 'p95', 'last', 'count')
+
+HOURLY_RESOLUTIONS = ('1m', '5m', '1h')
+
+COMPACTION_PAGE_SIZE = 200
+COMPACTION_WORKERS = 16
+
+
+def rollup_series(ts: 'np.ndarray', values: 'np.ndarray', resolution: int) -> Dict[int, List[float]]:
+    """
+    Aggregate one series into fixed-width points, fully vectorized
+
+    Args:
+        ts: Unix timestamps in seconds (int64, any order)
+        values: Sample values (float64, NaN for missing samples)
+        resolution: Point width in seconds
+
+    Returns:
+        Point start timestamp -> [min, max, mean, p95, last, count]
+    """
+    import numpy as np
+
+    valid = ~np.isnan(values)
+    ts = ts[valid]
+    values = values[valid]
+    if ts.size == 0:
+        return {}
+
+    bins = ts - ts % resolution
+
+    # Sorted by (bin, value) for min/max/p95 and by (bin, ts) for last; both group rows by bin
+    by_value = np.lexsort((values, bins))
+    by_time = np.lexsort((ts, bins))
+    sorted_bins = bins[by_value]
+    sorted_values = values[by_value]
+
+    starts = np.flatnonzero(np.r_[True, sorted_bins[1:] != sorted_bins[:-1]])
+    counts = np.diff(np.r_[starts, sorted_bins.size])
+    ends = starts + counts - 1
+
+    mins = sorted_values[starts]
+    maxs = sorted_values[ends]
+    means = np.add.reduceat(sorted_values, starts) / counts
+    p95s = sorted_values[starts + np.ceil(0.95 * counts).astype(np.int64) - 1]
+    lasts = values[by_time][ends]
+
+    return {
+        int(point): [float(mn), float(mx), float(mean), float(p95), float(last), int(count)]
+        for point, mn, mx, mean, p95, last, count
+        in zip(sorted_bins[starts], mins, maxs, means, p95s, lasts, counts)
+    }
+
+
+def rollup_arrays(arrays: Dict[str, List[Any]], resolution: int) -> Dict[int, Dict[str, List[float]]]:
+    """
+    Aggregate parallel sample arrays into points for every sample field
+
+    Args:
+        arrays: Parallel arrays as returned by history.bucket_arrays
+        resolution: Point width in seconds
+
+    Returns:
+        Point start timestamp -> {field: [min, max, mean, p95, last, count]}
+    """
+    # Imported on first use: only the scheduled rollup functions need NumPy
+    import numpy as np
+
+    ts = np.asarray(arrays.get('ts') or [], dtype=np.int64)
+    points: Dict[int, Dict[str, List[float]]] = {}
+    if ts.size == 0:
+        return points
+
+    for field in SAMPLE_FIELDS:
+        # None becomes NaN, which rollup_series drops
+        values = np.asarray(arrays.get(field) or [], dtype=np.float64)
+        if values.size != ts.size:
+            continue
+        for point, stats in rollup_series(ts, values, resolution).items():
+            points.setdefault(point, {})[field] = stats
+    return points
+
+
+def rollups_collection(db, user_id: str, resource_id: str):
+    """Get the rollups subcollection of a resource."""
+    return db.collection('users').document(user_id).collection('resources').document(resource_id).collection(ROLLUPS_COLLECTION)
+
+
+def window_start(resolution: str, ts: int) -> int:
+    """Get the start of the window document holding the point at ts."""
+    return ts - ts % WINDOWS[resolution]
+
+
+def window_id(resolution: str, ts: int) -> str:
+    """Get the id of the window document holding the point at ts ('1h_1753401600')."""
+    return f"{resolution}_{window_start(resolution, ts):010d}"
+
+
+def write_points(db, write_batch, user_id: str, resource_id: str, resolution: str, points: Dict[int, Dict[str, List[float]]]) -> int:
+    """
+    Queue blind merged writes of rollup points, one per window document touched
+
+    Args:
+        db: Firestore client
+        write_batch: Firestore WriteBatch the writes are added to
+        user_id: Owner of the resource
+        resource_id: The resource the points belong to
+        resolution: Resolution name (key of RESOLUTIONS)
+        points: Points as returned by rollup_arrays
+
+    Returns:
+        Number of writes queued
+    """
+    by_window: Dict[int, Dict[str, Any]] = {}
+    for point, stats in points.items():
+        by_window.setdefault(window_start(resolution, point), {})[str(point)] = stats
+
+    collection = rollups_collection(db, user_id, resource_id)
+    retention = RETENTION_DAYS[resolution]
+
+    for start, window_points in by_window.items():
+        data: Dict[str, Any] = {
+            'resolution': resolution,
+            'start': datetime.fromtimestamp(start, tz=timezone.utc),
+            'stats': list(STATS),
+            'points': window_points,
+        }
+        if retention is not None:
+            end = datetime.fromtimestamp(start + WINDOWS[resolution], tz=timezone.utc)
+            data['expire_at'] = end + timedelta(days=retention)
+        write_batch.set(collection.document(f"{resolution}_{start:010d}"), data, merge=True)
+
+    return len(by_window)
+
+
+def close_bucket(db, user_id: str, resource_id: str, closed_bucket_start: int) -> int:
+    """
+    Roll up a closed hourly bucket into 1m, 5m and 1h points.
+    Costs one read and one batched commit; the writes are idempotent.
+
+    Args:
+        db: Firestore client
+        user_id: Owner of the resource
+        resource_id: The resource the bucket belongs to
+        closed_bucket_start: Unix timestamp of the closed bucket start
+
+    Returns:
+        Number of documents written
+    """
+    bucket_doc = history_collection(db, user_id, resource_id).document(bucket_id(closed_bucket_start)).get()
+    if not bucket_doc.exists:
+        return 0
+
+    arrays = bucket_arrays(bucket_doc.to_dict() or {})
+    write_batch = db.batch()
+    writes = 0
+    for resolution in HOURLY_RESOLUTIONS:
+        writes += write_points(db, write_batch, user_id, resource_id, resolution,
+                               rollup_arrays(arrays, RESOLUTIONS[resolution]))
+    if writes:
+        write_batch.commit()
+    return writes
+
+
+def compact_resource_day(db, user_id: str, resource_id: str, day_start: int) -> int:
+    """
+    Compute the exact 1d point of a resource from the day's raw buckets and pack those
+    buckets into parallel arrays
+
+    Args:
+        db: Firestore client
+        user_id: Owner of the resource
+        resource_id: The resource to compact
+        day_start: Unix timestamp of the day start (UTC midnight)
+
+    Returns:
+        Number of raw buckets compacted
+    """
+    collection = history_collection(db, user_id, resource_id)
+    query = (
+        collection
+        .where(FieldPath.document_id(), '>=', collection.document(bucket_id(day_start)))
+        .where(FieldPath.document_id(), '<=', collection.document(bucket_id(day_start + 86400 - BUCKET_SECONDS)))
+    )
+
+    write_batch = db.batch()
+    day: Dict[str, List[Any]] = {key: [] for key in ('ts',) + SAMPLE_FIELDS}
+    buckets = 0
+
+    for bucket_doc in query.stream():
+        data = bucket_doc.to_dict() or {}
+        packed = pack_bucket(data)
+        for key in day:
+            day[key].extend(packed[key])
+        if 'samples' in data:
+            write_batch.set(bucket_doc.reference, packed)
+        buckets += 1
+
+    if not buckets:
+        return 0
+
+    write_points(db, write_batch, user_id, resource_id, '1d', rollup_arrays(day, RESOLUTIONS['1d']))
+    # Kept on the resource so the daily report reads it with the resource list
+    resource_ref = db.collection('users').document(user_id).collection('resources').document(resource_id)
+    write_batch.update(resource_ref, {'daily_summary': summarize_day(day, day_start)})
+    write_batch.commit()
+    return buckets
+
+
+def summarize_day(day: Dict[str, List[Any]], day_start: int) -> Dict[str, Any]:
+    """
+    Summarize one day of samples for the daily report
+
+    Args:
+        day: Parallel arrays of the day, as returned by history.bucket_arrays
+        day_start: Unix timestamp of the day start (UTC midnight)
+
+    Returns:
+        day ('YYYY-MM-DD'), uptime (share of the day's minutes with a sample), cpu_max, mem_max,
+        disk_max (None without samples) and samples
+    """
+    def peak(field: str) -> Optional[float]:
+        values = [value for value in day.get(field) or [] if value is not None]
+        return max(values) if values else None
+
+    minutes = {int(ts) // 60 for ts in day.get('ts') or [] if day_start <= ts < day_start + 86400}
+    return {
+        'day': datetime.fromtimestamp(day_start, tz=timezone.utc).strftime('%Y-%m-%d'),
+        'uptime': round(len(minutes) / 1440, 4),
+        'cpu_max': peak('cpu'),
+        'mem_max': peak('mem'),
+        'disk_max': peak('disk'),
+        'samples': len(day.get('ts') or []),
+    }
+
+
+def _bucket_pages(db, start: int, end: int) -> Iterator[List[Any]]:
+    """
+    Yield pages of the raw buckets starting within [start, end), following a (start, path) cursor.
+    A bucket `start` never changes, so concurrent ingest cannot move documents across the cursor.
+    """
+    base_query = (
+        db.collection_group(HISTORY_COLLECTION)
+        .where('start', '>=', datetime.fromtimestamp(start, tz=timezone.utc))
+        .where('start', '<', datetime.fromtimestamp(end, tz=timezone.utc))
+        .order_by('start')
+        .order_by(FieldPath.document_id())
+        .select(['start'])
+        .limit(COMPACTION_PAGE_SIZE)
+    )
+
+    cursor = None
+    while True:
+        page_query = base_query.start_after(cursor) if cursor is not None else base_query
+        page = list(page_query.stream())
+        if not page:
+            return
+        yield page
+        if len(page) < COMPACTION_PAGE_SIZE:
+            return
+        cursor = page[-1]
+
+
+def _for_active_resources(db, start: int, end: int, task: Callable[[str, str], int], action: str) -> int:
+    """Run task(user_id, resource_id) in parallel, once for every resource with a raw bucket within [start, end)."""
+    total = 0
+    seen = set()
+    with ThreadPoolExecutor(max_workers=COMPACTION_WORKERS) as executor:
+        for page in _bucket_pages(db, start, end):
+            futures = []
+            for doc in page:
+                # users/{user_id}/resources/{resource_id}/history/{bucket_id}
+                resource_ref = doc.reference.parent.parent
+                key = (resource_ref.parent.parent.id, resource_ref.id)
+                if key not in seen:
+                    seen.add(key)
+                    futures.append(executor.submit(task, *key))
+            for future in futures:
+                try:
+                    total += future.result()
+                except Exception as e:
+                    logger.error(f"Failed to {action}: {str(e)}")
+    return total
+
+
+def rollup_hour(db, hour: datetime) -> int:
+    """
+    Roll up one closed UTC hour for every resource with a raw bucket for that hour.
+
+    Args:
+        db: Firestore client
+        hour: Any time within the hour to roll up (timezone aware)
+
+    Returns:
+        Number of rollup documents written
+    """
+    hour_start = int(hour.timestamp()) - int(hour.timestamp()) % BUCKET_SECONDS
+    return _for_active_resources(
+        db, hour_start, hour_start + BUCKET_SECONDS,
+        lambda user_id, resource_id: close_bucket(db, user_id, resource_id, hour_start),
+        'roll up history',
+    )
+
+
+def compact_day(db, day: datetime) -> int:
+    """
+    Compact one UTC day for every resource with a raw bucket within that day.
+    Buckets are paged with a cursor and their resources compacted in parallel.
+
+    Args:
+        db: Firestore client
+        day: Any time within the day to compact (timezone aware)
+
+    Returns:
+        Number of raw buckets compacted
+    """
+    day_start = int(day.timestamp()) - int(day.timestamp()) % 86400
+    return _for_active_resources(
+        db, day_start, day_start + 86400,
+        lambda user_id, resource_id: compact_resource_day(db, user_id, resource_id, day_start),
+        'compact history',
+    )
+
+
+def query_rollups(db, user_id: str, resource_id: str, resolution: str, start: datetime, end: datetime) -> Dict[str, List[Any]]:
+    """
+    Get rollup points of a resource within a time range, reading one document per window
+
+    Args:
+        db: Firestore client
+        user_id: Owner of the resource
+        resource_id: The resource to query
+        resolution: Resolution name (key of RESOLUTIONS)
+        start: Range start (inclusive, timezone aware)
+        end: Range end (inclusive, timezone aware)
+
+    Returns:
+        Parallel arrays: 'ts' plus '{field}_{stat}' for every sample field and stat
+    """
+    start_ts = int(start.timestamp())
+    end_ts = int(end.timestamp())
+    collection = rollups_collection(db, user_id, resource_id)
+
+    query = (
+        collection
+        .where(FieldPath.document_id(), '>=', collection.document(window_id(resolution, start_ts)))
+        .where(FieldPath.document_id(), '<=', collection.document(window_id(resolution, end_ts)))
+        .order_by(FieldPath.document_id())
+    )
+
+    keys = [f"{field}_{stat}" for field in SAMPLE_FIELDS for stat in STATS]
+    result: Dict[str, List[Any]] = {key: [] for key in ['ts'] + keys}
+
+    for window_doc in query.stream():
+        points = (window_doc.to_dict() or {}).get('points') or {}
+        for point in sorted(points, key=int):
+            ts = int(point)
+            if not start_ts <= ts <= end_ts:
+                continue
+            result['ts'].append(ts)
+            for field in SAMPLE_FIELDS:
+                stats: Optional[Iterable[Any]] = points[point].get(field)
+                values = list(stats) if stats else [None] * len(STATS)
+                for stat, value in zip(STATS, values):
+                    result[f"{field}_{stat}"].append(value)
+    return result
@@ -0,0 +1,314 @@
+"""
+Streaming statistics and anomaly scores of the values extracted at ingest.
+
+Every resource keeps, per field of STREAM_FIELDS, an exponentially weighted mean and variance
+and three quantile estimates (STREAM_QUANTILES) that move with every value. Each is updated in
+constant time from the new value alone, so the state of a resource is a few floats whatever its
+history:
+
+    {"cpu": [n, mean, var, p05, p50, p95], "mem": [...], ..., "ts": 1700000000}
+
+The state lives in a per-instance cache and is stored on the resource document as
+`stream_stats`, written with the latest payload by the coalescing buffer. An instance that has
+not seen the resource reads it back in the background and does not score the batches that arrive
+meanwhile, so ingest never waits on the read; batch ingest starts one multi-get for all of its
+resources. Concurrent instances each update their own copy and the last write wins, which only
+loses a few samples of weight.
+
+Each batch is scored against the statistics before it: the distance of every value from the
+mean in standard deviations, once the field has STREAM_WARMUP_SAMPLES samples. The scores are
+stored with the snapshot as one extra measurement, which alert rules read as `anomaly_score`:
+
+    {"name": "anomaly", "tags": {}, "fields": {"cpu": 0.42, "mem": 3.1, ...}}
+"""
+import contextvars
+import math
+import os
+import threading
+from array import array
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+from firebase_functions import logger
+
+from cache.cache import TTLCache
+from instrumentation.instrumentation import record_read
+from models.models import MetricsBatch, extract_disk_io_rates
+
+
+STREAM_STATS_FIELD = 'stream_stats'
+ANOMALY_MEASUREMENT = 'anomaly'
+
+# Weight of the newest value; the statistics remember roughly the last 1 / alpha samples
+STREAM_ALPHA = float(os.environ.get('STREAM_STATS_ALPHA', '0.02'))
+STREAM_WARMUP_SAMPLES = int(os.environ.get('STREAM_STATS_WARMUP_SAMPLES', '30'))
+STREAM_CACHE_MAX_SIZE = int(os.environ.get('STREAM_STATS_CACHE_MAX_SIZE', '20000'))
+STREAM_CACHE_TTL_SECONDS = float(os.environ.get('STREAM_STATS_CACHE_TTL_SECONDS', '3600'))
+STREAM_LOAD_WORKERS = int(os.environ.get('STREAM_STATS_LOAD_WORKERS', '2'))
+
+STREAM_QUANTILES = (0.05, 0.5, 0.95)
+
+# Quantile estimates move by this share of a standard deviation per value
+STREAM_QUANTILE_STEP = float(os.environ.get('STREAM_STATS_QUANTILE_STEP', '0.1'))
+
+# Field -> smallest standard deviation used for scoring, in the field unit (% or MB/s), so that
+# a value that never moved does not make the first small change look extreme
+STREAM_FIELDS: Dict[str, float] = {
+    'cpu': 1.0,
+    'mem': 1.0,
+    'swap': 1.0,
+    'disk': 0.5,
+    'net_rx_rate': 0.1,
+    'net_tx_rate': 0.1,
+    'disk_read_rate': 0.1,
+    'disk_write_rate': 0.1,
+}
+
+MAX_ANOMALY_SCORE = 99.99
+
+ResourceKey = Tuple[str, str]
+
+
+class StreamingStats:
+    """
+    Exponentially weighted statistics of one field
+
+    Attributes:
+        n: Number of values seen
+        mean: Exponentially weighted mean
+        var: Exponentially weighted variance
+        quantiles: Estimates of STREAM_QUANTILES, in order
+    """
+
+    __slots__ = ('n', 'mean', 'var', 'quantiles')
+
+    def __init__(self, n: int = 0, mean: float = 0.0, var: float = 0.0, quantiles: Optional[List[float]] = None):
+        self.n = n
+        self.mean = mean
+        self.var = var
+        self.quantiles = array('d', quantiles if quantiles is not None else [0.0] * len(STREAM_QUANTILES))
+
+    def score(self, value: float, min_std: float) -> Optional[float]:
+        """Get how many standard deviations a value is from the mean (None while warming up)."""
+        if self.n < STREAM_WARMUP_SAMPLES:
+            return None
+        std = max(math.sqrt(self.var), min_std)
+        return min(abs(value - self.mean) / std, MAX_ANOMALY_SCORE)
+
+    def update(self, value: float, alpha: float = STREAM_ALPHA) -> None:
+        """Fold a value into the statistics."""
+        quantiles = self.quantiles
+        if not self.n:
+            self.n = 1
+            self.mean = value
+            for i in range(len(quantiles)):
+                quantiles[i] = value
+            return
+
+        self.n += 1
+        delta = value - self.mean
+        self.mean += alpha * delta
+        self.var = (1 - alpha) * (self.var + alpha * delta * delta)
+
+        # Stochastic quantile tracking, with steps scaled to the spread of the field
+        step = STREAM_QUANTILE_STEP * math.sqrt(self.var)
+        for i, q in enumerate(STREAM_QUANTILES):
+            if value > quantiles[i]:
+                quantiles[i] += step * q
+            elif value < quantiles[i]:
+                quantiles[i] -= step * (1 - q)
+
+    def as_list(self) -> List[float]:
+        """Get [n, mean, var, *quantiles] as stored on the resource document."""
+        return [self.n, round(self.mean, 4), round(self.var, 4)] + [round(q, 4) for q in self.quantiles]
+
+    @classmethod
+    def from_list(cls, stored: Any) -> Optional['StreamingStats']:
+        """Rebuild statistics stored by as_list, or None if they are malformed."""
+        if not isinstance(stored, list) or len(stored) != 3 + len(STREAM_QUANTILES):
+            return None
+        try:
+            values = [float(value) for value in stored]
+        except (TypeError, ValueError):
+            return None
+        return cls(int(values[0]), values[1], max(0.0, values[2]), values[3:])
+
+
+class ResourceStats:
+    """
+    Streaming statistics of every field of one resource
+
+    Attributes:
+        fields: Field -> statistics
+        ts: Time of the last update (unix seconds)
+    """
+
+    __slots__ = ('fields', 'ts')
+
+    def __init__(self, fields: Optional[Dict[str, StreamingStats]] = None, ts: Optional[int] = None):
+        self.fields = fields if fields is not None else {}
+        self.ts = ts
+
+    def observe(self, values: Dict[str, Optional[float]], ts: int) -> Dict[str, float]:
+        """
+        Score the values against the statistics, then fold them in
+
+        Args:
+            values: Value (or None) per field of STREAM_FIELDS
+            ts: Sample time (unix seconds)
+
+        Returns:
+            Field -> anomaly score, for the fields past their warm-up
+        """
+        scores: Dict[str, float] = {}
+        for field, min_std in STREAM_FIELDS.items():
+            value = values.get(field)
+            if value is None:
+                continue
+            stats = self.fields.get(field)
+            if stats is None:
+                stats = self.fields[field] = StreamingStats()
+            score = stats.score(value, min_std)
+            if score is not None:
+                scores[field] = round(score, 2)
+            stats.update(value)
+        self.ts = ts
+        return scores
+
+    def as_dict(self) -> Dict[str, Any]:
+        """Get the `stream_stats` blob."""
+        blob: Dict[str, Any] = {field: stats.as_list() for field, stats in self.fields.items()}
+        blob['ts'] = self.ts
+        return blob
+
+    @classmethod
+    def from_dict(cls, blob: Any) -> 'ResourceStats':
+        """Rebuild the statistics of a `stream_stats` blob, skipping malformed fields."""
+        if not isinstance(blob, dict):
+            return cls()
+        fields = {}
+        for field in STREAM_FIELDS:
+            stats = StreamingStats.from_list(blob.get(field))
+            if stats is not None:
+                fields[field] = stats
+        ts = blob.get('ts')
+        return cls(fields, ts if isinstance(ts, int) else None)
+
+
+def stream_values(batch: MetricsBatch, sample: Dict[str, Optional[float]]) -> Dict[str, Optional[float]]:
+    """
+    Get the values of STREAM_FIELDS of a batch
+
+    Args:
+        batch: The indexed metrics batch, including the rates derived by models.rates
+        sample: Its history sample (see history.history.extract_sample)
+
+    Returns:
+        Value (or None) per field of STREAM_FIELDS
+    """
+    disk_io = extract_disk_io_rates(batch)
+    return {
+        'cpu': sample.get('cpu'),
+        'mem': sample.get('mem'),
+        'swap': sample.get('swap'),
+        'disk': sample.get('disk'),
+        'net_rx_rate': sample.get('net_rx_rate'),
+        'net_tx_rate': sample.get('net_tx_rate'),
+        'disk_read_rate': disk_io[0] if disk_io else None,
+        'disk_write_rate': disk_io[1] if disk_io else None,
+    }
+
+
+def anomaly_metric(scores: Dict[str, float], ts: int) -> Dict[str, Any]:
+    """Get the Telegraf-shaped metric the scores are stored as."""
+    return {'name': ANOMALY_MEASUREMENT, 'tags': {}, 'fields': scores, 'timestamp': ts}
+
+
+class StreamTracker:
+    """
+    Per-instance cache of the streaming statistics of each resource
+
+    Args:
+        max_size: Maximum number of resources kept
+        ttl: Seconds after which a resource is read back from Firestore
+        workers: Threads reading the statistics of resources the instance has not seen
+    """
+
+    def __init__(self, max_size: int = STREAM_CACHE_MAX_SIZE, ttl: float = STREAM_CACHE_TTL_SECONDS, workers: int = STREAM_LOAD_WORKERS):
+        self._stats = TTLCache(max_size=max_size, ttl=ttl)
+        self._lock = threading.Lock()
+        self._loading: Set[ResourceKey] = set()
+        self._workers = workers
+        self._executor: Optional[ThreadPoolExecutor] = None
+
+    def _read(self, db, keys: List[ResourceKey]) -> None:
+        """Read the statistics of resources in one multi-get and cache them (runs on the executor)."""
+        refs = [
+            db.collection('users').document(user_id).collection('resources').document(resource_id)
+            for user_id, resource_id in keys
+        ]
+        try:
+            snapshots = list(db.get_all(refs, field_paths=[STREAM_STATS_FIELD]))
+            record_read(len(keys))
+            with self._lock:
+                for snapshot in snapshots:
+                    key = (snapshot.reference.parent.parent.id, snapshot.id)
+                    if not self._stats.get(key)[0]:
+                        data = (snapshot.to_dict() or {}) if snapshot.exists else {}
+                        self._stats.set(key, ResourceStats.from_dict(data.get(STREAM_STATS_FIELD)))
+        except Exception as e:
+            # The next batch of these resources starts another read
+            logger.warn(f"Failed to read streaming statistics of {len(keys)} resources: {str(e)}")
+        finally:
+            with self._lock:
+                self._loading.difference_update(keys)
+
+    def preload(self, db, keys: List[ResourceKey]) -> None:
+        """
+        Start reading, in the background, the statistics of every resource this instance has not
+        seen and is not reading already
+
+        Args:
+            db: Firestore client
+            keys: (user_id, resource_id) of the resources about to be observed
+        """
+        with self._lock:
+            missing = [key for key in set(keys) if key not in self._loading and not self._stats.get(key)[0]]
+            if not missing:
+                return
+            self._loading.update(missing)
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self._workers, thread_name_prefix='stream-stats')
+            executor = self._executor
+        # Reads stay counted against the request that needed them
+        executor.submit(contextvars.copy_context().run, self._read, db, missing)
+
+    def observe(self, db, key: ResourceKey, values: Dict[str, Optional[float]], ts: int) -> Tuple[Dict[str, float], Optional[Dict[str, Any]]]:
+        """
+        Score a batch and update the statistics of its resource
+
+        Args:
+            db: Firestore client, read in the background for resources the instance has not seen
+            key: (user_id, resource_id)
+            values: Value (or None) per field of STREAM_FIELDS
+            ts: Sample time (unix seconds)
+
+        Returns:
+            The anomaly scores, and the `stream_stats` blob to store (None while the statistics
+            are being read, so that the stored ones are not overwritten)
+        """
+        found, stats = self._stats.get(key)
+        if not found:
+            self.preload(db, [key])
+            return {}, None
+
+        with self._lock:
+            if stats.ts is not None and ts < stats.ts:
+                # Out of order batch, the statistics have already moved past it
+                return {}, None
+            scores = stats.observe(values, ts)
+            return scores, stats.as_dict()
+
+
+# Shared by every request served by this instance
+stream_tracker = StreamTracker()
@@ -0,0 +1 @@
+# Ingestion package for Tinyfal Firebase Functions
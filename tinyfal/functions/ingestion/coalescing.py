@@ -0,0 +1,394 @@
+"""
+Per-instance write coalescing of ingest batches.
+
+Every accepted batch is merged into an in-memory entry keyed by resource: the latest stored
+payload wins, every history sample is kept, and running aggregates (min, max, mean) of the sample
+fields are tracked over the window. A resource is written to Firestore at most once per
+COALESCE_INTERVAL_SECONDS. The first batch of a window is flushed by the request that brought
+it; batches arriving within the interval are flushed by the next due request of the resource or
+at the end of any later request once their interval elapsed (due), since Cloud Functions only
+allocates CPU while a request is being served. The background flusher covers instances with
+always-allocated CPU, and the buffer is drained when the instance shuts down.
+
+The batch ingest endpoint writes the windows due across its envelopes together, in as few
+batched commits as possible (flush_pending_many).
+
+Writes use update() semantics, so a deleted resource is never recreated and no read is needed
+before writing. They only carry the payload keys that materially changed (ingestion/delta.py).
+Every write also moves `offline_at`, the time after which the offline sweep considers the
+resource offline (see alerts/offline.py). When alerts are evaluated from the resource write
+trigger, every write also carries `alert_samples`: the alert values of each batch of the window,
+which on_resource_written evaluates in order (see alerts/dispatch.py).
+"""
+import atexit
+import os
+import signal
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from firebase_admin import firestore
+from firebase_functions import logger
+from google.cloud.firestore_v1.field_path import FieldPath
+
+from history.history import SAMPLE_FIELDS, append_samples, bucket_start
+from ingestion.delta import Fingerprint, delta_tracker
+
+
+COALESCE_INTERVAL_SECONDS = float(os.environ.get('INGEST_COALESCE_INTERVAL_SECONDS', '5'))
+
+# Silence after which a resource is offline, unless the resource sets `offline_after` (seconds)
+OFFLINE_AFTER_SECONDS = float(os.environ.get('OFFLINE_AFTER_SECONDS', '300'))
+MIN_OFFLINE_AFTER_SECONDS = 60
+
+# Document writes Firestore accepts in one batched commit
+MAX_BATCH_WRITES = 500
+
+ALERT_SAMPLES_FIELD = 'alert_samples'
+
+# Newest alert samples kept per window, bounds the write after a run of failed flushes
+MAX_ALERT_SAMPLES = int(os.environ.get('INGEST_MAX_ALERT_SAMPLES', '60'))
+
+Sample = Dict[str, Optional[float]]
+ResourceKey = Tuple[str, str]
+
+
+class RunningStats:
+    """
+    Running min, max and mean of one sample field
+    """
+
+    __slots__ = ('count', 'min', 'max', 'total')
+
+    def __init__(self):
+        self.count = 0
+        self.min = None
+        self.max = None
+        self.total = 0.0
+
+    def add(self, value: float) -> None:
+        self.count += 1
+        self.total += value
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+
+    def merge(self, other: 'RunningStats') -> None:
+        if not other.count:
+            return
+        self.count += other.count
+        self.total += other.total
+        self.min = other.min if self.min is None else min(self.min, other.min)
+        self.max = other.max if self.max is None else max(self.max, other.max)
+
+    def as_list(self) -> List[float]:
+        """Get [min, max, mean]."""
+        return [self.min, self.max, self.total / self.count]
+
+
+class PendingWrite:
+    """
+    Coalesced state of one resource waiting to be written
+
+    Attributes:
+        user_id: Owner of the resource
+        resource_id: The resource
+        payload: Latest projected payload
+        samples: Every history sample of the window as (timestamp, values) pairs
+        stats: Running aggregates per sample field
+        offline_after: Offline deadline of the resource in seconds, if it sets one
+        alerts: Alert values of every batch of the window as (timestamp, values) pairs
+    """
+
+    __slots__ = ('user_id', 'resource_id', 'payload', 'samples', 'stats', 'offline_after', 'alerts')
+
+    def __init__(self, user_id: str, resource_id: str):
+        self.user_id = user_id
+        self.resource_id = resource_id
+        self.payload: Dict[str, Any] = {}
+        self.samples: List[Tuple[int, Sample]] = []
+        self.stats: Dict[str, RunningStats] = {field: RunningStats() for field in SAMPLE_FIELDS}
+        self.offline_after: Optional[float] = None
+        self.alerts: List[Tuple[int, Dict[str, float]]] = []
+
+    def merge(self, payload: Dict[str, Any], ts: int, sample: Sample, offline_after: Optional[float] = None,
+              alert_values: Optional[Dict[str, float]] = None) -> None:
+        """Merge one accepted batch into the window."""
+        self.payload = payload
+        self.offline_after = offline_after
+        self.samples.append((ts, sample))
+        if alert_values is not None:
+            self.alerts.append((ts, alert_values))
+        for field in SAMPLE_FIELDS:
+            value = sample.get(field)
+            if value is not None:
+                self.stats[field].add(value)
+
+    def absorb(self, older: 'PendingWrite') -> None:
+        """Fold in an older window that failed to flush, keeping the newer payload."""
+        if not self.payload:
+            self.payload = older.payload
+            self.offline_after = older.offline_after
+        self.samples = older.samples + self.samples
+        self.alerts = older.alerts + self.alerts
+        for field in SAMPLE_FIELDS:
+            self.stats[field].merge(older.stats[field])
+
+    def window(self) -> Dict[str, Any]:
+        """Get the window aggregates as stored on the resource document."""
+        window: Dict[str, Any] = {'samples': len(self.samples)}
+        for field, stats in self.stats.items():
+            if stats.count:
+                window[field] = stats.as_list()
+        return window
+
+    def alert_samples(self) -> List[Dict[str, Any]]:
+        """Get the newest alert samples of the window as stored on the resource document, oldest first."""
+        return [{'at': ts, 'values': values} for ts, values in self.alerts[-MAX_ALERT_SAMPLES:]]
+
+
+class CoalescingBuffer:
+    """
+    Thread-safe per-resource coalescing buffer
+
+    Args:
+        interval: Minimum time in seconds between two writes of the same resource
+        clock: Monotonic time source, replaceable for tests
+    """
+
+    def __init__(self, interval: float = COALESCE_INTERVAL_SECONDS, clock: Callable[[], float] = time.monotonic):
+        self.interval = interval
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._pending: Dict[ResourceKey, PendingWrite] = {}
+        self._last_flush: Dict[ResourceKey, float] = {}
+        self._flusher: Optional[threading.Thread] = None
+        # Set once the buffer is drained for shutdown; later batches are written right away
+        self._closed = threading.Event()
+
+    def add(self, user_id: str, resource_id: str, payload: Dict[str, Any], ts: int, sample: Sample,
+            offline_after: Optional[float] = None, alert_values: Optional[Dict[str, float]] = None) -> Optional[PendingWrite]:
+        """
+        Merge a batch into the buffer
+
+        Args:
+            user_id: Owner of the resource
+            resource_id: The resource the batch belongs to
+            payload: Projected payload to store
+            ts: Unix timestamp of the sample in seconds
+            sample: History sample values keyed by SAMPLE_FIELDS
+            offline_after: The resource `offline_after` deadline in seconds, if any
+            alert_values: Alert values of the batch, written for the resource write trigger
+
+        Returns:
+            The window to write now if the resource is due, otherwise None (the batch is buffered)
+        """
+        key = (user_id, resource_id)
+        now = self._clock()
+        with self._lock:
+            pending = self._pending.get(key)
+            if pending is None:
+                pending = self._pending[key] = PendingWrite(user_id, resource_id)
+            pending.merge(payload, ts, sample, offline_after, alert_values)
+
+            last = self._last_flush.get(key)
+            if last is not None and now - last < self.interval and not self._closed.is_set():
+                return None
+
+            self._last_flush[key] = now
+            return self._pending.pop(key)
+
+    def due(self) -> List[PendingWrite]:
+        """Take every buffered window whose interval has elapsed."""
+        now = self._clock()
+        with self._lock:
+            ready = [key for key in self._pending if now - self._last_flush.get(key, now - self.interval) >= self.interval]
+            for key in ready:
+                self._last_flush[key] = now
+            # A resource whose interval elapsed is due anyway, its flush time is no longer needed
+            for key in [key for key, last in self._last_flush.items() if now - last >= self.interval and key not in self._pending]:
+                del self._last_flush[key]
+            return [self._pending.pop(key) for key in ready]
+
+    def drain(self) -> List[PendingWrite]:
+        """Take every buffered window regardless of its interval."""
+        with self._lock:
+            pending = list(self._pending.values())
+            self._pending.clear()
+            return pending
+
+    def requeue(self, pending: PendingWrite) -> None:
+        """Put back a window that failed to flush so its samples go out with the next write."""
+        key = (pending.user_id, pending.resource_id)
+        with self._lock:
+            current = self._pending.get(key)
+            if current is None:
+                self._pending[key] = pending
+            else:
+                current.absorb(pending)
+
+    def discard(self, user_id: str, resource_id: str) -> None:
+        """Forget a resource, e.g. once it is known to be deleted."""
+        key = (user_id, resource_id)
+        with self._lock:
+            self._pending.pop(key, None)
+            self._last_flush.pop(key, None)
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._pending)
+
+    def start_flusher(self, flush: Callable[[PendingWrite], None], period: Optional[float] = None) -> None:
+        """
+        Start a daemon thread writing due windows every `period` seconds (default: the interval).
+        Calling it again is a no-op.
+        """
+        if self._flusher is not None:
+            return
+
+        def run():
+            while True:
+                time.sleep(period or self.interval)
+                for pending in self.due():
+                    flush(pending)
+
+        self._flusher = threading.Thread(target=run, name='ingest-coalescing', daemon=True)
+        self._flusher.start()
+
+    def flush_on_shutdown(self, flush: Callable[[PendingWrite], None]) -> None:
+        """
+        Write every buffered window when the instance receives SIGTERM or exits.
+        The SIGTERM handler interrupts the main thread, possibly while it holds the buffer lock,
+        so it only flags the shutdown and leaves the flush to a (non-daemon) thread.
+        """
+
+        def flush_all():
+            self._closed.set()
+            for pending in self.drain():
+                flush(pending)
+
+        atexit.register(flush_all)
+
+        try:
+            previous = signal.getsignal(signal.SIGTERM)
+
+            def on_sigterm(signum, frame):
+                self._closed.set()
+                threading.Thread(target=flush_all, name='ingest-coalescing-shutdown').start()
+                if callable(previous):
+                    previous(signum, frame)
+                elif previous == signal.SIG_DFL:
+                    raise SystemExit(0)
+
+            signal.signal(signal.SIGTERM, on_sigterm)
+        except ValueError:
+            # Signal handlers can only be installed from the main thread; atexit still applies
+            logger.warn("Could not install the SIGTERM flush handler for the coalescing buffer")
+
+
+def _queue_pending(db, write_batch, pending: PendingWrite) -> Tuple[int, Fingerprint]:
+    """
+    Queue the writes of a coalesced window on a write batch
+
+    Returns:
+        The number of document writes, and the payload fingerprint to remember once committed
+    """
+    resource_ref = db.collection('users').document(pending.user_id).collection('resources').document(pending.resource_id)
+
+    # Only the payload keys that materially changed since the last write (see ingestion/delta.py)
+    changed, fingerprint = delta_tracker.diff((pending.user_id, pending.resource_id), pending.payload)
+
+    # Payload keys come from the agent, quote them so they are never read as nested paths
+    update = {FieldPath(key).to_api_repr(): value for key, value in changed.items()}
+    update['last_update'] = firestore.SERVER_TIMESTAMP
+    update['window'] = pending.window()
+    update['offline_at'] = datetime.now(timezone.utc) + timedelta(seconds=offline_deadline(pending.offline_after))
+    if pending.alerts:
+        update[ALERT_SAMPLES_FIELD] = pending.alert_samples()
+
+    write_batch.update(resource_ref, update)
+    return 1 + append_samples(db, write_batch, pending.user_id, pending.resource_id, pending.samples), fingerprint
+
+
+def flush_pending(db, pending: PendingWrite) -> int:
+    """
+    Write a coalesced window: the changed part of the latest payload, last_update and the window
+    aggregates on the resource document, plus every buffered history sample, in one batched commit
+
+    Args:
+        db: Firestore client
+        pending: The window to write
+
+    Returns:
+        Number of document writes
+
+    Raises:
+        google.api_core.exceptions.NotFound: If the resource no longer exists
+    """
+    write_batch = db.batch()
+    writes, fingerprint = _queue_pending(db, write_batch, pending)
+    write_batch.commit()
+    delta_tracker.remember((pending.user_id, pending.resource_id), fingerprint)
+    return writes
+
+
+def flush_pending_many(db, windows: List[PendingWrite]) -> List[Any]:
+    """
+    Write many coalesced windows in as few batched commits as possible (at most
+    MAX_BATCH_WRITES document writes each). Each window stays atomic: if a commit fails, for
+    instance because one of its resources was deleted, its windows are written one by one so
+    that the failure is attributed to the right window.
+
+    Args:
+        db: Firestore client
+        windows: The windows to write
+
+    Returns:
+        For each window in order, its number of document writes or the exception that stopped it
+    """
+    results: List[Any] = [None] * len(windows)
+
+    def commit(chunk: List[int]) -> None:
+        write_batch = db.batch()
+        queued = [_queue_pending(db, write_batch, windows[index]) for index in chunk]
+        try:
+            write_batch.commit()
+        except Exception as e:
+            if len(chunk) == 1:
+                results[chunk[0]] = e
+                return
+            for index in chunk:
+                try:
+                    results[index] = flush_pending(db, windows[index])
+                except Exception as window_error:
+                    results[index] = window_error
+            return
+        for index, (count, fingerprint) in zip(chunk, queued):
+            delta_tracker.remember((windows[index].user_id, windows[index].resource_id), fingerprint)
+            results[index] = count
+
+    chunk: List[int] = []
+    chunk_writes = 0
+    for index, pending in enumerate(windows):
+        # One resource update plus one write per history bucket the window touches
+        writes = 1 + len({bucket_start(ts) for ts, _ in pending.samples})
+        if chunk and chunk_writes + writes > MAX_BATCH_WRITES:
+            commit(chunk)
+            chunk, chunk_writes = [], 0
+        chunk.append(index)
+        chunk_writes += writes
+    if chunk:
+        commit(chunk)
+    return results
+
+
+def offline_deadline(offline_after: Any) -> float:
+    """Get the silence in seconds after which a resource is offline."""
+    try:
+        return max(MIN_OFFLINE_AFTER_SECONDS, float(offline_after)) if offline_after is not None else OFFLINE_AFTER_SECONDS
+    except (TypeError, ValueError):
+        return OFFLINE_AFTER_SECONDS
+
+
+# Shared by every request served by this instance
+write_buffer = CoalescingBuffer()
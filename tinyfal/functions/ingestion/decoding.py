@@ -0,0 +1,364 @@
+"""
+Streaming decoding of ingest request bodies.
+
+Telegraf can compress its HTTP output (`content_encoding = "gzip"`). Bodies are decompressed
+chunk by chunk and the `metrics` array is decoded one element at a time, so neither the full
+expanded text nor the measurements we do not keep are ever held in memory at once. Batch ingest
+bodies (decode_envelopes) go through the same decompression and are decoded one envelope at a time.
+"""
+import codecs
+import json
+import os
+import re
+import zlib
+from typing import Any, Collection, Dict, IO, Iterator, List, Optional
+
+try:
+    import zstandard
+except ImportError:  # zstd support is optional
+    zstandard = None
+
+
+# Upper bound on the decompressed body, guards against zip bombs
+MAX_BODY_BYTES = int(os.environ.get('INGEST_MAX_BODY_BYTES', str(8 * 1024 * 1024)))
+MAX_BATCH_BODY_BYTES = int(os.environ.get('INGEST_MAX_BATCH_BODY_BYTES', str(64 * 1024 * 1024)))
+
+# Upper bound on the envelopes of one batch ingest request
+MAX_BATCH_ENVELOPES = int(os.environ.get('INGEST_MAX_BATCH_ENVELOPES', '1000'))
+
+CHUNK_SIZE = 64 * 1024
+
+_WHITESPACE = re.compile(r'[ \t\n\r]*')
+
+
+class BodyDecodingError(ValueError):
+    """
+    Raised when a request body cannot be decoded. `status` is the HTTP status to answer with.
+    """
+
+    def __init__(self, message: str, status: int = 400):
+        super().__init__(message)
+        self.status = status
+
+
+def supported_encodings() -> List[str]:
+    """Get the Content-Encoding values accepted by this instance."""
+    encodings = ['identity', 'gzip', 'deflate']
+    if zstandard is not None:
+        encodings.append('zstd')
+    return encodings
+
+
+def _read_chunks(stream: IO[bytes], max_bytes: int) -> Iterator[bytes]:
+    """Read raw body chunks, refusing bodies larger than max_bytes."""
+    total = 0
+    while True:
+        chunk = stream.read(CHUNK_SIZE)
+        if not chunk:
+            return
+        total += len(chunk)
+        if total > max_bytes:
+            raise BodyDecodingError(f"Request body exceeds {max_bytes} bytes", status=413)
+        yield chunk
+
+
+def _inflate(chunks: Iterator[bytes], wbits: int) -> Iterator[bytes]:
+    """Decompress gzip/deflate chunks, never producing more than CHUNK_SIZE bytes at a time."""
+    decompressor = zlib.decompressobj(wbits)
+    for chunk in chunks:
+        data = chunk
+        while data:
+            yield decompressor.decompress(data, CHUNK_SIZE)
+            data = decompressor.unconsumed_tail
+            # Concatenated gzip members are valid, start a new decompressor for the next one
+            if decompressor.eof and decompressor.unused_data:
+                data = decompressor.unused_data
+                decompressor = zlib.decompressobj(wbits)
+    yield decompressor.flush()
+
+
+class _ChunkReader:
+    """
+    Minimal file-like reader over an iterator of byte chunks, so that stream based decompressors
+    read through _read_chunks and its raw size cap.
+    """
+
+    def __init__(self, chunks: Iterator[bytes]):
+        self._chunks = chunks
+        self._buffer = b''
+
+    def read(self, size: int = -1) -> bytes:
+        if not self._buffer:
+            self._buffer = next(self._chunks, b'')
+        if size is None or size < 0 or size >= len(self._buffer):
+            data, self._buffer = self._buffer, b''
+        else:
+            data, self._buffer = self._buffer[:size], self._buffer[size:]
+        return data
+
+
+def _unzstd(chunks: Iterator[bytes]) -> Iterator[bytes]:
+    """Decompress zstd chunks in CHUNK_SIZE pieces. Concatenated frames are all decoded."""
+    reader = zstandard.ZstdDecompressor().stream_reader(_ChunkReader(chunks), read_size=CHUNK_SIZE, read_across_frames=True)
+    with reader:
+        while True:
+            chunk = reader.read(CHUNK_SIZE)
+            if not chunk:
+                return
+            yield chunk
+
+
+def _decompressed(stream: IO[bytes], content_encoding: Optional[str], max_bytes: int) -> Iterator[bytes]:
+    """Yield the decompressed body, enforcing max_bytes on the expanded size."""
+    encoding = (content_encoding or 'identity').strip().lower()
+
+    if encoding in ('identity', ''):
+        source = _read_chunks(stream, max_bytes)
+    elif encoding in ('gzip', 'x-gzip'):
+        source = _inflate(_read_chunks(stream, max_bytes), 16 + zlib.MAX_WBITS)
+    elif encoding == 'deflate':
+        source = _inflate(_read_chunks(stream, max_bytes), zlib.MAX_WBITS)
+    elif encoding == 'zstd' and zstandard is not None:
+        source = _unzstd(_read_chunks(stream, max_bytes))
+    else:
+        raise BodyDecodingError(
+            f"Unsupported Content-Encoding '{encoding}'. Use one of: {', '.join(supported_encodings())}",
+            status=415,
+        )
+
+    total = 0
+    try:
+        for chunk in source:
+            total += len(chunk)
+            if total > max_bytes:
+                raise BodyDecodingError(f"Decompressed body exceeds {max_bytes} bytes", status=413)
+            if chunk:
+                yield chunk
+    except zlib.error as e:
+        raise BodyDecodingError(f"Invalid {encoding} body: {str(e)}")
+    except Exception as e:
+        if zstandard is not None and isinstance(e, zstandard.ZstdError):
+            raise BodyDecodingError(f"Invalid zstd body: {str(e)}")
+        raise
+
+
+class _JsonStream:
+    """
+    Incremental JSON reader over text chunks, built on JSONDecoder.raw_decode.
+    Only the current element and the unread tail of the last chunk are buffered.
+    """
+
+    def __init__(self, chunks: Iterator[str]):
+        self._chunks = chunks
+        self._buffer = ''
+        self._pos = 0
+        self._decoder = json.JSONDecoder()
+
+    def _fill(self) -> bool:
+        chunk = next(self._chunks, None)
+        if chunk is None:
+            return False
+        self._buffer = self._buffer[self._pos:] + chunk
+        self._pos = 0
+        return True
+
+    def peek(self) -> str:
+        """Get the next non-whitespace character without consuming it ('' at the end)."""
+        while True:
+            self._pos = _WHITESPACE.match(self._buffer, self._pos).end()
+            if self._pos < len(self._buffer):
+                return self._buffer[self._pos]
+            if not self._fill():
+                return ''
+
+    def expect(self, char: str) -> None:
+        """Consume the next non-whitespace character, which must be `char`."""
+        found = self.peek()
+        if found != char:
+            raise BodyDecodingError(f"Invalid JSON: expected '{char}' but found '{found or 'end of body'}'")
+        self._pos += 1
+
+    def value(self) -> Any:
+        """Decode the next complete JSON value."""
+        self.peek()
+        while True:
+            try:
+                value, end = self._decoder.raw_decode(self._buffer, self._pos)
+            except json.JSONDecodeError as e:
+                if self._fill():
+                    continue
+                raise BodyDecodingError(f"Invalid JSON: {str(e)}")
+            # A number at the end of the buffer may continue in the next chunk
+            if end == len(self._buffer) and self._fill():
+                continue
+            self._pos = end
+            return value
+
+    def array(self) -> Iterator[Any]:
+        """Decode a JSON array lazily, one element at a time."""
+        self.expect('[')
+        if self.peek() == ']':
+            self._pos += 1
+            return
+        while True:
+            yield self.value()
+            if self.peek() == ',':
+                self._pos += 1
+                continue
+            self.expect(']')
+            return
+
+
+def _reader(stream: IO[bytes], content_encoding: Optional[str], max_bytes: int) -> _JsonStream:
+    """Get a JSON reader over the decompressed, UTF-8 decoded body."""
+    decoder = codecs.getincrementaldecoder('utf-8')(errors='strict')
+
+    def text_chunks() -> Iterator[str]:
+        try:
+            for chunk in _decompressed(stream, content_encoding, max_bytes):
+                yield decoder.decode(chunk)
+            yield decoder.decode(b'', final=True)
+        except UnicodeDecodeError as e:
+            raise BodyDecodingError(f"Request body is not valid UTF-8: {str(e)}")
+
+    return _JsonStream(text_chunks())
+
+
+METRICS_ERROR = "'metrics' must be an array of metric objects"
+
+
+def _keep(metric: Any, measurements: Optional[Collection[str]]) -> bool:
+    if not isinstance(metric, dict):
+        raise BodyDecodingError(METRICS_ERROR)
+    return measurements is None or metric.get('name') in measurements
+
+
+def valid_metrics(metrics: Any) -> bool:
+    """Check that a decoded `metrics` value is an array of metric objects."""
+    return isinstance(metrics, list) and all(isinstance(metric, dict) for metric in metrics)
+
+
+def decode_json_body(
+    stream: IO[bytes],
+    content_encoding: Optional[str] = None,
+    measurements: Optional[Collection[str]] = None,
+    max_bytes: int = MAX_BODY_BYTES
+) -> Dict[str, Any]:
+    """
+    Decode a (possibly compressed) Telegraf JSON body from a byte stream
+
+    Args:
+        stream: Readable byte stream of the request body
+        content_encoding: Value of the Content-Encoding header (gzip, deflate, zstd or identity)
+        measurements: Measurement names to keep from the metrics array (None keeps all)
+        max_bytes: Maximum decompressed body size in bytes
+
+    Returns:
+        The decoded body. A bare array of metrics is returned as {'metrics': [...]}
+
+    Raises:
+        BodyDecodingError: If the body is too large, uses an unsupported encoding, is not valid JSON
+            or its metrics are not an array of objects
+    """
+    reader = _reader(stream, content_encoding, max_bytes)
+    first = reader.peek()
+
+    if first == '[':
+        result: Dict[str, Any] = {'metrics': [m for m in reader.array() if _keep(m, measurements)]}
+    elif first == '{':
+        result = {}
+        reader.expect('{')
+        if reader.peek() == '}':
+            reader.expect('}')
+        else:
+            while True:
+                key = reader.value()
+                if not isinstance(key, str):
+                    raise BodyDecodingError("Invalid JSON: object keys must be strings")
+                reader.expect(':')
+                if key == 'metrics':
+                    if reader.peek() != '[':
+                        raise BodyDecodingError(METRICS_ERROR)
+                    result[key] = [m for m in reader.array() if _keep(m, measurements)]
+                else:
+                    result[key] = reader.value()
+                if reader.peek() == ',':
+                    reader.expect(',')
+                    continue
+                reader.expect('}')
+                break
+    elif first == '':
+        raise BodyDecodingError("Request body must be valid JSON")
+    else:
+        raise BodyDecodingError("Request body must be a JSON object or array")
+
+    if reader.peek() != '':
+        raise BodyDecodingError("Invalid JSON: unexpected data after the body")
+
+    return result
+
+
+def keep_measurements(metrics: Any, measurements: Optional[Collection[str]]) -> List[Dict[str, Any]]:
+    """
+    Filter a metrics array like decode_json_body does
+
+    Args:
+        metrics: The decoded metrics array, checked with valid_metrics
+        measurements: Measurement names to keep (None keeps all)
+
+    Returns:
+        The metrics with a kept measurement name
+    """
+    return [metric for metric in metrics if _keep(metric, measurements)]
+
+
+def decode_envelopes(
+    stream: IO[bytes],
+    content_encoding: Optional[str] = None,
+    max_bytes: int = MAX_BATCH_BODY_BYTES,
+    max_envelopes: int = MAX_BATCH_ENVELOPES
+) -> List[Any]:
+    """
+    Decode a (possibly compressed) batch ingest body: a JSON array of envelopes, or NDJSON with
+    one envelope per line. Each envelope is expected to be {"token": ..., "metrics": [...]};
+    envelopes are returned as decoded so that a malformed one only fails itself (see
+    valid_metrics).
+
+    Args:
+        stream: Readable byte stream of the request body
+        content_encoding: Value of the Content-Encoding header (gzip, deflate, zstd or identity)
+        max_bytes: Maximum decompressed body size in bytes
+        max_envelopes: Maximum number of envelopes
+
+    Returns:
+        The decoded envelopes in body order
+
+    Raises:
+        BodyDecodingError: If the body is too large, has too many envelopes, uses an unsupported
+            encoding or is not valid JSON
+    """
+    reader = _reader(stream, content_encoding, max_bytes)
+    first = reader.peek()
+
+    if first == '[':
+        values = reader.array()
+    elif first == '{':
+        def ndjson() -> Iterator[Any]:
+            while reader.peek() != '':
+                yield reader.value()
+        values = ndjson()
+    elif first == '':
+        raise BodyDecodingError("Request body must be valid JSON")
+    else:
+        raise BodyDecodingError("Request body must be a JSON array or NDJSON envelopes")
+
+    envelopes = []
+    for envelope in values:
+        if len(envelopes) == max_envelopes:
+            raise BodyDecodingError(f"Request body exceeds {max_envelopes} envelopes", status=413)
+        envelopes.append(envelope)
+
+    if reader.peek() != '':
+        raise BodyDecodingError("Invalid JSON: unexpected data after the body")
+
+    return envelopes
@@ -0,0 +1,219 @@
+"""
+Delta writes of the ingest payload.
+
+Consecutive Telegraf batches mostly repeat the previous one: gauges move by a fraction of a
+percent and counters by a tiny share of their total. For each resource, the instance remembers a
+fingerprint of the payload it last wrote. It holds the layout of the `metrics` array
+(measurements, tags and field names), its numeric values in one array, and a hash of every
+other top-level key. A coalesced write then only carries the payload keys that materially
+changed:
+
+- `metrics` is rewritten when its layout or a non-numeric field changed, or when a numeric field
+  moved past its tolerance (TOLERANCES) from the value last written. Cumulative counters have no
+  tolerance: the app shows the stored totals, so any traffic rewrites them;
+- other keys are rewritten when their hash changed, except LAZY_FIELDS, which are only
+  refreshed by full writes.
+
+`last_update`, `offline_at` and the window aggregates are written every time, so the resource
+stays fresh for the app and for offline detection. Every DELTA_FULL_WRITE_SECONDS the whole
+payload is written again, which bounds how long a value within tolerance can stay stale and
+corrects anything another instance wrote meanwhile.
+"""
+import json
+import os
+import threading
+import time
+from array import array
+from typing import Any, Callable, Dict, List, Tuple
+
+from cache.cache import TTLCache
+
+
+DELTA_WRITES_ENABLED = os.environ.get('INGEST_DELTA_WRITES', '1') != '0'
+DELTA_FULL_WRITE_SECONDS = float(os.environ.get('INGEST_DELTA_FULL_WRITE_SECONDS', '300'))
+DELTA_CACHE_MAX_SIZE = int(os.environ.get('INGEST_DELTA_CACHE_MAX_SIZE', '20000'))
+
+# Payload keys that change on every batch but are only needed by cold instances
+LAZY_FIELDS = frozenset({'stream_stats'})
+
+# 'measurement.field' or 'measurement' -> (absolute, relative) tolerance. A value is unchanged
+# while |new - written| <= max(absolute, relative * |written|). Fields not listed must match
+# exactly, which includes the cumulative counters (net, diskio, docker_container_net,
+# docker_container_blkio): a relative tolerance on a total grows with the total rather than with
+# the traffic, and a frozen total reads as no traffic followed by a spike.
+TOLERANCES: Dict[str, Tuple[float, float]] = {
+    'cpu': (1.0, 0.0),
+    'mem.available_percent': (0.5, 0.0),
+    'mem.used': (0.0, 0.005),
+    'mem.buffered': (0.0, 0.01),
+    'mem.cached': (0.0, 0.01),
+    'swap.used': (0.0, 0.005),
+    'swap.free': (0.0, 0.005),
+    'system.load1': (0.05, 0.0),
+    'system.load5': (0.05, 0.0),
+    'system.load15': (0.05, 0.0),
+    'system.uptime': (0.0, 0.01),
+    'disk.used': (0.0, 0.001),
+    'disk.free': (0.0, 0.001),
+    'disk.inodes_used': (0.0, 0.001),
+    'disk.inodes_free': (0.0, 0.001),
+    'disk.inodes_used_percent': (0.1, 0.0),
+    'netstat': (2.0, 0.05),
+    'processes': (2.0, 0.02),
+    'processes.zombies': (0.0, 0.0),
+    'docker_container_status.uptime_ns': (0.0, 0.01),
+    'docker_container_mem': (0.0, 0.01),
+    'docker_container_cpu': (1.0, 0.0),
+    'net_rate': (1000.0, 0.1),
+    'diskio_rate': (4096.0, 0.1),
+    'anomaly': (0.5, 0.0),
+}
+TOLERANCES.update({
+    key: (float(absolute), float(relative))
+    for key, (absolute, relative) in json.loads(os.environ.get('INGEST_DELTA_TOLERANCES', '{}')).items()
+})
+
+EXACT = (0.0, 0.0)
+
+# (measurement, sorted tag items, field names) of every metric
+Layout = Tuple[Tuple[str, Tuple[Tuple[str, Any], ...], Tuple[str, ...]], ...]
+
+
+def tolerance(measurement: str, field: str) -> Tuple[float, float]:
+    """Get the (absolute, relative) tolerance of a field."""
+    return TOLERANCES.get(f'{measurement}.{field}') or TOLERANCES.get(measurement) or EXACT
+
+
+class Fingerprint:
+    """
+    Compact summary of a written payload
+
+    Attributes:
+        layout: Structure of the metrics array
+        numbers: Numeric field values, in layout order
+        others: Non-numeric field values, in layout order
+        hashes: Hash of every other top-level payload key
+        written_at: When the whole payload was last written (monotonic seconds)
+    """
+
+    __slots__ = ('layout', 'numbers', 'others', 'hashes', 'written_at')
+
+    def __init__(self, layout: Layout, numbers: array, others: Tuple[Any, ...], hashes: Dict[str, int], written_at: float):
+        self.layout = layout
+        self.numbers = numbers
+        self.others = others
+        self.hashes = hashes
+        self.written_at = written_at
+
+
+def _is_number(value: Any) -> bool:
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+def _flatten(metrics: Any) -> Tuple[Layout, array, Tuple[Any, ...]]:
+    """Split a metrics array into its layout, numeric values and other values."""
+    layout = []
+    numbers = array('d')
+    others = []
+    for metric in metrics if isinstance(metrics, list) else []:
+        if not isinstance(metric, dict):
+            others.append(metric)
+            continue
+        fields = metric.get('fields') if isinstance(metric.get('fields'), dict) else {}
+        tags = metric.get('tags') if isinstance(metric.get('tags'), dict) else {}
+        names = tuple(sorted(fields))
+        layout.append((metric.get('name'), tuple(sorted(tags.items())), names))
+        for name in names:
+            value = fields[name]
+            if _is_number(value):
+                numbers.append(value)
+            else:
+                others.append(value)
+    return tuple(layout), numbers, tuple(others)
+
+
+def _hash(value: Any) -> int:
+    return hash(json.dumps(value, sort_keys=True, default=str))
+
+
+class DeltaTracker:
+    """
+    Per-instance fingerprints of the payload last written for each resource
+
+    Args:
+        full_write: Seconds after which the whole payload is written again
+        max_size: Maximum number of resources kept
+        clock: Monotonic time source, replaceable for tests
+    """
+
+    def __init__(self, full_write: float = DELTA_FULL_WRITE_SECONDS, max_size: int = DELTA_CACHE_MAX_SIZE,
+                 clock: Callable[[], float] = time.monotonic):
+        self._fingerprints = TTLCache(max_size=max_size, ttl=full_write, clock=clock)
+        self._clock = clock
+        self._lock = threading.Lock()
+        # Layout -> tolerances of its numeric fields, shared by every resource with that layout
+        self._tolerances: Dict[Layout, List[Tuple[float, float]]] = {}
+
+    def _layout_tolerances(self, layout: Layout, metrics: List[Dict[str, Any]]) -> List[Tuple[float, float]]:
+        tolerances = self._tolerances.get(layout)
+        if tolerances is None:
+            tolerances = []
+            for (name, _, names), metric in zip(layout, (m for m in metrics if isinstance(m, dict))):
+                tolerances.extend(tolerance(name, field) for field in names if _is_number(metric['fields'][field]))
+            with self._lock:
+                if len(self._tolerances) >= DELTA_CACHE_MAX_SIZE:
+                    self._tolerances.clear()
+                self._tolerances[layout] = tolerances
+        return tolerances
+
+    def _metrics_changed(self, previous: Fingerprint, layout: Layout, numbers: array, others: Tuple[Any, ...],
+                         metrics: List[Dict[str, Any]]) -> bool:
+        if layout != previous.layout or others != previous.others:
+            return True
+        for written, value, (absolute, relative) in zip(previous.numbers, numbers, self._layout_tolerances(layout, metrics)):
+            if abs(value - written) > max(absolute, relative * abs(written)):
+                return True
+        return False
+
+    def diff(self, key: Tuple[str, str], payload: Dict[str, Any]) -> Tuple[Dict[str, Any], Fingerprint]:
+        """
+        Get the part of a payload that has to be written
+
+        Args:
+            key: (user_id, resource_id)
+            payload: The payload about to be written
+
+        Returns:
+            The payload keys to write, and the fingerprint to remember once the write succeeded
+        """
+        layout, numbers, others = _flatten(payload.get('metrics'))
+        hashes = {name: _hash(value) for name, value in payload.items() if name != 'metrics'}
+        now = self._clock()
+
+        found, previous = self._fingerprints.get(key)
+        if not DELTA_WRITES_ENABLED or not found or now - previous.written_at >= self._fingerprints.ttl:
+            return dict(payload), Fingerprint(layout, numbers, others, hashes, now)
+
+        changed: Dict[str, Any] = {}
+        if 'metrics' in payload and self._metrics_changed(previous, layout, numbers, others, payload['metrics']):
+            changed['metrics'] = payload['metrics']
+        else:
+            # Keep comparing against what is actually stored
+            layout, numbers, others = previous.layout, previous.numbers, previous.others
+        for name, value in payload.items():
+            if name == 'metrics' or name in LAZY_FIELDS:
+                continue
+            if hashes[name] != previous.hashes.get(name):
+                changed[name] = value
+        for name in LAZY_FIELDS:
+            if name in previous.hashes:
+                hashes[name] = previous.hashes[name]
+        return changed, Fingerprint(layout, numbers, others, hashes, previous.written_at)
+
+    def remember(self, key: Tuple[str, str], fingerprint: Fingerprint) -> None:
+        """Record the fingerprint of a payload that was written."""
+        self._fingerprints.set(key, fingerprint)
+
+
+# Shared by every request served by this instance
+delta_tracker = DeltaTracker()
@@ -0,0 +1,219 @@
+"""
+Per-token admission control of ingest requests.
+
+Every ingest token has a token bucket: it holds up to `burst` requests and refills at `rate`
+requests per second. A request that finds the bucket empty is answered 429 with Retry-After
+before the token is resolved, so a misconfigured agent or a leaked token costs no Firestore
+I/O and cannot hold the instances other agents need.
+
+Limits come from the plan of the owner (users/{user_id}/billing/plan, which clients cannot
+write, copied into the token index entry; see tokens/tokens.py). A bucket starts with the
+DEFAULT_PLAN limits until the token is resolved once on the instance. Plans and their limits are overridable through the functions environment:
+
+    INGEST_RATE_LIMITS='{"free": [0.2, 12], "pro": [1, 60]}'
+
+Buckets live in memory, so each instance enforces the limits on its own share of the traffic.
+Setting RATE_LIMIT_REDIS_URL also checks a bucket shared by every instance (requires the redis
+package) once the local bucket admitted the request; if the shared store is unreachable,
+requests are admitted on the local bucket alone.
+"""
+import json
+import math
+import os
+import threading
+import time
+from typing import Callable, Dict, Optional, Tuple
+
+from firebase_functions import logger
+
+from cache.cache import TTLCache
+
+
+DEFAULT_PLAN = os.environ.get('INGEST_DEFAULT_PLAN', 'free')
+
+# Plan -> (requests per second, burst)
+PLAN_LIMITS: Dict[str, Tuple[float, float]] = {
+    'free': (0.2, 12),
+    'pro': (1.0, 60),
+}
+PLAN_LIMITS.update({
+    plan: (float(rate), float(burst))
+    for plan, (rate, burst) in json.loads(os.environ.get('INGEST_RATE_LIMITS', '{}')).items()
+})
+
+RATE_LIMIT_MAX_TOKENS = int(os.environ.get('RATE_LIMIT_MAX_TOKENS', '20000'))
+RATE_LIMIT_REDIS_URL = os.environ.get('RATE_LIMIT_REDIS_URL')
+
+# Time budget of a shared store call, in seconds; past it the local decision stands
+RATE_LIMIT_SHARED_TIMEOUT_SECONDS = float(os.environ.get('RATE_LIMIT_SHARED_TIMEOUT_SECONDS', '0.05'))
+
+
+def plan_limits(plan: Optional[str]) -> Tuple[float, float]:
+    """Get the (rate, burst) of a plan, falling back to DEFAULT_PLAN for unknown plans."""
+    return PLAN_LIMITS.get(plan or DEFAULT_PLAN) or PLAN_LIMITS[DEFAULT_PLAN]
+
+
+class TokenBucket:
+    """
+    Token bucket of one ingest token
+
+    Attributes:
+        plan: Plan the limits come from
+        rate: Refill rate in requests per second
+        burst: Capacity in requests
+        tokens: Requests currently available
+        updated: Time of the last refill (monotonic seconds)
+        throttled: Requests rejected since the last admitted one
+    """
+
+    __slots__ = ('plan', 'rate', 'burst', 'tokens', 'updated', 'throttled')
+
+    def __init__(self, plan: str, now: float):
+        self.plan = plan
+        self.rate, self.burst = plan_limits(plan)
+        self.tokens = self.burst
+        self.updated = now
+        self.throttled = 0
+
+    def take(self, now: float) -> float:
+        """
+        Take one request from the bucket
+
+        Returns:
+            0 if the request is admitted, otherwise the seconds until it would be
+        """
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            self.throttled = 0
+            return 0.0
+        self.throttled += 1
+        return (1 - self.tokens) / self.rate
+
+
+class RedisBucketStore:
+    """
+    Token buckets shared by every instance, kept in Redis and updated atomically by a script
+
+    Args:
+        url: Redis URL, e.g. redis://10.0.0.3:6379/0
+        timeout: Socket timeout in seconds
+    """
+
+    SCRIPT = """
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'updated')
+local rate, burst, now = tonumber(ARGV[1]), tonumber(ARGV[2]), tonumber(ARGV[3])
+local tokens = tonumber(state[1]) or burst
+local updated = tonumber(state[2]) or now
+tokens = math.min(burst, tokens + math.max(0, now - updated) * rate)
+local wait = 0
+if tokens >= 1 then tokens = tokens - 1 else wait = (1 - tokens) / rate end
+redis.call('HSET', KEYS[1], 'tokens', tokens, 'updated', now)
+redis.call('EXPIRE', KEYS[1], math.ceil(burst / rate) + 1)
+return tostring(wait)
+"""
+
+    def __init__(self, url: str, timeout: float = RATE_LIMIT_SHARED_TIMEOUT_SECONDS):
+        import redis
+
+        self._client = redis.Redis.from_url(url, socket_timeout=timeout, socket_connect_timeout=timeout)
+        self._script = self._client.register_script(self.SCRIPT)
+
+    def take(self, key: str, rate: float, burst: float) -> float:
+        """
+        Take one request from the shared bucket of a token
+
+        Returns:
+            0 if the request is admitted, otherwise the seconds until it would be
+        """
+        return float(self._script(keys=[f'ingest-rate:{key}'], args=[rate, burst, time.time()]))
+
+
+class RateLimiter:
+    """
+    Thread-safe per-token rate limiter
+
+    Args:
+        max_tokens: Maximum number of buckets kept; the least recently used are dropped
+        shared: Optional store of buckets shared between instances
+        clock: Monotonic time source, replaceable for tests
+    """
+
+    def __init__(self, max_tokens: int = RATE_LIMIT_MAX_TOKENS, shared: Optional[RedisBucketStore] = None,
+                 clock: Callable[[], float] = time.monotonic):
+        # An idle bucket refills completely, so dropping it after the slowest refill loses nothing
+        slowest_refill = max(burst / rate for rate, burst in PLAN_LIMITS.values())
+        self._buckets = TTLCache(max_size=max_tokens, ttl=slowest_refill, clock=clock)
+        self._shared = shared
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._admitted: Dict[str, int] = {}
+        self._throttled: Dict[str, int] = {}
+
+    def admit(self, key: str) -> Optional[float]:
+        """
+        Decide whether a request of a token may proceed
+
+        Args:
+            key: The token key (see tokens.tokens.hash_token)
+
+        Returns:
+            None if the request is admitted, otherwise the seconds to wait before retrying
+        """
+        now = self._clock()
+        with self._lock:
+            found, bucket = self._buckets.get(key)
+            if not found:
+                bucket = TokenBucket(DEFAULT_PLAN, now)
+            wait = bucket.take(now)
+            self._buckets.set(key, bucket)
+            plan, rate, burst, throttled = bucket.plan, bucket.rate, bucket.burst, bucket.throttled
+
+        if not wait and self._shared is not None:
+            try:
+                wait = self._shared.take(key, rate, burst)
+            except Exception as e:
+                logger.warn(f"Shared rate limit store unavailable, admitting on the local bucket: {str(e)}")
+
+        with self._lock:
+            counters = self._throttled if wait else self._admitted
+            counters[plan] = counters.get(plan, 0) + 1
+
+        if not wait:
+            return None
+        if throttled == 1:
+            # Once per throttled episode of a token, not once per rejected request
+            logger.warn(f"Throttling ingest token {key[:10]}... (plan: {plan})", throttled=self.counters())
+        return wait
+
+    def set_plan(self, key: str, plan: Optional[str]) -> None:
+        """
+        Apply the limits of a plan to the bucket of a token, once the token has been resolved
+
+        Args:
+            key: The token key
+            plan: The plan of the token owner, or None for DEFAULT_PLAN
+        """
+        plan = plan or DEFAULT_PLAN
+        with self._lock:
+            found, bucket = self._buckets.get(key)
+            if not found or bucket.plan == plan:
+                return
+            bucket.plan = plan
+            bucket.rate, bucket.burst = plan_limits(plan)
+            bucket.tokens = min(bucket.tokens, bucket.burst)
+
+    def counters(self) -> Dict[str, Dict[str, int]]:
+        """Get the admitted and throttled requests per plan since the instance started."""
+        with self._lock:
+            return {'admitted': dict(self._admitted), 'throttled': dict(self._throttled)}
+
+
+def retry_after_header(wait: float) -> str:
+    """Format a wait as a Retry-After value (whole seconds, at least 1)."""
+    return str(max(1, math.ceil(wait)))
+
+
+# Shared by every request served by this instance
+ingest_limiter = RateLimiter(shared=RedisBucketStore(RATE_LIMIT_REDIS_URL) if RATE_LIMIT_REDIS_URL else None)
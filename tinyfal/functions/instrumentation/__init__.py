@@ -0,0 +1 @@
+# Instrumentation package for Tinyfal Firebase Functions
@@ -0,0 +1,225 @@
+"""
+Per-request accounting of Firestore operations and per-stage latency.
+
+Timing is sampled: a request is timed with probability TIMING_SAMPLE_RATE (0 disables it). A
+timed request records the duration of each stage wrapped in `span(stage)`, and finish_timer
+emits one structured log record with the stage durations, the annotations (payload bytes, ...)
+and the Firestore op counts. With TIMING_SERVER_HEADER=1 the durations are also returned in a
+Server-Timing response header, which browsers and curl show without log access.
+
+When a request is not timed, span() returns a shared no-op context manager: the cost is one
+context variable lookup per stage.
+"""
+import os
+import random
+import time
+from contextvars import ContextVar
+from typing import Any, Dict, Optional
+
+from firebase_functions import logger
+
+
+TIMING_SAMPLE_RATE = float(os.environ.get('TIMING_SAMPLE_RATE', '0'))
+TIMING_SERVER_HEADER = os.environ.get('TIMING_SERVER_HEADER', '0') == '1'
+
+
+class OpCounter:
+    """
+    Counts the Firestore reads and writes issued while serving one request.
+    Queries count one read per returned document (minimum one), as Firestore bills them.
+    """
+
+    __slots__ = ('reads', 'writes', 'deletes')
+
+    def __init__(self):
+        self.reads = 0
+        self.writes = 0
+        self.deletes = 0
+
+    @property
+    def total(self) -> int:
+        return self.reads + self.writes + self.deletes
+
+    def as_dict(self) -> Dict[str, int]:
+        return {
+            'reads': self.reads,
+            'writes': self.writes,
+            'deletes': self.deletes,
+        }
+
+
+_current_ops: ContextVar[Optional[OpCounter]] = ContextVar('tinyfal_firestore_ops', default=None)
+
+
+def start_op_counter() -> OpCounter:
+    """
+    Start counting Firestore operations for the current request
+
+    Returns:
+        The counter that record_read/record_write will update
+    """
+    counter = OpCounter()
+    _current_ops.set(counter)
+    return counter
+
+
+def record_read(count: int = 1) -> None:
+    """Record document reads against the current request, if one is being counted."""
+    counter = _current_ops.get()
+    if counter is not None:
+        counter.reads += max(count, 1)
+
+
+def record_write(count: int = 1) -> None:
+    """Record document writes against the current request, if one is being counted."""
+    counter = _current_ops.get()
+    if counter is not None:
+        counter.writes += count
+
+
+def record_delete(count: int = 1) -> None:
+    """Record document deletes against the current request, if one is being counted."""
+    counter = _current_ops.get()
+    if counter is not None:
+        counter.deletes += count
+
+
+class RequestTimer:
+    """
+    Stage durations of one timed request
+
+    Attributes:
+        name: What is timed, e.g. the function name
+        started: Start time (perf_counter seconds)
+        spans: Stage -> total seconds, in the order stages first ran
+        fields: Annotations logged with the durations
+    """
+
+    __slots__ = ('name', 'started', 'spans', 'fields')
+
+    def __init__(self, name: str):
+        self.name = name
+        self.started = time.perf_counter()
+        self.spans: Dict[str, float] = {}
+        self.fields: Dict[str, Any] = {}
+
+    def add(self, stage: str, seconds: float) -> None:
+        """Add time to a stage; a stage that runs several times accumulates."""
+        self.spans[stage] = self.spans.get(stage, 0.0) + seconds
+
+    def total(self) -> float:
+        """Get the seconds elapsed since the timer started."""
+        return time.perf_counter() - self.started
+
+    def as_dict(self) -> Dict[str, Any]:
+        return {
+            'name': self.name,
+            'total_ms': round(self.total() * 1000, 2),
+            'spans_ms': {stage: round(seconds * 1000, 2) for stage, seconds in self.spans.items()},
+            **self.fields,
+        }
+
+    def server_timing(self) -> str:
+        """Format the durations as a Server-Timing header value."""
+        entries = [f'{stage};dur={seconds * 1000:.2f}' for stage, seconds in self.spans.items()]
+        entries.append(f'total;dur={self.total() * 1000:.2f}')
+        return ', '.join(entries)
+
+
+class _Span:
+    __slots__ = ('timer', 'stage', 'started')
+
+    def __init__(self, timer: RequestTimer, stage: str):
+        self.timer = timer
+        self.stage = stage
+
+    def __enter__(self) -> '_Span':
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info) -> bool:
+        self.timer.add(self.stage, time.perf_counter() - self.started)
+        return False
+
+
+class _NoSpan:
+    __slots__ = ()
+
+    def __enter__(self) -> '_NoSpan':
+        return self
+
+    def __exit__(self, *exc_info) -> bool:
+        return False
+
+
+_NO_SPAN = _NoSpan()
+
+_current_timer: ContextVar[Optional[RequestTimer]] = ContextVar('tinyfal_request_timer', default=None)
+
+
+def start_timer(name: str, sample_rate: Optional[float] = None) -> Optional[RequestTimer]:
+    """
+    Start timing the current request if it is sampled
+
+    Args:
+        name: What is timed, e.g. the function name
+        sample_rate: Probability of timing the request (default TIMING_SAMPLE_RATE)
+
+    Returns:
+        The timer, or None if the request is not timed
+    """
+    rate = TIMING_SAMPLE_RATE if sample_rate is None else sample_rate
+    if rate <= 0 or (rate < 1 and random.random() >= rate):
+        # Threads serve many requests, never let a previous request's timer collect spans
+        _current_timer.set(None)
+        return None
+    timer = RequestTimer(name)
+    _current_timer.set(timer)
+    return timer
+
+
+def span(stage: str):
+    """
+    Time a stage of the current request
+
+        with span('token'):
+            owner = resolve_token(db, token)
+    """
+    timer = _current_timer.get()
+    return _NO_SPAN if timer is None else _Span(timer, stage)
+
+
+def annotate(**fields: Any) -> None:
+    """Attach fields (payload bytes, batch sizes, ...) to the timing record of the current request, if timed."""
+    timer = _current_timer.get()
+    if timer is not None:
+        timer.fields.update(fields)
+
+
+def finish_timer(response=None) -> Optional[RequestTimer]:
+    """
+    Stop timing the current request: log its timing record and, with TIMING_SERVER_HEADER, add
+    the Server-Timing header to the response
+
+    Args:
+        response: The response about to be returned, if any
+
+    Returns:
+        The finished timer, or None if the request was not timed
+    """
+    timer = _current_timer.get()
+    if timer is None:
+        return None
+    _current_timer.set(None)
+
+    record = timer.as_dict()
+    counter = _current_ops.get()
+    if counter is not None:
+        record['firestore_ops'] = counter.as_dict()
+    if response is not None:
+        record['status'] = response.status_code
+        if TIMING_SERVER_HEADER:
+            response.headers['Server-Timing'] = timer.server_timing()
+
+    logger.info(f"{timer.name} took {record['total_ms']} ms", timing=record)
+    return timer
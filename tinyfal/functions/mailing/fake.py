@@ -0,0 +1,86 @@
+"""
+Local HTTP stand-in for the Forward Email API, for local runs and tests.
+
+    with StubMailServer(statuses=[503, 200]) as server:
+        client = MailClient('key', api_url=server.url)
+        client.send('user@example.com', 'Subject', '<p>Hi</p>')
+
+Every request is recorded in `received` as its decoded form fields; nothing leaves the machine.
+"""
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, Iterable, List, Optional
+from urllib.parse import parse_qs
+
+
+class StubMailServer:
+    """
+    Threaded HTTP server answering email posts
+
+    Args:
+        statuses: Status codes answered to the first requests, in order; 200 afterwards
+        delay: Seconds to wait before answering each request
+        retry_after: Retry-After header sent with 429 and 503 answers
+    """
+
+    def __init__(self, statuses: Iterable[int] = (), delay: float = 0.0, retry_after: Optional[str] = None):
+        self.statuses = list(statuses)
+        self.delay = delay
+        self.retry_after = retry_after
+        self.received: List[Dict[str, str]] = []
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer(('127.0.0.1', 0), self._handler())
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def url(self) -> str:
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}/v1/emails"
+
+    def _next_status(self, fields: Dict[str, str]) -> int:
+        with self._lock:
+            self.received.append(fields)
+            return self.statuses.pop(0) if self.statuses else 200
+
+    def _handler(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                length = int(self.headers.get('Content-Length') or 0)
+                body = self.rfile.read(length).decode('utf-8')
+                fields = {key: values[0] for key, values in parse_qs(body).items()}
+                status = stub._next_status(fields)
+                if stub.delay:
+                    time.sleep(stub.delay)
+
+                payload = json.dumps({'id': f"stub-{len(stub.received)}"} if status == 200 else {'message': 'stub error'}).encode()
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(payload)))
+                if stub.retry_after is not None and status in (429, 503):
+                    self.send_header('Retry-After', stub.retry_after)
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def log_message(self, format, *args):
+                return None
+
+        return Handler
+
+    def start(self) -> 'StubMailServer':
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self) -> 'StubMailServer':
+        return self.start()
+
+    def __exit__(self, *exc) -> None:
+        self.stop()
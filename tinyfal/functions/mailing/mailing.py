@@ -1,136 +1,378 @@
-import requests
-from jinja2 import Template
+"""
+Transactional email through the Forward Email API.
+
+Mail goes through a MailClient: one pooled requests session per API key, reused across
+invocations on a warm instance, with explicit timeouts and retries with jittered backoff on
+429/5xx. send_many delivers a list of messages concurrently through a bounded worker pool.
+The API URL can point at a local stub server (MAIL_API_URL, see mailing/fake.py).
+
+Templates are compiled on first render, and jinja2 and requests are only imported when mail is
+rendered or sent, so functions that never send mail do not pay for them on cold start.
+"""
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+
+from retry.retry import backoff_delays
+
+url = os.environ.get('MAIL_API_URL', "https://api.forwardemail.net/v1/emails")
 
-url = "https://api.forwardemail.net/v1/emails"
- # Username and empty password
+MAIL_SENDER = 'app@tinyfal.com'
 
+# (connect, read) timeouts in seconds; without them a stalled API holds the function until it times out
+MAIL_CONNECT_TIMEOUT_SECONDS = float(os.environ.get('MAIL_CONNECT_TIMEOUT_SECONDS', '3.05'))
+MAIL_READ_TIMEOUT_SECONDS = float(os.environ.get('MAIL_READ_TIMEOUT_SECONDS', '10'))
 
+MAIL_ATTEMPTS = int(os.environ.get('MAIL_ATTEMPTS', '4'))
+MAIL_WORKERS = int(os.environ.get('MAIL_WORKERS', '8'))
 
+# Responses worth another attempt
+RETRY_STATUS_CODES = frozenset({429, 500, 502, 503, 504})
 
-# Define an HTML template
-welcome_html_template = """
+##########################################################################################
+# Resource creation email template
+
+resource_created_html_template = """
 <!DOCTYPE html>
 <html>
 <head>
-    <title>Bienvenido a Literatos</title>
+    <title>Nuevo recurso creado - Tinyfal</title>
 </head>
 <body>
     <div>
-        <h1>Bienvenido a Literatos</h1>
+        <h1>¡Tu recurso ha sido creado exitosamente!</h1>
+        
+        <p>Hola,</p>
+        <p>Te informamos que tu nuevo recurso <strong>"{{ resource_title }}"</strong> ha sido creado exitosamente en tu cuenta de Tinyfal.</p>
+        <p>Ya puedes comenzar a enviar datos a este recurso utilizando el token que se generó para él.</p>
+        
+        <p>Puedes acceder a tu recurso y ver los datos en tiempo real desde tu panel de control en la aplicación.</p>
         
-        <p>Nuestra plataforma está diseñada para conectar a los amantes de la literatura con historias que inspiran, educan y entretienen.</p>
-        <p>Explora nuestra colección de obras literarias, participa en debates apasionantes y comparte tus propias creaciones con una comunidad vibrante de lectores y escritores.</p>
-        <p>Gracias por unirte a nosotros en este viaje. ¡Esperamos que disfrutes de la experiencia!</p>
         <div>
-            <p>Si tienes alguna pregunta o necesitas ayuda, no dudes en contactarnos en <a href="mailto:app@literatos.net">app@literatos.net</a>.</p>
-            <p>&copy; 2023 Literatos. Todos los derechos reservados.</p>
+            <p>Si tienes alguna pregunta o necesitas ayuda, no dudes en contactarnos en <a href="mailto:app@tinyfal.com">app@tinyfal.com</a>.</p>
+            <p>&copy; 2025 Tinyfal. Todos los derechos reservados.</p>
         </div>
     </div>
 </body>
 </html>
 """
 
-# Define an HTML template for contest submission
-contest_submission_html_template = """
+##########################################################################################
+# Daily summary
+
+# Per-user daily report. [[ ... ]] placeholders are the locale strings, filled in once per
+# locale by get_localized_template; {{ ... }} placeholders are the report data.
+
+daily_summary_html_template = """
 <!DOCTYPE html>
 <html>
 <head>
-    <title>Gracias por tu envío</title>
+    <title>[[ title ]] - Tinyfal</title>
 </head>
 <body>
     <div>
-        <h1>¡Gracias por participar en nuestro concurso literario!</h1>
-        
-        <p>Tu texto ha sido recibido con éxito y estamos emocionados de que formes parte de esta iniciativa.</p>
-        <p>Te invitamos a registrarte en nuestra plataforma <a href="https://app.literatos.net">app.literatos.net</a> para explorar los textos enviados por otros participantes, interactuar con la comunidad y descubrir más oportunidades para compartir tu talento.</p>
-        <p>Gracias por contribuir a enriquecer nuestra comunidad literaria.</p>
+        <h1>[[ title ]] {{ day }}</h1>
+
+        <table>
+            <tr>
+                <th>[[ resource ]]</th>
+                <th>[[ uptime ]]</th>
+                <th>[[ peak_cpu ]]</th>
+                <th>[[ peak_ram ]]</th>
+                <th>[[ peak_disk ]]</th>
+                <th>[[ alerts ]]</th>
+            </tr>
+            {% for resource in resources %}
+            <tr>
+                <td>{{ resource.title }}</td>
+                <td>{% if resource.uptime is not none %}{{ '%.1f' % (resource.uptime * 100) }}%{% else %}[[ no_data ]]{% endif %}</td>
+                <td>{% if resource.cpu_max is not none %}{{ '%.0f' % resource.cpu_max }}%{% else %}-{% endif %}</td>
+                <td>{% if resource.mem_max is not none %}{{ '%.0f' % resource.mem_max }}%{% else %}-{% endif %}</td>
+                <td>{% if resource.disk_max is not none %}{{ '%.0f' % resource.disk_max }}%{% else %}-{% endif %}</td>
+                <td>{{ resource.alerts }}</td>
+            </tr>
+            {% endfor %}
+        </table>
+
+        <p>[[ alert_total ]]: {{ alert_total }}</p>
+
         <div>
-            <p>Si tienes alguna pregunta o necesitas ayuda, no dudes en contactarnos en <a href="mailto:app@literatos.net">app@literatos.net</a>.</p>
-            <p>&copy; 2023 Literatos. Todos los derechos reservados.</p>
+            <p>[[ footer ]]</p>
+            <p>&copy; 2025 Tinyfal. [[ rights ]]</p>
         </div>
     </div>
 </body>
 </html>
 """
 
-# Update the data dictionary to include the HTML content
+DEFAULT_LOCALE = 'es'
 
+LOCALE_STRINGS = {
+    'daily_summary': {
+        'es': {
+            'subject': 'Resumen diario de Tinyfal',
+            'title': 'Resumen del día',
+            'resource': 'Recurso',
+            'uptime': 'Disponibilidad',
+            'peak_cpu': 'CPU máx.',
+            'peak_ram': 'RAM máx.',
+            'peak_disk': 'Disco máx.',
+            'alerts': 'Alertas',
+            'no_data': 'Sin datos',
+            'alert_total': 'Alertas del día',
+            'footer': 'Puedes desactivar este resumen en los ajustes de la aplicación.',
+            'rights': 'Todos los derechos reservados.',
+        },
+        'en': {
+            'subject': 'Tinyfal daily summary',
+            'title': 'Daily summary',
+            'resource': 'Resource',
+            'uptime': 'Uptime',
+            'peak_cpu': 'Peak CPU',
+            'peak_ram': 'Peak RAM',
+            'peak_disk': 'Peak disk',
+            'alerts': 'Alerts',
+            'no_data': 'No data',
+            'alert_total': 'Alerts today',
+            'footer': 'You can turn this summary off in the app settings.',
+            'rights': 'All rights reserved.',
+        },
+    },
+}
 
-# Create a Jinja2 template object
-welcome_template = Template(welcome_html_template)
+TEMPLATES = {
+    'resource_created': resource_created_html_template,
+    'daily_summary': daily_summary_html_template,
+}
 
-# Render the template with data
-welcome_html_content = welcome_template.render()
 
-# Create a Jinja2 template object for contest submission
-contest_submission_template = Template(contest_submission_html_template)
+@lru_cache(maxsize=None)
+def get_template(name):
+    """Compile a template of TEMPLATES on first use."""
+    from jinja2 import Template
 
-# Render the template with data
-contest_submission_html_content = contest_submission_template.render()
+    return Template(TEMPLATES[name])
 
-##########################################################################################
-# Resource creation email template
 
-resource_created_html_template = """
-<!DOCTYPE html>
-<html>
-<head>
-    <title>Nuevo recurso creado - Tinyfal</title>
-</head>
-<body>
-    <div>
-        <h1>¡Tu recurso ha sido creado exitosamente!</h1>
-        
-        <p>Hola,</p>
-        <p>Te informamos que tu nuevo recurso <strong>"{{ resource_title }}"</strong> ha sido creado exitosamente en tu cuenta de Tinyfal.</p>
-        <p>Ya puedes comenzar a enviar datos a este recurso utilizando el token que se generó para él.</p>
-        
-        <p>Puedes acceder a tu recurso y ver los datos en tiempo real desde tu panel de control en la aplicación.</p>
-        
-        <div>
-            <p>Si tienes alguna pregunta o necesitas ayuda, no dudes en contactarnos en <a href="mailto:app@tinyfal.com">app@tinyfal.com</a>.</p>
-            <p>&copy; 2025 Tinyfal. Todos los derechos reservados.</p>
-        </div>
-    </div>
-</body>
-</html>
-"""
+def supported_locale(name, locale):
+    """Get the language of LOCALE_STRINGS[name] to use for a user locale such as 'en-US'."""
+    language = (locale or '').replace('_', '-').split('-')[0].lower()
+    return language if language in LOCALE_STRINGS[name] else DEFAULT_LOCALE
 
-# Create a Jinja2 template object for resource creation
-resource_created_template = Template(resource_created_html_template)
+
+@lru_cache(maxsize=None)
+def get_localized_template(name, language):
+    """
+    Compile a template of TEMPLATES for a language on first use: the [[ ... ]] strings are
+    rendered once, leaving a template that only renders the data.
+    """
+    from jinja2 import Environment, Template
+
+    # Only [[ ... ]] is evaluated here; the {{ ... }} and {% ... %} of the data pass through
+    strings = Environment(
+        variable_start_string='[[', variable_end_string=']]',
+        block_start_string='[%', block_end_string='%]',
+        comment_start_string='[#', comment_end_string='#]',
+        autoescape=True,
+    )
+    source = strings.from_string(TEMPLATES[name]).render(**LOCALE_STRINGS[name][language])
+    return Template(source, autoescape=True)
 
 ##########################################################################################
-# Daily summary
+# Sending
 
-daily_summary_html= """
-    <html>
-        <body>
-            <h1>Resumen del día{{today}} </h1>
-            <p><strong>Registros:</strong> {{new_users_count}}</p>
-            <p><strong>Escritos creados:</strong> {{new_escritos_count}}</p>
-        </body>
-    </html>
+class MailMessage:
     """
-daily_summary_template = Template(daily_summary_html)
+    One email
 
-##########################################################################################
-def mailto(to, subject, html_content, api_key):
+    Attributes:
+        to: Recipient address
+        subject: Subject line
+        html_content: Rendered HTML body
+    """
+
+    __slots__ = ('to', 'subject', 'html_content')
+
+    def __init__(self, to: str, subject: str, html_content: str):
+        self.to = to
+        self.subject = subject
+        self.html_content = html_content
+
+
+def retry_after_seconds(response) -> Optional[float]:
+    """Get the delay a 429/503 response asks for, if given in seconds."""
+    value = response.headers.get('Retry-After')
+    try:
+        return max(0.0, float(value)) if value is not None else None
+    except ValueError:
+        return None
+
+
+class MailClient:
+    """
+    Forward Email API client with a pooled session
+
+    Connection errors (including connect timeouts) and 429/5xx responses are retried. Read
+    timeouts are not: the API may already have accepted the message, and a retry would send it twice.
+
+    Args:
+        api_key: Forward Email API key
+        api_url: Endpoint to post messages to
+        timeout: (connect, read) timeouts in seconds
+        attempts: Maximum number of attempts per message
+        workers: Concurrent sends of send_many, and size of the connection pool
+        base_delay: Delay bound before the first retry, in seconds
+        max_delay: Upper bound of any single delay, including Retry-After, in seconds
+        sleep: Sleep function used between attempts, replaceable for tests
+    """
 
-    auth = (api_key, '') 
-    # Send the email using the Forward Email API
-    data = {
-    'from': 'app@tinyfal.com',
-    'to': to,
-    'subject': subject,
-    'html' : html_content,
-    }
-    response = requests.post(url, auth=auth, data=data)
+    def __init__(
+        self,
+        api_key: str,
+        api_url: str = url,
+        timeout: Tuple[float, float] = (MAIL_CONNECT_TIMEOUT_SECONDS, MAIL_READ_TIMEOUT_SECONDS),
+        attempts: int = MAIL_ATTEMPTS,
+        workers: int = MAIL_WORKERS,
+        base_delay: float = 0.5,
+        max_delay: float = 8.0,
+        sleep: Callable[[float], None] = time.sleep
+    ):
+        self.api_url = api_url
+        self._api_key = api_key
+        self._timeout = timeout
+        self._attempts = attempts
+        self._workers = workers
+        self._base_delay = base_delay
+        self._max_delay = max_delay
+        self._sleep = sleep
+        self._session = None
+        self._session_lock = threading.Lock()
 
-    return response
+    @property
+    def session(self):
+        """The requests session, created on first use."""
+        if self._session is None:
+            with self._session_lock:
+                if self._session is None:
+                    import requests
+                    from requests.adapters import HTTPAdapter
+
+                    session = requests.Session()
+                    session.auth = (self._api_key, '')
+                    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self._workers)
+                    session.mount('https://', adapter)
+                    session.mount('http://', adapter)
+                    self._session = session
+        return self._session
+
+    def send(self, to: str, subject: str, html_content: str):
+        """
+        Send one email, retrying connection errors and 429/5xx responses
+
+        Returns:
+            The last response; a retryable status is returned once every attempt failed
+
+        Raises:
+            requests.ConnectionError once every attempt failed to connect, or requests.Timeout on a read timeout
+        """
+        import requests
+
+        data = {
+            'from': MAIL_SENDER,
+            'to': to,
+            'subject': subject,
+            'html': html_content,
+        }
+        delays = backoff_delays(self._attempts, self._base_delay, self._max_delay)
+        while True:
+            response = None
+            try:
+                response = self.session.post(self.api_url, data=data, timeout=self._timeout)
+                if response.status_code not in RETRY_STATUS_CODES:
+                    return response
+            except requests.ConnectionError:
+                delay = next(delays, None)
+                if delay is None:
+                    raise
+                self._sleep(delay)
+                continue
+
+            delay = next(delays, None)
+            if delay is None:
+                return response
+            # The API may ask for a longer pause than the backoff
+            requested = retry_after_seconds(response)
+            if requested is not None:
+                delay = min(max(delay, requested), self._max_delay)
+            self._sleep(delay)
+
+    def send_many(self, messages: Iterable[MailMessage]) -> List[Any]:
+        """
+        Send emails concurrently through a pool of at most `workers` threads
+
+        Args:
+            messages: The emails
+
+        Returns:
+            For each message in order, its response or the exception that stopped it
+        """
+        messages = list(messages)
+        if not messages:
+            return []
+
+        with ThreadPoolExecutor(max_workers=min(self._workers, len(messages)), thread_name_prefix='mail') as pool:
+            futures = [pool.submit(self.send, message.to, message.subject, message.html_content) for message in messages]
+
+        results: List[Any] = []
+        for future in futures:
+            try:
+                results.append(future.result())
+            except Exception as e:
+                results.append(e)
+        return results
+
+    def close(self) -> None:
+        """Close the pooled connections."""
+        if self._session is not None:
+            self._session.close()
+            self._session = None
+
+
+_clients: Dict[str, MailClient] = {}
+_clients_lock = threading.Lock()
+
+
+def get_mail_client(api_key: str) -> MailClient:
+    """Get the client of an API key, shared by every invocation on this instance."""
+    with _clients_lock:
+        client = _clients.get(api_key)
+        if client is None:
+            client = _clients[api_key] = MailClient(api_key)
+        return client
+
+
+def mailto(to, subject, html_content, api_key):
+    """Send one email through the shared client of the API key."""
+    return get_mail_client(api_key).send(to, subject, html_content)
 
 def render_resource_created_email(resource_title):
     """Render the resource creation email template with the given resource title."""
-    return resource_created_template.render(resource_title=resource_title)
+    return get_template('resource_created').render(resource_title=resource_title)
+
+def render_daily_summary_email(report, locale):
+    """
+    Render the daily report of a user
 
-if __name__ == "__main__":
-    mailto("ferwanguer@me.com", "Bienvenido a Literatos", welcome_html_content)
\ No newline at end of file
+    Args:
+        report: Template data: day, resources (title, uptime, cpu_max, mem_max, disk_max, alerts) and alert_total
+        locale: User locale, e.g. 'es' or 'en-US'
+
+    Returns:
+        (subject, html_content)
+    """
+    language = supported_locale('daily_summary', locale)
+    html_content = get_localized_template('daily_summary', language).render(**report)
+    return f"{LOCALE_STRINGS['daily_summary'][language]['subject']} {report['day']}", html_content
@@ -2,22 +2,58 @@
 # To get started, simply uncomment the below code or create your own.
 # Deploy with `firebase deploy`
 
-from firebase_functions import https_fn, logger, firestore_fn
-from firebase_functions.options import set_global_options
-from firebase_admin import initialize_app, firestore
+from firebase_functions import https_fn, logger, firestore_fn, scheduler_fn, tasks_fn
+from firebase_functions.options import set_global_options, RetryConfig, RateLimits
+from firebase_admin import initialize_app
 from firebase_functions.params import SecretParam
 
 import json
-from datetime import datetime, timezone
+from typing import Any, Dict, List, Optional, Tuple
+from google.api_core.exceptions import NotFound
+from datetime import datetime, timedelta, timezone
+
+# Import database functionality
+from database.database import get_db
 
 # Import mailing functionality
-from mailing.mailing import mailto, render_resource_created_email
+from mailing.mailing import mailto, render_resource_created_email, get_mail_client
+
+# Import daily report functionality
+from reports.daily import send_daily_reports
 
-# Import notification functionality
-from notifications.notifications import check_and_send_threshold_alerts
+# Import alert dispatch functionality
+from alerts.dispatch import AlertJob, get_alert_queue, process_alert_job, dispatches_from_trigger, jobs_from_write
+from alerts.rules import alert_values
+from alerts.digest import overdue_digests
+from notifications.notifications import send_alert_digest
 
 # Import models functionality
-from models.models import extract_available_memory_percent, extract_cpu_available_percent
+from models.models import MetricsBatch, extract_available_memory_percent, extract_cpu_available_percent
+from models.projection import DEFAULT_PROJECTION, Projection, project_payload
+from models.rates import COUNTER_MEASUREMENTS, rate_tracker
+
+# Import history functionality
+from history.history import extract_sample, history_collection
+from history.streaming import STREAM_STATS_FIELD, stream_tracker, stream_values, anomaly_metric
+from history.rollups import rollup_hour, compact_day, rollups_collection
+
+# Import alert state and offline detection functionality
+from alerts.state import alert_state_ref
+from alerts.offline import sweep_offline, notify_back_online
+
+# Import token resolution functionality
+from tokens.tokens import TokenOwner, hash_token, resolve_token, resolve_tokens, invalidate_token, sync_token_index, sync_token_plans
+
+# Import user settings functionality
+from users.settings import remember_user_settings, settings_changed, stamp_settings_version
+
+# Import request body decoding and write coalescing functionality
+from ingestion.decoding import decode_json_body, decode_envelopes, keep_measurements, valid_metrics, BodyDecodingError
+from ingestion.coalescing import PendingWrite, write_buffer, flush_pending, flush_pending_many
+from ingestion.ratelimit import ingest_limiter, retry_after_header
+
+# Import instrumentation functionality
+from instrumentation.instrumentation import start_op_counter, record_write, start_timer, finish_timer, span, annotate
 
 
 # For cost control, you can set the maximum number of containers that can be
@@ -38,15 +74,153 @@ FW_EMAIL_API_KEY = SecretParam('FW_EMAIL_API_KEY')
 # Initialize Firebase Admin SDK
 initialize_app()
 
+def flush_coalesced(pending: PendingWrite) -> None:
+    """
+    Write a buffered window outside of a request (background flusher and shutdown).
+    Failed windows are put back so their samples go out with the next write.
+    """
+    try:
+        flush_pending(get_db(), pending)
+    except NotFound:
+        write_buffer.discard(pending.user_id, pending.resource_id)
+        logger.warn(f"Dropped buffered samples of deleted resource user_id: {pending.user_id}, resource_id: {pending.resource_id}")
+    except Exception as e:
+        write_buffer.requeue(pending)
+        logger.error(f"Failed to flush buffered samples for user_id: {pending.user_id}, resource_id: {pending.resource_id}. Error: {str(e)}")
+
+
+def flush_due_windows() -> None:
+    """
+    Write the buffered windows whose interval elapsed, at the end of a request while the
+    instance still has CPU. Failed windows are put back so their samples go out with the next write.
+    """
+    windows = write_buffer.due()
+    if not windows:
+        return
+    
+    try:
+        results = flush_pending_many(get_db(), windows)
+    except Exception as e:
+        for pending in windows:
+            write_buffer.requeue(pending)
+        logger.error(f"Failed to flush {len(windows)} buffered windows. Error: {str(e)}")
+        return
+    
+    for pending, written in zip(windows, results):
+        if isinstance(written, NotFound):
+            write_buffer.discard(pending.user_id, pending.resource_id)
+            logger.warn(f"Dropped buffered samples of deleted resource user_id: {pending.user_id}, resource_id: {pending.resource_id}")
+        elif isinstance(written, Exception):
+            write_buffer.requeue(pending)
+            logger.error(f"Failed to flush buffered samples for user_id: {pending.user_id}, resource_id: {pending.resource_id}. Error: {str(written)}")
+        else:
+            record_write(written)
+
+
+write_buffer.start_flusher(flush_coalesced)
+write_buffer.flush_on_shutdown(flush_coalesced)
+
+
+def buffer_metrics(db, owner: TokenOwner, request_data: Dict[str, Any], projection: Projection,
+                   current_time: datetime) -> Tuple[Optional[str], Optional[PendingWrite], Optional[AlertJob]]:
+    """
+    Extract, score and buffer one batch of metrics of a resource
+
+    Args:
+        db: Firestore client
+        owner: The resource the batch belongs to
+        request_data: Decoded batch ({'metrics': [...]})
+        projection: Projection of the resource
+        current_time: Time the batch was received
+
+    Returns:
+        (error, pending, alert_job). error is set when the batch lacks the memory or CPU metrics;
+        otherwise pending is the window to write now (None if the batch was buffered) and
+        alert_job the alerts to enqueue once the batch is accepted (None when on_resource_written
+        evaluates them from the write)
+    """
+    user_id, resource_id = owner.user_id, owner.resource_id
+
+    # The batch is indexed once so every extractor below is a dictionary lookup
+    with span('extract'):
+        metrics_data = MetricsBatch(request_data.get('metrics', []))
+        available_memory_percent = extract_available_memory_percent(metrics_data)
+        available_cpu_percent = extract_cpu_available_percent(metrics_data)
+    
+    # Both are required
+    if available_memory_percent is None:
+        logger.error(f"Failed to extract available memory percentage for user_id: {user_id}, resource_id: {resource_id}")
+        return "Unable to extract available memory percentage from metrics data", None, None
+    
+    if available_cpu_percent is None:
+        logger.error(f"Failed to extract available CPU percentage for user_id: {user_id}, resource_id: {resource_id}")
+        return "Unable to extract available CPU percentage from metrics data", None, None
+    
+    logger.info(f"Successfully extracted metrics for user_id: {user_id}, resource_id: {resource_id} - Memory: {available_memory_percent}%, CPU: {available_cpu_percent}%")
+    
+    # Network and disk I/O counters become per-second rates against the previous batch of the resource
+    with span('rates'):
+        derived_metrics = rate_tracker.derive((user_id, resource_id), metrics_data, current_time.timestamp())
+        metrics_data.extend(derived_metrics)
+    
+    # Score the batch against the usual values of the resource, updating its streaming statistics
+    with span('stream_stats'):
+        sample = extract_sample(metrics_data)
+        scores, stream_stats = stream_tracker.observe(db, (user_id, resource_id), stream_values(metrics_data, sample), int(current_time.timestamp()))
+    if scores:
+        anomaly = anomaly_metric(scores, int(current_time.timestamp()))
+        derived_metrics.append(anomaly)
+        metrics_data.extend([anomaly])
+    
+    # The resource write trigger evaluates alerts from the values of every batch, written with the window
+    values = alert_values(metrics_data) if dispatches_from_trigger() else None
+    
+    # Derived metrics and statistics are stored with the snapshot
+    payload = project_payload(request_data, projection)
+    if derived_metrics:
+        payload = {**payload, 'metrics': (payload.get('metrics') or []) + derived_metrics}
+    if stream_stats is not None:
+        payload = {**payload, STREAM_STATS_FIELD: stream_stats}
+    
+    # Merge the batch into the coalescing buffer; the resource is written at most once per interval
+    with span('buffer'):
+        pending = write_buffer.add(
+            user_id,
+            resource_id,
+            payload,
+            int(current_time.timestamp()),
+            sample,
+            owner.offline_after,
+            values,
+        )
+    
+    # Otherwise alerts are evaluated and delivered off the request path by the in-process queue
+    alert_job = None
+    if values is None:
+        alert_job = AlertJob(user_id, resource_id, owner.title, request_data.get('metrics', []) + derived_metrics, current_time.timestamp())
+    
+    return None, pending, alert_job
+
 
 @https_fn.on_request()
 def ingest(req: https_fn.Request) -> https_fn.Response:
     """
     Firebase function that handles POST requests with authorization tokens.
     Logs JSON data to the corresponding user's resource document.
+    Sampled requests log their per-stage latency (see instrumentation/instrumentation.py).
     """
-    
-    db = firestore.client()
+    start_timer('ingest')
+    annotate(payload_bytes=req.content_length)
+    response = _ingest(req)
+    with span('flush_due'):
+        flush_due_windows()
+    finish_timer(response)
+    return response
+
+
+def _ingest(req: https_fn.Request) -> https_fn.Response:
+    db = get_db()
+    ops = start_op_counter()
     
     # Only allow POST requests
     if req.method != 'POST':
@@ -77,26 +251,32 @@ def ingest(req: https_fn.Request) -> https_fn.Response:
             headers={"Content-Type": "application/json"}
         )
     
-    # Find the user and resource that corresponds to this token using collection group query
+    # Per-token rate limit, enforced before the token costs any Firestore I/O
+    with span('rate_limit'):
+        token_key = hash_token(token)
+        wait = ingest_limiter.admit(token_key)
+    if wait is not None:
+        retry_after = retry_after_header(wait)
+        return https_fn.Response(
+            json.dumps({"error": f"Rate limit exceeded, retry in {retry_after} s"}),
+            status=429,
+            headers={"Content-Type": "application/json", "Retry-After": retry_after}
+        )
+    
+    # Find the user and resource that corresponds to this token (cached on warm instances)
     try:
-        # Use collection group query to search across all 'resources' subcollections
-        resources_query = db.collection_group('resources').where('token', '==', token).limit(1)
-        resources_docs = list(resources_query.stream())
+        with span('token'):
+            owner = resolve_token(db, token)
         
-        if not resources_docs:
+        if owner is None:
             return https_fn.Response(
                 json.dumps({"error": "Invalid or unauthorized token"}),
                 status=401,
                 headers={"Content-Type": "application/json"}
             )
         
-        # Extract user_id and resource_id from the document path
-        resource_doc = resources_docs[0]
-        resource_id = resource_doc.id
-        
-        # The document path format is: users/{user_id}/resources/{resource_id}
-        # So we can extract user_id from the parent reference
-        user_id = resource_doc.reference.parent.parent.id
+        user_id, resource_id = owner.user_id, owner.resource_id
+        ingest_limiter.set_plan(token_key, owner.plan)
             
     except Exception as e:
         logger.error(f"Token verification failed for token: {token[:10]}... Error: {str(e)}")
@@ -109,15 +289,30 @@ def ingest(req: https_fn.Request) -> https_fn.Response:
     # Log successful token verification
     logger.info(f"Token verified successfully for user_id: {user_id}, resource_id: {resource_id}")
 
-    # Parse JSON body
+    # Create document path
+    doc_path = f"users/{user_id}/resources/{resource_id}"
+    
+    # Get current server time at the beginning of function execution
+    current_time = datetime.now(timezone.utc)
+    
+    # Title and projection overrides come with the token index entry, the resource itself is never read
+    projection = DEFAULT_PROJECTION.with_overrides(owner.projection)
+    
+    # Parse JSON body, decompressing it on the fly and keeping only the measurements that are stored
+    # or turned into rates (counters the projection does not store are dropped after deriving)
     try:
-        request_data = req.get_json()
-        if request_data is None:
-            return https_fn.Response(
-                json.dumps({"error": "Request body must be valid JSON"}),
-                status=400,
-                headers={"Content-Type": "application/json"}
+        with span('decode'):
+            request_data = decode_json_body(
+                req.stream,
+                content_encoding=req.headers.get('Content-Encoding'),
+                measurements=projection.measurements | COUNTER_MEASUREMENTS,
             )
+    except BodyDecodingError as e:
+        return https_fn.Response(
+            json.dumps({"error": str(e)}),
+            status=e.status,
+            headers={"Content-Type": "application/json"}
+        )
     except Exception as e:
         return https_fn.Response(
             json.dumps({"error": f"Invalid JSON: {str(e)}"}),
@@ -126,98 +321,58 @@ def ingest(req: https_fn.Request) -> https_fn.Response:
         )
     
     logger.info("DATA RECEIVED: %s", request_data)
+    annotate(metrics=len(request_data.get('metrics') or []))
     
-    # Extract CPU and RAM available percentages from the metrics data
-    metrics_data = request_data.get('metrics', [])
-    
-    # Extract available memory percentage
-    available_memory_percent = extract_available_memory_percent(metrics_data)
-    if available_memory_percent is None:
-        logger.error(f"Failed to extract available memory percentage for user_id: {user_id}, resource_id: {resource_id}")
+    error, pending, alert_job = buffer_metrics(db, owner, request_data, projection, current_time)
+    if error is not None:
         return https_fn.Response(
-            json.dumps({"error": "Unable to extract available memory percentage from metrics data"}),
+            json.dumps({"error": error}),
             status=200,
             headers={"Content-Type": "application/json"}
         )
     
-    # Extract available CPU percentage
-    available_cpu_percent = extract_cpu_available_percent(metrics_data)
-    if available_cpu_percent is None:
-        logger.error(f"Failed to extract available CPU percentage for user_id: {user_id}, resource_id: {resource_id}")
+    if pending is None:
+        if alert_job is not None:
+            with span('alert_enqueue'):
+                get_alert_queue().enqueue(alert_job)
+        logger.info(f"Data received and buffered for user_id: {user_id}, resource_id: {resource_id}")
+        
         return https_fn.Response(
-            json.dumps({"error": "Unable to extract available CPU percentage from metrics data"}),
+            json.dumps({
+                "success": True,
+                "message": "Data received and buffered",
+            }),
             status=200,
             headers={"Content-Type": "application/json"}
         )
     
-    logger.info(f"Successfully extracted metrics for user_id: {user_id}, resource_id: {resource_id} - Memory: {available_memory_percent}%, CPU: {available_cpu_percent}%")
-    # user_id and resource_id are already determined from token lookup above
-    # Create document path
-    doc_path = f"users/{user_id}/resources/{resource_id}"
-    
-    # Get current server time at the beginning of function execution
-    current_time = datetime.now(timezone.utc)
-    
     # Log data to Firestore
     try:
-        # Get reference to the document
-        doc_ref = db.document(doc_path)
-        
-        # Check if document exists and get the last_update timestamp
-        doc_snapshot = doc_ref.get()
-        
-        if doc_snapshot.exists:
-            doc_data = doc_snapshot.to_dict()
-            last_update = doc_data.get('last_update')
-            
-            if last_update:
-                # Calculate time difference in seconds
-                time_diff = (current_time - last_update).total_seconds()
-                
-                # If last update was within 60 seconds, don't update
-                if time_diff < 5:
-                    logger.info(f"Data received but not logged for user_id: {user_id}, resource_id: {resource_id}. Last update was {time_diff:.1f} seconds ago (less than 60 seconds)")
-                    
-                    return https_fn.Response(
-                        json.dumps({
-                            "success": True,
-                            "message": "Data received but not logged (last update was less than 60 seconds ago)",
-                        }),
-                        status=200,
-                        headers={"Content-Type": "application/json"}
-                    )
-        
-        # Set the entry data with merge capabilities
-        doc_ref.set(request_data, merge=True)
-        
-        # Log the last_update timestamp
-        doc_ref.set({"last_update": firestore.SERVER_TIMESTAMP}, merge=True)
-        
-        # Check for threshold alerts after successful data logging
+        # Latest payload, last_update, window aggregates and every buffered history sample in one RPC
         try:
-            # Get user settings for notification preferences
-            user_doc = db.collection('users').document(user_id).get()
-            if user_doc.exists:
-                user_settings = user_doc.to_dict()
-                
-                # Get resource name from document or use resource_id as fallback
-                resource_doc_data = doc_ref.get().to_dict()
-                resource_name = resource_doc_data.get('title', resource_id) if resource_doc_data else resource_id
-                
-                # Check and send threshold alerts
-                check_and_send_threshold_alerts(
-                    user_id=user_id,
-                    resource_id=resource_id,
-                    resource_name=resource_name,
-                    available_cpu_percent=available_cpu_percent,
-                    available_memory_percent=available_memory_percent,
-                    user_settings=user_settings
-                )
-        except Exception as e:
-            logger.error(f"Failed to check threshold alerts for user_id: {user_id}, resource_id: {resource_id}. Error: {str(e)}")
+            with span('firestore_write'):
+                writes = flush_pending(db, pending)
+        except NotFound:
+            # The resource was deleted: the cached token is stale and nothing must be recreated
+            write_buffer.discard(user_id, resource_id)
+            invalidate_token(token)
+            logger.warn(f"Stale token cache entry for user_id: {user_id}, resource_id: {resource_id}")
+            return https_fn.Response(
+                json.dumps({"error": "Invalid or unauthorized token"}),
+                status=401,
+                headers={"Content-Type": "application/json"}
+            )
+        except Exception:
+            write_buffer.requeue(pending)
+            raise
+        record_write(writes)
+        
+        if alert_job is not None:
+            with span('alert_enqueue'):
+                get_alert_queue().enqueue(alert_job)
         
         # Log successful data logging
-        logger.info(f"Data logged successfully for user_id: {user_id}, resource_id: {resource_id}")
+        logger.info(f"Data logged successfully for user_id: {user_id}, resource_id: {resource_id} ({len(pending.samples)} samples)", firestore_ops=ops.as_dict())
         
         return https_fn.Response(
             json.dumps({
@@ -240,6 +395,150 @@ def ingest(req: https_fn.Request) -> https_fn.Response:
         ) 
 
 
+@https_fn.on_request()
+def ingest_batch(req: https_fn.Request) -> https_fn.Response:
+    """
+    Firebase function that ingests the metrics of many resources in one POST request.
+    The body is a JSON array or NDJSON of {"token": ..., "metrics": [...]} envelopes; every
+    envelope gets its own status, in body order.
+    """
+    start_timer('ingest_batch')
+    annotate(payload_bytes=req.content_length)
+    response = _ingest_batch(req)
+    with span('flush_due'):
+        flush_due_windows()
+    finish_timer(response)
+    return response
+
+
+def _ingest_batch(req: https_fn.Request) -> https_fn.Response:
+    db = get_db()
+    ops = start_op_counter()
+    
+    # Only allow POST requests
+    if req.method != 'POST':
+        return https_fn.Response(
+            json.dumps({"error": "Only POST requests are allowed"}),
+            status=405,
+            headers={"Content-Type": "application/json"}
+        )
+    
+    try:
+        with span('decode'):
+            envelopes = decode_envelopes(req.stream, content_encoding=req.headers.get('Content-Encoding'))
+    except BodyDecodingError as e:
+        return https_fn.Response(
+            json.dumps({"error": str(e)}),
+            status=e.status,
+            headers={"Content-Type": "application/json"}
+        )
+    
+    current_time = datetime.now(timezone.utc)
+    results: List[Dict[str, Any]] = [{} for _ in envelopes]
+    annotate(envelopes=len(envelopes))
+    
+    # Every envelope is rate limited on its own token before any token is resolved
+    admitted: List[int] = []
+    for index, envelope in enumerate(envelopes):
+        token = envelope.get('token') if isinstance(envelope, dict) else None
+        if not isinstance(token, str) or not token or not valid_metrics(envelope.get('metrics')):
+            results[index] = {"status": 400, "error": "Envelope must be an object with a 'token' and a 'metrics' array"}
+            continue
+        with span('rate_limit'):
+            wait = ingest_limiter.admit(hash_token(token))
+        if wait is not None:
+            results[index] = {"status": 429, "error": "Rate limit exceeded", "retry_after": int(retry_after_header(wait))}
+            continue
+        admitted.append(index)
+    
+    # One multi-get on the token index for every token this instance has not cached
+    try:
+        with span('token'):
+            owners = resolve_tokens(db, [envelopes[index]['token'] for index in admitted])
+    except Exception as e:
+        logger.error(f"Token verification failed for batch of {len(admitted)} envelopes. Error: {str(e)}")
+        return https_fn.Response(
+            json.dumps({"error": f"Token verification failed: {str(e)}"}),
+            status=503,
+            headers={"Content-Type": "application/json"}
+        )
+    
+    # Streaming statistics of the resources this instance has not seen, read in one background multi-get
+    with span('stream_stats'):
+        stream_tracker.preload(db, [
+            (owner.user_id, owner.resource_id) for owner in owners.values() if owner is not None
+        ])
+    
+    due: List[Tuple[int, PendingWrite]] = []
+    jobs: Dict[int, AlertJob] = {}
+    for index in admitted:
+        envelope = envelopes[index]
+        owner = owners.get(envelope['token'])
+        if owner is None:
+            results[index] = {"status": 401, "error": "Invalid or unauthorized token"}
+            continue
+        ingest_limiter.set_plan(hash_token(envelope['token']), owner.plan)
+        
+        projection = DEFAULT_PROJECTION.with_overrides(owner.projection)
+        request_data = {'metrics': keep_measurements(envelope.get('metrics'), projection.measurements | COUNTER_MEASUREMENTS)}
+        try:
+            error, pending, alert_job = buffer_metrics(db, owner, request_data, projection, current_time)
+        except Exception as e:
+            logger.error(f"Failed to process envelope for user_id: {owner.user_id}, resource_id: {owner.resource_id}. Error: {str(e)}")
+            results[index] = {"status": 500, "error": f"Failed to process metrics: {str(e)}"}
+            continue
+        if error is not None:
+            results[index] = {"status": 422, "error": error, "resource_id": owner.resource_id}
+            continue
+        
+        if alert_job is not None:
+            jobs[index] = alert_job
+        if pending is None:
+            results[index] = {"status": 200, "message": "Data received and buffered", "resource_id": owner.resource_id}
+        else:
+            due.append((index, pending))
+    
+    # The windows that are due go out together, in as few batched commits as possible
+    with span('firestore_write'):
+        written_windows = flush_pending_many(db, [pending for _, pending in due])
+    for (index, pending), written in zip(due, written_windows):
+        envelope = envelopes[index]
+        if isinstance(written, NotFound):
+            # The resource was deleted: the cached token is stale and nothing must be recreated
+            write_buffer.discard(pending.user_id, pending.resource_id)
+            invalidate_token(envelope['token'])
+            jobs.pop(index, None)
+            results[index] = {"status": 401, "error": "Invalid or unauthorized token"}
+        elif isinstance(written, Exception):
+            write_buffer.requeue(pending)
+            jobs.pop(index, None)
+            logger.error(f"Failed to log data for user_id: {pending.user_id}, resource_id: {pending.resource_id}. Error: {str(written)}")
+            results[index] = {"status": 500, "error": f"Failed to log data: {str(written)}"}
+        else:
+            record_write(written)
+            results[index] = {"status": 200, "message": "Data logged successfully", "resource_id": pending.resource_id}
+    
+    # Alerts are evaluated and delivered off the request path
+    if jobs:
+        with span('alert_enqueue'):
+            alert_queue = get_alert_queue()
+            for alert_job in jobs.values():
+                alert_queue.enqueue(alert_job)
+    
+    accepted = sum(1 for result in results if result.get('status') == 200)
+    logger.info(f"Batch ingest accepted {accepted} of {len(envelopes)} envelopes ({len(due)} windows written)", firestore_ops=ops.as_dict())
+    
+    return https_fn.Response(
+        json.dumps({
+            "success": accepted == len(envelopes),
+            "accepted": accepted,
+            "results": results,
+        }),
+        status=200,
+        headers={"Content-Type": "application/json"}
+    )
+
+
 @firestore_fn.on_document_created(document="users/{user_id}/resources/{resource_id}", secrets=[FW_EMAIL_API_KEY])
 def on_resource_created(event: firestore_fn.Event[firestore_fn.DocumentSnapshot | None]) -> None:
     """
@@ -269,7 +568,7 @@ def on_resource_created(event: firestore_fn.Event[firestore_fn.DocumentSnapshot
         resource_title = resource_data.get('title', 'Sin título')
         
         # Get the user's email from Firestore
-        db = firestore.client()
+        db = get_db()
         user_doc = db.collection('users').document(user_id).get()
         
         if not user_doc.exists:
@@ -301,3 +600,211 @@ def on_resource_created(event: firestore_fn.Event[firestore_fn.DocumentSnapshot
     except Exception as e:
         logger.error(f"Error in on_resource_created: {str(e)}")
 
+
+@firestore_fn.on_document_written(document="users/{user_id}/resources/{resource_id}")
+def on_resource_written(event: firestore_fn.Event[firestore_fn.Change[firestore_fn.DocumentSnapshot | None]]) -> None:
+    """
+    Firebase function that triggers on every resource create, update or delete.
+    Keeps the tokens/{sha256(token)} index (token, title and projection overrides) and the token
+    cache consistent with the resource, removes the resource history when the resource is deleted,
+    evaluates alert rules against the metrics stored by ingest and ends the outage of a resource
+    marked offline once it reports again.
+    Other warm ingest instances catch up within the token cache TTL (TOKEN_CACHE_TTL_SECONDS,
+    one minute by default); writes to a deleted resource fail in ingest and drop the stale entry.
+    """
+    
+    if not event.data:
+        return
+    
+    before = event.data.before.to_dict() if event.data.before and event.data.before.exists else {}
+    after = event.data.after.to_dict() if event.data.after and event.data.after.exists else {}
+    
+    user_id = event.params['user_id']
+    resource_id = event.params['resource_id']
+    
+    # Subcollections are not deleted with their parent, drop the resource history explicitly
+    if before and not after:
+        try:
+            db = get_db()
+            db.recursive_delete(history_collection(db, user_id, resource_id))
+            db.recursive_delete(rollups_collection(db, user_id, resource_id))
+            db.recursive_delete(alert_state_ref(db, user_id, resource_id).parent)
+        except Exception as e:
+            logger.error(f"Failed to delete history for user_id: {user_id}, resource_id: {resource_id}. Error: {str(e)}")
+    
+    try:
+        sync_token_index(get_db(), user_id, resource_id, before, after)
+    except Exception as e:
+        logger.error(f"Failed to update token index for user_id: {user_id}, resource_id: {resource_id}. Error: {str(e)}")
+    
+    # The first write after an outage sends the back online notification
+    if after.get('offline') and after.get('last_update') and after.get('last_update') != before.get('last_update'):
+        try:
+            notify_back_online(get_db(), user_id, resource_id, after.get('title', resource_id), after['last_update'])
+        except Exception as e:
+            logger.error(f"Failed to end outage for user_id: {user_id}, resource_id: {resource_id}. Error: {str(e)}")
+    
+    # Every ingest flush moves last_update and carries the alert values of the batches it wrote
+    if dispatches_from_trigger() and after.get('last_update') and after.get('last_update') != before.get('last_update'):
+        try:
+            for alert_job in jobs_from_write(user_id, resource_id, before, after):
+                process_alert_job(alert_job)
+        except Exception as e:
+            logger.error(f"Failed to process alerts for user_id: {user_id}, resource_id: {resource_id}. Error: {str(e)}")
+
+
+@firestore_fn.on_document_written(document="users/{user_id}/billing/plan")
+def on_plan_written(event: firestore_fn.Event[firestore_fn.Change[firestore_fn.DocumentSnapshot | None]]) -> None:
+    """
+    Firebase function that triggers when the billing plan of a user is written by the backend.
+    Copies the plan into the token index entries of the user, where ingest reads its rate limits.
+    """
+    
+    if not event.data:
+        return
+    
+    before = event.data.before.to_dict() if event.data.before and event.data.before.exists else {}
+    after = event.data.after.to_dict() if event.data.after and event.data.after.exists else {}
+    
+    if before.get('plan') == after.get('plan'):
+        return
+    
+    user_id = event.params['user_id']
+    plan = after.get('plan') if isinstance(after.get('plan'), str) and after.get('plan') else None
+    
+    try:
+        sync_token_plans(get_db(), user_id, plan)
+    except Exception as e:
+        logger.error(f"Failed to update token index plan for user_id: {user_id}. Error: {str(e)}")
+
+
+@firestore_fn.on_document_updated(document="users/{user_id}")
+def on_user_updated(event: firestore_fn.Event[firestore_fn.Change[firestore_fn.DocumentSnapshot]]) -> None:
+    """
+    Firebase function that triggers when a user document is updated.
+    When notification settings, alert rules or device tokens change, stamps the new settings
+    version on the user's resources so every instance reloads its cached settings (see
+    users/settings.py).
+    """
+    
+    if not event.data:
+        return
+    
+    before = event.data.before.to_dict() or {}
+    after = event.data.after.to_dict() or {}
+    
+    if not settings_changed(before, after):
+        return
+    
+    user_id = event.params['user_id']
+    version = event.data.after.update_time
+    remember_user_settings(user_id, after, version)
+    
+    try:
+        stamp_settings_version(get_db(), user_id, version)
+    except Exception as e:
+        logger.error(f"Failed to stamp settings version for user_id: {user_id}. Error: {str(e)}")
+
+
+@tasks_fn.on_task_dispatched(
+    retry_config=RetryConfig(max_attempts=5, min_backoff_seconds=30),
+    rate_limits=RateLimits(max_concurrent_dispatches=10),
+)
+def deliver_alert_digest(req: tasks_fn.CallableRequest) -> None:
+    """
+    Task queue function that delivers the alert digest of a user once its window has passed.
+    Enqueued by the first alert transition of the window (see alerts/digest.py).
+    """
+    
+    user_id = (req.data or {}).get('user_id')
+    if not user_id:
+        logger.error("Alert digest task without user_id")
+        return
+    
+    send_alert_digest(user_id)
+
+
+@scheduler_fn.on_schedule(schedule="every 5 minutes", timezone=scheduler_fn.Timezone("UTC"), timeout_sec=300)
+def deliver_overdue_digests(event: scheduler_fn.ScheduledEvent) -> None:
+    """
+    Scheduled function that delivers the alert digests whose scheduled delivery was lost
+    (see alerts/digest.py).
+    """
+    
+    try:
+        user_ids = overdue_digests(get_db(), datetime.now(timezone.utc).timestamp())
+    except Exception as e:
+        logger.error(f"Failed to find overdue alert digests: {str(e)}")
+        return
+    
+    for user_id in user_ids:
+        logger.warn(f"Delivering overdue alert digest of user: {user_id}")
+        try:
+            send_alert_digest(user_id)
+        except Exception as e:
+            logger.error(f"Failed to deliver overdue alert digest of user: {user_id}. Error: {str(e)}")
+
+
+@scheduler_fn.on_schedule(schedule="every 2 minutes", timezone=scheduler_fn.Timezone("UTC"), timeout_sec=540)
+def detect_offline_resources(event: scheduler_fn.ScheduledEvent) -> None:
+    """
+    Scheduled function that marks resources offline once their offline_at deadline passed and
+    sends one offline notification per user (see alerts/offline.py).
+    """
+    
+    try:
+        marked = sweep_offline(get_db(), datetime.now(timezone.utc))
+        if marked:
+            logger.info(f"Offline sweep marked {marked} resources offline")
+    except Exception as e:
+        logger.error(f"Failed to sweep offline resources: {str(e)}")
+
+
+@scheduler_fn.on_schedule(schedule="5 * * * *", timezone=scheduler_fn.Timezone("UTC"), timeout_sec=900)
+def rollup_history(event: scheduler_fn.ScheduledEvent) -> None:
+    """
+    Scheduled function that rolls up the previous UTC hour of history.
+    Writes the 1m, 5m and 1h rollup points of every resource that reported during that hour.
+    """
+    
+    hour = datetime.now(timezone.utc) - timedelta(hours=1)
+    
+    try:
+        written = rollup_hour(get_db(), hour)
+        logger.info(f"History rolled up for {hour.strftime('%Y-%m-%d %H:00')}: {written} rollup documents")
+    except Exception as e:
+        logger.error(f"Failed to roll up history for {hour.strftime('%Y-%m-%d %H:00')}: {str(e)}")
+
+
+@scheduler_fn.on_schedule(schedule="every day 00:30", timezone=scheduler_fn.Timezone("UTC"), timeout_sec=1800)
+def compact_history(event: scheduler_fn.ScheduledEvent) -> None:
+    """
+    Scheduled function that compacts the previous UTC day of history.
+    Writes the exact 1d rollup point and the daily summary of every resource that reported and
+    packs the day's raw buckets into parallel arrays. Raw buckets and fine rollups then expire
+    through TTL policies.
+    """
+    
+    day = datetime.now(timezone.utc) - timedelta(days=1)
+    
+    try:
+        compacted = compact_day(get_db(), day)
+        logger.info(f"History compacted for {day.date().isoformat()}: {compacted} raw buckets")
+    except Exception as e:
+        logger.error(f"Failed to compact history for {day.date().isoformat()}: {str(e)}")
+
+
+@scheduler_fn.on_schedule(schedule="every day 06:00", timezone=scheduler_fn.Timezone("UTC"), timeout_sec=1800, secrets=[FW_EMAIL_API_KEY])
+def send_daily_report(event: scheduler_fn.ScheduledEvent) -> None:
+    """
+    Scheduled function that emails the report of the previous UTC day to every user who opted in.
+    Runs after compact_history has stored the daily summaries of the resources.
+    """
+    
+    day = datetime.now(timezone.utc) - timedelta(days=1)
+    
+    try:
+        sent = send_daily_reports(get_db(), day, get_mail_client(FW_EMAIL_API_KEY.value))
+        logger.info(f"Daily reports sent for {day.date().isoformat()}: {sent}")
+    except Exception as e:
+        logger.error(f"Failed to send daily reports for {day.date().isoformat()}: {str(e)}")
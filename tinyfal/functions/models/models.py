@@ -2,84 +2,280 @@
 Models for processing resource data similar to resource.dart
 """
 import math
-from typing import List, Dict, Any, Optional
+from typing import List, Dict, Any, Optional, Tuple, Union
 from firebase_functions import logger
 
 
-def get_by_name(data: List[Dict[str, Any]], name: str) -> List[Dict[str, Any]]:
+class Metric:
+    """
+    A single Telegraf metric (one entry of the 'metrics' array)
+    """
+
+    __slots__ = ('name', 'tags', 'fields', 'timestamp')
+
+    def __init__(self, name: str, tags: Dict[str, Any], fields: Dict[str, Any], timestamp: Any = None):
+        self.name = name
+        self.tags = tags
+        self.fields = fields
+        self.timestamp = timestamp
+
+    def number(self, field: str) -> Optional[float]:
+        """
+        Get a numeric field value
+
+        Args:
+            field: The field name
+
+        Returns:
+            The value as float or None if missing or not a number
+        """
+        value = self.fields.get(field)
+        if isinstance(value, bool) or not isinstance(value, (int, float)):
+            return None
+        return float(value)
+
+    def as_dict(self) -> Dict[str, Any]:
+        """Get the metric back in the Telegraf JSON shape."""
+        return {'name': self.name, 'tags': self.tags, 'fields': self.fields, 'timestamp': self.timestamp}
+
+
+class MetricsBatch:
+    """
+    A Telegraf JSON batch indexed once by measurement name and by tag.
+
+    Building the batch is a single pass over the metrics array; every lookup afterwards is a
+    dictionary access, so extracting many values from a large batch (percpu, many disks,
+    interfaces and containers) no longer rescans the whole array per value.
+    """
+
+    __slots__ = ('_by_name', '_by_tag', 'size')
+
+    def __init__(self, data: Optional[List[Dict[str, Any]]]):
+        """
+        Args:
+            data: List of dictionaries containing resource metrics data
+        """
+        self._by_name: Dict[str, List[Metric]] = {}
+        self._by_tag: Dict[Tuple[str, str, Any], Metric] = {}
+        self.size = 0
+        self.extend(data)
+
+    def extend(self, data: Optional[List[Dict[str, Any]]]) -> None:
+        """
+        Index more metrics, e.g. derived ones
+
+        Args:
+            data: List of dictionaries containing resource metrics data
+        """
+        by_name = self._by_name
+        by_tag = self._by_tag
+
+        for item in data or ():
+            if not isinstance(item, dict):
+                continue
+
+            name = item.get('name')
+            tags = item.get('tags') or {}
+            metric = Metric(name, tags, item.get('fields') or {}, item.get('timestamp'))
+            self.size += 1
+
+            entries = by_name.get(name)
+            if entries is None:
+                by_name[name] = [metric]
+            else:
+                entries.append(metric)
+
+            # Keep the first metric per tag value, like the list scans in resource.dart
+            for tag, value in tags.items():
+                by_tag.setdefault((name, tag, value), metric)
+
+    def __len__(self) -> int:
+        return self.size
+
+    def names(self) -> List[str]:
+        """Get the measurement names present in the batch."""
+        return list(self._by_name)
+
+    def get_by_name(self, name: str) -> List[Metric]:
+        """
+        Get all metrics with a given measurement name
+
+        Args:
+            name: The measurement name (e.g. 'cpu', 'disk')
+
+        Returns:
+            List of metrics in batch order (empty if none)
+        """
+        return self._by_name.get(name, [])
+
+    def first(self, name: str) -> Optional[Metric]:
+        """
+        Get the first metric with a given measurement name
+
+        Args:
+            name: The measurement name
+
+        Returns:
+            The metric or None if not found
+        """
+        entries = self._by_name.get(name)
+        return entries[0] if entries else None
+
+    def find(self, name: str, tag: str, value: Any) -> Optional[Metric]:
+        """
+        Get the first metric of a measurement carrying a given tag value
+
+        Args:
+            name: The measurement name
+            tag: The tag key (e.g. 'cpu', 'path', 'interface')
+            value: The tag value to match
+
+        Returns:
+            The metric or None if not found
+        """
+        return self._by_tag.get((name, tag, value))
+
+    def first_with_field(self, name: str, field: str) -> Optional[Metric]:
+        """
+        Get the first metric of a measurement that reports a given field
+
+        Args:
+            name: The measurement name
+            field: The field that must be present
+
+        Returns:
+            The metric or None if not found
+        """
+        for metric in self._by_name.get(name, ()):
+            if field in metric.fields:
+                return metric
+        return None
+
+
+MetricsData = Union[MetricsBatch, List[Dict[str, Any]]]
+
+
+def as_batch(data: MetricsData) -> MetricsBatch:
+    """
+    Get an indexed batch from either a raw metrics list or an existing batch
+
+    Args:
+        data: List of resource metric dictionaries or a MetricsBatch
+
+    Returns:
+        The indexed MetricsBatch
+    """
+    return data if isinstance(data, MetricsBatch) else MetricsBatch(data)
+
+
+def get_by_name(data: MetricsData, name: str) -> List[Dict[str, Any]]:
     """
     Get all maps with a given 'name' attribute
-    
+
     Args:
         data: List of dictionaries containing resource metrics data
         name: The name to filter by
-        
+
     Returns:
         List of dictionaries matching the name
     """
-    return [item for item in data if item.get('name') == name]
+    return [metric.as_dict() for metric in as_batch(data).get_by_name(name)]
 
 
-def get_mem_data(data: List[Dict[str, Any]]) -> Optional[Dict[str, Any]]:
+def get_mem_data(data: MetricsData) -> Optional[Dict[str, Any]]:
     """
     Get memory data entry
-    
+
     Args:
         data: List of dictionaries containing resource metrics data
-        
+
     Returns:
         Memory data dictionary or None if not found
     """
-    mem_list = get_by_name(data, 'mem')
-    return mem_list[0] if mem_list else None
+    mem = as_batch(data).first('mem')
+    return mem.as_dict() if mem else None
 
 
-def get_cpu_total_data(data: List[Dict[str, Any]]) -> Optional[Dict[str, Any]]:
+def get_cpu_total_data(data: MetricsData) -> Optional[Dict[str, Any]]:
     """
     Get CPU total data entry (cpu-total)
-    
+
     Args:
         data: List of dictionaries containing resource metrics data
-        
+
     Returns:
         CPU total data dictionary or None if not found
     """
-    cpu_list = get_by_name(data, 'cpu')
-    # Look for the cpu-total entry specifically
-    for cpu in cpu_list:
-        tags = cpu.get('tags', {})
-        if tags.get('cpu') == 'cpu-total':
-            return cpu
-    return None
+    cpu = as_batch(data).find('cpu', 'cpu', 'cpu-total')
+    return cpu.as_dict() if cpu else None
+
+
+def get_root_disk(batch: MetricsBatch) -> Optional[Metric]:
+    """
+    Get the root disk (path="/"), or the first disk if there is no root mount
+
+    Args:
+        batch: The indexed metrics batch
+
+    Returns:
+        The disk metric or None if not found
+    """
+    return batch.find('disk', 'path', '/') or batch.first('disk')
+
+
+def get_primary_network_interface(batch: MetricsBatch) -> Optional[Metric]:
+    """
+    Get the primary network interface (equivalent to primaryNetworkInterface in Dart),
+    skipping loopback and Docker/bridge/veth interfaces
+
+    Args:
+        batch: The indexed metrics batch
+
+    Returns:
+        The net metric or None if not found
+    """
+    interfaces = batch.get_by_name('net')
+    for interface in interfaces:
+        name = interface.tags.get('interface')
+        if (
+            isinstance(name, str)
+            and not name.startswith(('docker', 'br-', 'veth'))
+            and name not in ('lo', 'all')
+        ):
+            return interface
+
+    # Fallback to first interface if no primary found
+    return interfaces[0] if interfaces else None
 
 
-def extract_available_memory_percent(data: List[Dict[str, Any]]) -> Optional[int]:
+def extract_available_memory_percent(data: MetricsData) -> Optional[int]:
     """
     Extract available memory percentage from resource data (equivalent to availableMemoryPercent in Dart)
-    
+
     Args:
         data: List of resource metric dictionaries
-        
+
     Returns:
         Available memory percentage as integer (rounded up) or None if not available
     """
-    logger.info(f"Extracting available memory percent from data with {len(data)} entries")
-    
-    mem_data = get_mem_data(data)
+    batch = as_batch(data)
+    logger.info(f"Extracting available memory percent from data with {len(batch)} entries")
+
+    mem_data = batch.first('mem')
     if mem_data is None:
         logger.warn("No memory data found in resource metrics")
         return None
-    
-    fields = mem_data.get('fields', {})
+
+    fields = mem_data.fields
     if not fields:
         logger.warn("No fields found in memory data")
         return None
-    
+
     available_percent = fields.get('available_percent')
     if available_percent is None:
         logger.warn("available_percent field not found in memory data fields")
         return None
-    
+
     # Convert to number and round up (ceiling)
     if isinstance(available_percent, (int, float)):
         result = math.ceil(float(available_percent))
@@ -87,71 +283,254 @@ def extract_available_memory_percent(data: List[Dict[str, Any]]) -> Optional[int
         return result
     else:
         logger.error(f"available_percent is not a number: {type(available_percent).__name__} = {available_percent}")
-    
+
     return None
 
 
-def extract_cpu_usage_percent(data: List[Dict[str, Any]]) -> Optional[int]:
+def extract_used_memory_percent(data: MetricsData) -> Optional[int]:
+    """
+    Extract used memory percentage (equivalent to usedMemoryPercent in Dart, btop style)
+
+    Args:
+        data: List of resource metric dictionaries or a MetricsBatch
+
+    Returns:
+        Used memory percentage as integer or None if not available
+    """
+    mem = as_batch(data).first('mem')
+    if mem is None:
+        return None
+
+    available_percent = mem.number('available_percent')
+    if available_percent is None:
+        return None
+
+    return 100 - math.floor(available_percent)
+
+
+def extract_cpu_usage_percent(data: MetricsData) -> Optional[int]:
     """
     Extract CPU usage percentage from resource data (calculated as: 100 - idle_usage)
-    
+
     Args:
         data: List of resource metric dictionaries
-        
+
     Returns:
         CPU usage percentage as integer (rounded up) or None if not available
     """
-    cpu_data = get_cpu_total_data(data)
+    cpu_data = as_batch(data).find('cpu', 'cpu', 'cpu-total')
     if cpu_data is None:
         return None
-    
-    fields = cpu_data.get('fields', {})
-    if not fields:
-        return None
-    
-    idle_usage = fields.get('usage_idle')
+
+    idle_usage = cpu_data.number('usage_idle')
     if idle_usage is None:
         return None
-    
-    if isinstance(idle_usage, (int, float)):
-        used_percent = 100.0 - float(idle_usage)
-        result = math.ceil(used_percent)
-        # Clamp between 0 and 100
-        result = max(0, min(100, result))
-        
-        # Handle anomalous 0% readings (similar to Dart logic)
-        if result == 0:
-            # In a real implementation, you might want to check timestamp
-            # For now, we'll just return the result
-            pass
-        
-        return result
-    
-    return None
+
+    used_percent = 100.0 - idle_usage
+    result = math.ceil(used_percent)
+    # Clamp between 0 and 100
+    return max(0, min(100, result))
 
 
-def extract_cpu_available_percent(data: List[Dict[str, Any]]) -> Optional[int]:
+def extract_cpu_available_percent(data: MetricsData) -> Optional[int]:
     """
     Extract available CPU percentage from resource data (calculated as: 100 - cpu_usage)
     This is the inverse of CPU usage, representing available CPU capacity
-    
+
     Args:
         data: List of resource metric dictionaries
-        
+
     Returns:
         Available CPU percentage as integer or None if not available
     """
     cpu_usage = extract_cpu_usage_percent(data)
     if cpu_usage is None:
         return None
-    
+
     # Available CPU is the inverse of used CPU
     cpu_available = 100 - cpu_usage
     return max(0, min(100, cpu_available))
 
 
+def extract_swap_used_percent(data: MetricsData) -> Optional[int]:
+    """
+    Extract used swap percentage (equivalent to usedSwapPercent in Dart, btop style)
+
+    Args:
+        data: List of resource metric dictionaries or a MetricsBatch
+
+    Returns:
+        Used swap percentage as integer (rounded up), 0 if no swap is configured, or None
+    """
+    swap = as_batch(data).first('swap')
+    if swap is None:
+        return None
+
+    total = swap.number('total')
+    free = swap.number('free')
+    if total is None or free is None:
+        return None
+
+    # No swap configured
+    if total == 0:
+        return 0
+
+    return max(0, min(100, math.ceil((total - free) / total * 100)))
+
+
+def extract_disk_usage_percent(data: MetricsData) -> Optional[int]:
+    """
+    Extract root disk usage percentage (equivalent to diskUsagePercent in Dart, btop style)
+
+    Args:
+        data: List of resource metric dictionaries or a MetricsBatch
+
+    Returns:
+        Disk usage percentage as integer (rounded up) or None if not available
+    """
+    disk = get_root_disk(as_batch(data))
+    if disk is None:
+        return None
+
+    total = disk.number('total')
+    free = disk.number('free')
+    if total is None or free is None or total == 0:
+        return None
+
+    return max(0, min(100, math.ceil((total - math.floor(free)) / total * 100)))
+
+
+def extract_load_average(data: MetricsData, window: str = 'load1') -> Optional[float]:
+    """
+    Extract a system load average (equivalent to load1/load5/load15 in Dart)
+
+    Args:
+        data: List of resource metric dictionaries or a MetricsBatch
+        window: One of 'load1', 'load5' or 'load15'
+
+    Returns:
+        Load average as float or None if not available
+    """
+    system = as_batch(data).first_with_field('system', window)
+    return system.number(window) if system else None
+
+
+def extract_process_count(data: MetricsData, state: str = 'total') -> Optional[int]:
+    """
+    Extract a process count (equivalent to totalProcesses, zombieProcesses, ... in Dart)
+
+    Args:
+        data: List of resource metric dictionaries or a MetricsBatch
+        state: Telegraf processes field, e.g. 'total', 'running', 'sleeping', 'zombies', 'total_threads'
+
+    Returns:
+        Process count as integer or None if not available
+    """
+    processes = as_batch(data).first('processes')
+    if processes is None:
+        return None
+
+    value = processes.number(state)
+    return int(value) if value is not None else None
+
 
-    
+def extract_zombie_processes(data: MetricsData) -> Optional[int]:
+    """
+    Extract the number of zombie processes (equivalent to zombieProcesses in Dart)
+
+    Args:
+        data: List of resource metric dictionaries or a MetricsBatch
+
+    Returns:
+        Zombie process count or None if not available
+    """
+    return extract_process_count(data, 'zombies')
+
+
+def extract_docker_containers(data: MetricsData, state: str = 'n_containers') -> Optional[int]:
+    """
+    Extract a Docker container count (equivalent to dockerContainersTotal/Running/Stopped/Paused in Dart)
+
+    Args:
+        data: List of resource metric dictionaries or a MetricsBatch
+        state: Telegraf docker field, e.g. 'n_containers', 'n_containers_running', 'n_containers_stopped'
+
+    Returns:
+        Container count as integer or None if not available
+    """
+    docker = as_batch(data).first('docker')
+    if docker is None:
+        return None
+
+    value = docker.number(state)
+    return int(value) if value is not None else None
+
+
+def extract_network_rates(data: MetricsData) -> Optional[Tuple[float, float]]:
+    """
+    Extract the receive and send rates of the primary network interface, as derived by
+    models.rates from the byte counters
+
+    Args:
+        data: List of resource metric dictionaries or a MetricsBatch
+
+    Returns:
+        Tuple (received, sent) in MB/s or None if not available
+    """
+    batch = as_batch(data)
+    interface = get_primary_network_interface(batch)
+    if interface is None:
+        return None
+
+    rates = batch.find('net_rate', 'interface', interface.tags.get('interface'))
+    if rates is None:
+        return None
+
+    received = rates.number('bytes_recv')
+    sent = rates.number('bytes_sent')
+    if received is None or sent is None:
+        return None
+
+    return received / 1e6, sent / 1e6
+
+
+def extract_disk_io_rates(data: MetricsData) -> Optional[Tuple[float, float]]:
+    """
+    Extract the read and write rates summed over every disk device, as derived by models.rates
+
+    Args:
+        data: List of resource metric dictionaries or a MetricsBatch
+
+    Returns:
+        Tuple (read, written) in MB/s or None if not available
+    """
+    devices = as_batch(data).get_by_name('diskio_rate')
+    if not devices:
+        return None
+
+    read = sum(device.number('read_bytes') or 0.0 for device in devices)
+    written = sum(device.number('write_bytes') or 0.0 for device in devices)
+    return read / 1e6, written / 1e6
+
+
+def extract_anomaly_score(data: MetricsData, field: Optional[str] = None) -> Optional[float]:
+    """
+    Extract an anomaly score computed at ingest by history.streaming
+
+    Args:
+        data: List of resource metric dictionaries or a MetricsBatch
+        field: Field to get the score of (e.g. 'cpu'), or None for the highest score
 
+    Returns:
+        Score in standard deviations from the mean, or None if not available
+    """
+    anomaly = as_batch(data).first('anomaly')
+    if anomaly is None:
+        return None
 
+    if field is not None:
+        return anomaly.number(field)
 
+    scores = [anomaly.number(name) for name in anomaly.fields]
+    scores = [score for score in scores if score is not None]
+    return max(scores) if scores else None
@@ -0,0 +1,190 @@
+"""
+Projection of Telegraf batches down to the measurements and fields the app renders.
+
+Ingest stores the projected metrics instead of the raw batch, which keeps resource documents
+small (nstat counters, per-core CPU entries and most per-interface counters are never shown) and far
+from Firestore's 1 MiB document limit.
+"""
+from typing import Any, Dict, FrozenSet, Iterable, List, Optional
+
+
+class MeasurementRule:
+    """
+    How one measurement is stored
+
+    Attributes:
+        fields: Field names to keep, or None to keep every field
+        tag_filter: Optional (tag, allowed values) pair; other series of the measurement are dropped
+    """
+
+    __slots__ = ('fields', 'tag_filter')
+
+    def __init__(self, fields: Optional[Iterable[str]] = None, tag_filter: Optional[tuple] = None):
+        self.fields = frozenset(fields) if fields is not None else None
+        self.tag_filter = (tag_filter[0], frozenset(tag_filter[1])) if tag_filter else None
+
+    def apply(self, metric: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        """
+        Project a single metric
+
+        Args:
+            metric: Telegraf metric dictionary
+
+        Returns:
+            The projected metric, or None if it should not be stored
+        """
+        tags = metric.get('tags') or {}
+        if self.tag_filter is not None:
+            tag, allowed = self.tag_filter
+            if tags.get(tag) not in allowed:
+                return None
+
+        fields = metric.get('fields') or {}
+        if self.fields is not None:
+            fields = {key: value for key, value in fields.items() if key in self.fields}
+            # e.g. the net 'interface=all' series, which only carries protocol counters
+            if not fields:
+                return None
+
+        projected = {'name': metric.get('name'), 'tags': tags, 'fields': fields}
+        if 'timestamp' in metric:
+            projected['timestamp'] = metric['timestamp']
+        return projected
+
+
+# Fields read by Status in lib/src/models/resource.dart and the resource views
+DEFAULT_RULES: Dict[str, MeasurementRule] = {
+    'cpu': MeasurementRule(
+        ('usage_idle', 'usage_user', 'usage_system', 'usage_iowait'),
+        tag_filter=('cpu', ('cpu-total',)),
+    ),
+    'mem': MeasurementRule(('available_percent', 'buffered', 'cached', 'total', 'used')),
+    'swap': MeasurementRule(('total', 'free', 'used')),
+    'system': MeasurementRule(
+        ('load1', 'load5', 'load15', 'n_cpus', 'n_unique_users', 'uptime', 'uptime_format'),
+    ),
+    'disk': MeasurementRule(
+        ('total', 'free', 'used', 'inodes_total', 'inodes_used', 'inodes_free', 'inodes_used_percent'),
+    ),
+    'net': MeasurementRule(
+        ('bytes_recv', 'bytes_sent', 'packets_recv', 'packets_sent',
+         'drop_in', 'drop_out', 'err_in', 'err_out', 'speed'),
+    ),
+    'netstat': MeasurementRule(
+        ('tcp_established', 'tcp_listen', 'tcp_time_wait', 'tcp_close_wait', 'udp_socket'),
+    ),
+    'processes': MeasurementRule(
+        ('total', 'running', 'sleeping', 'idle', 'zombies', 'total_threads'),
+    ),
+    'docker': MeasurementRule(
+        ('n_containers', 'n_containers_running', 'n_containers_stopped', 'n_containers_paused', 'n_images'),
+    ),
+    'docker_container_status': MeasurementRule(('uptime_ns', 'pid', 'exitcode', 'started_at')),
+    'docker_container_health': MeasurementRule(('health_status', 'failing_streak')),
+    'docker_container_mem': MeasurementRule(('usage', 'usage_percent', 'limit')),
+    'docker_container_cpu': MeasurementRule(('usage_percent',), tag_filter=('cpu', ('cpu-total',))),
+    'docker_container_net': MeasurementRule(('rx_bytes', 'tx_bytes')),
+    'docker_container_blkio': MeasurementRule(
+        ('io_service_bytes_recursive_read', 'io_service_bytes_recursive_write'),
+    ),
+}
+
+
+class Projection:
+    """
+    A set of measurement rules. Measurements without a rule are dropped.
+    """
+
+    __slots__ = ('rules', 'measurements')
+
+    def __init__(self, rules: Dict[str, MeasurementRule]):
+        self.rules = rules
+        self.measurements: FrozenSet[str] = frozenset(rules)
+
+    def with_overrides(self, overrides: Optional[Dict[str, Any]]) -> 'Projection':
+        """
+        Build a projection adjusted by a per-resource override map.
+
+        The resource document may hold a `projection` map of measurement name to:
+            true   keep the measurement with every field and series
+            false  drop the measurement
+            [..]   keep only the listed fields
+
+        Args:
+            overrides: The override map (None or empty returns this projection)
+
+        Returns:
+            The adjusted projection
+        """
+        if not overrides or not isinstance(overrides, dict):
+            return self
+
+        rules = dict(self.rules)
+        for name, setting in overrides.items():
+            if setting is True:
+                rules[name] = MeasurementRule()
+            elif setting is False:
+                rules.pop(name, None)
+            elif isinstance(setting, list):
+                rules[name] = MeasurementRule(str(field) for field in setting)
+        return Projection(rules)
+
+    def apply(self, metrics: Iterable[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """
+        Project a metrics array
+
+        Args:
+            metrics: Telegraf metric dictionaries
+
+        Returns:
+            The metrics worth storing, in batch order
+        """
+        projected = []
+        rules = self.rules
+        for metric in metrics:
+            if not isinstance(metric, dict):
+                continue
+            rule = rules.get(metric.get('name'))
+            if rule is None:
+                continue
+            stored = rule.apply(metric)
+            if stored is not None:
+                projected.append(stored)
+        return projected
+
+
+DEFAULT_PROJECTION = Projection(DEFAULT_RULES)
+
+
+def projection_for(resource_data: Optional[Dict[str, Any]]) -> Projection:
+    """
+    Get the projection to use for a resource, honouring its `projection` override map
+
+    Args:
+        resource_data: The resource document data
+
+    Returns:
+        The effective projection
+    """
+    if not resource_data:
+        return DEFAULT_PROJECTION
+    return DEFAULT_PROJECTION.with_overrides(resource_data.get('projection'))
+
+
+def project_payload(request_data: Dict[str, Any], projection: Projection = DEFAULT_PROJECTION) -> Dict[str, Any]:
+    """
+    Project a decoded ingest body down to the keys stored on the resource document.
+    Other top-level keys are dropped, so a body cannot overwrite resource fields such as
+    `token`, `title` or `offline`.
+
+    Args:
+        request_data: The decoded request body
+        projection: The projection to apply
+
+    Returns:
+        The body to store
+    """
+    metrics = request_data.get('metrics')
+    if not isinstance(metrics, list):
+        return {}
+    return {'metrics': projection.apply(metrics)}
@@ -0,0 +1,248 @@
+"""
+Server-side rates of the Telegraf counters (net, diskio).
+
+Telegraf reports network and disk I/O as monotonically increasing counters, so a single snapshot
+only holds totals. Ingest keeps the previous counters of each resource in a compact per-instance
+cache: one tuple of (measurement, series, field) keys, shared between samples while the layout
+of the batch does not change, and one array of values. The next batch turns the difference into
+per-second rates for every interface and device in one pass over the parallel arrays, stored with
+the snapshot as extra measurements:
+
+    {"name": "net_rate", "tags": {"interface": "eth0"}, "fields": {"bytes_recv": 1250.5, ...}}
+    {"name": "diskio_rate", "tags": {"name": "sda"}, "fields": {"read_bytes": 4096.0, ...}}
+
+A batch holds a few dozen counters, so the pass is plain Python: NumPy is deliberately kept off
+the ingest path, where importing it would cost more than the arithmetic (only rollups use it).
+
+A counter lower than its previous value either wrapped (32 or 64 bit, when the previous value was
+close to the limit) or was reset by a reboot, in which case the counter value itself is the
+increase since the reset. A reboot resets every counter of an interface or device, while a wrap
+only affects the counters that reached the limit, so when any counter of a series went down from
+a value that cannot wrap the whole series is taken as reset. This keeps a 64-bit counter that was
+close to 2^32 when the host rebooted from being read as a 32-bit wrap. A resource whose previous
+sample is on another instance, or older than RATE_MAX_GAP_SECONDS, gets rates from its next batch.
+"""
+import os
+from array import array
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+from cache.cache import TTLCache
+from models.models import MetricsBatch
+
+
+RATE_CACHE_MAX_SIZE = int(os.environ.get('RATE_CACHE_MAX_SIZE', '20000'))
+RATE_MAX_GAP_SECONDS = float(os.environ.get('RATE_MAX_GAP_SECONDS', '900'))
+
+# Measurement -> (series tag, counter fields)
+COUNTERS: Dict[str, Tuple[str, Tuple[str, ...]]] = {
+    'net': ('interface', ('bytes_recv', 'bytes_sent', 'packets_recv', 'packets_sent',
+                          'err_in', 'err_out', 'drop_in', 'drop_out')),
+    'diskio': ('name', ('read_bytes', 'write_bytes', 'reads', 'writes')),
+}
+
+# Decoded at ingest whatever the projection stores, so that every counter reaches the tracker
+COUNTER_MEASUREMENTS = frozenset(COUNTERS)
+
+RATE_SUFFIX = '_rate'
+
+# A decrease from above this share of a counter width is a wrap, otherwise a reset
+WRAP_THRESHOLD = 0.75
+COUNTER_WIDTHS = (2.0 ** 32, 2.0 ** 64)
+
+CounterKey = Tuple[str, str, str]
+
+
+class CounterSample:
+    """
+    Counters of one batch
+
+    Attributes:
+        keys: (measurement, series, field) of every counter
+        values: Counter values, parallel to keys
+        ts: Sample time (unix seconds)
+    """
+
+    __slots__ = ('keys', 'values', 'ts')
+
+    def __init__(self, keys: Tuple[CounterKey, ...], values: array, ts: float):
+        self.keys = keys
+        self.values = values
+        self.ts = ts
+
+
+def _seconds(timestamp: Any) -> Optional[float]:
+    """Get a Telegraf timestamp in seconds, whether it was sent in s, ms, us or ns."""
+    if isinstance(timestamp, bool) or not isinstance(timestamp, (int, float)) or timestamp <= 0:
+        return None
+    while timestamp > 1e11:
+        timestamp /= 1000
+    return float(timestamp)
+
+
+def collect_counters(batch: MetricsBatch) -> Tuple[Tuple[CounterKey, ...], List[float], Optional[float]]:
+    """
+    Flatten the counters of a batch
+
+    Args:
+        batch: The indexed metrics batch
+
+    Returns:
+        The counter keys, their values and the latest metric timestamp (None if no metric has one)
+    """
+    keys: List[CounterKey] = []
+    values: List[float] = []
+    ts: Optional[float] = None
+    for measurement, (tag, fields) in COUNTERS.items():
+        for metric in batch.get_by_name(measurement):
+            series = metric.tags.get(tag)
+            # The net 'interface=all' series only carries protocol counters
+            if not isinstance(series, str) or series == 'all':
+                continue
+            for field in fields:
+                value = metric.number(field)
+                if value is not None:
+                    keys.append((measurement, series, field))
+                    values.append(value)
+            metric_ts = _seconds(metric.timestamp)
+            if metric_ts is not None and (ts is None or metric_ts > ts):
+                ts = metric_ts
+    return tuple(keys), values, ts
+
+
+def counter_increase(previous: float, current: float, reset: bool = False) -> float:
+    """
+    Get how much a counter increased, accounting for wraparound and resets
+
+    Args:
+        previous: Previous counter value
+        current: Current counter value
+        reset: Whether the series of the counter is known to have been reset
+
+    Returns:
+        The increase (never negative)
+    """
+    if current >= previous:
+        return current - previous
+    if not reset:
+        for width in COUNTER_WIDTHS:
+            if WRAP_THRESHOLD * width <= previous <= width:
+                return current + (width - previous)
+    return current
+
+
+def reset_series(pairs: List[Tuple[CounterKey, float, float]]) -> Set[Tuple[str, str]]:
+    """
+    Find the series that were reset between two samples: those with a counter that went down
+    from a value too low to wrap
+
+    Args:
+        pairs: (key, previous value, current value) of the counters present in both samples
+
+    Returns:
+        (measurement, series) of every reset series
+    """
+    lowest_wrap = WRAP_THRESHOLD * COUNTER_WIDTHS[0]
+    return {key[:2] for key, old, new in pairs if new < old < lowest_wrap}
+
+
+def counter_rates(previous: CounterSample, keys: Tuple[CounterKey, ...], values: List[float], ts: float) -> List[Tuple[CounterKey, float]]:
+    """
+    Compute per-second rates of every counter present in both samples
+
+    Args:
+        previous: The previous sample
+        keys: Current counter keys
+        values: Current counter values
+        ts: Current sample time (unix seconds)
+
+    Returns:
+        (key, rate) pairs in the order of the current keys
+    """
+    elapsed = ts - previous.ts
+    if previous.keys == keys:
+        # Same interfaces and devices as last time: the arrays are parallel
+        pairs = list(zip(keys, previous.values, values))
+    else:
+        index = {key: position for position, key in enumerate(previous.keys)}
+        pairs = [
+            (key, previous.values[index[key]], new)
+            for key, new in zip(keys, values)
+            if key in index
+        ]
+
+    resets = reset_series(pairs)
+    return [(key, counter_increase(old, new, key[:2] in resets) / elapsed) for key, old, new in pairs]
+
+
+def rate_metrics(rates: List[Tuple[CounterKey, float]], ts: float) -> List[Dict[str, Any]]:
+    """
+    Group rates into one Telegraf-shaped metric per interface or device
+
+    Args:
+        rates: (key, rate) pairs
+        ts: Sample time (unix seconds)
+
+    Returns:
+        Metrics named '{measurement}_rate', tagged like their counters
+    """
+    by_series: Dict[Tuple[str, str], Dict[str, float]] = {}
+    for (measurement, series, field), rate in rates:
+        by_series.setdefault((measurement, series), {})[field] = round(rate, 2)
+    return [
+        {
+            'name': measurement + RATE_SUFFIX,
+            'tags': {COUNTERS[measurement][0]: series},
+            'fields': fields,
+            'timestamp': int(ts),
+        }
+        for (measurement, series), fields in by_series.items()
+    ]
+
+
+class RateTracker:
+    """
+    Per-instance cache of the previous counters of each resource
+
+    Args:
+        max_size: Maximum number of resources kept
+        max_gap: Oldest previous sample (seconds) rates are computed against; also the cache TTL
+    """
+
+    def __init__(self, max_size: int = RATE_CACHE_MAX_SIZE, max_gap: float = RATE_MAX_GAP_SECONDS):
+        self._samples = TTLCache(max_size=max_size, ttl=max_gap)
+        self._max_gap = max_gap
+
+    def derive(self, key: Tuple[str, str], batch: MetricsBatch, fallback_ts: float) -> List[Dict[str, Any]]:
+        """
+        Remember the counters of a batch and get their rates since the previous batch
+
+        Args:
+            key: (user_id, resource_id)
+            batch: The indexed metrics batch
+            fallback_ts: Sample time (unix seconds) if the metrics carry no timestamp
+
+        Returns:
+            Rate metrics to store with the snapshot (empty without a usable previous sample)
+        """
+        keys, values, ts = collect_counters(batch)
+        if not keys:
+            return []
+        if ts is None:
+            ts = fallback_ts
+
+        found, previous = self._samples.get(key)
+        if found and previous is not None and ts <= previous.ts:
+            # Out of order or repeated batch, keep the newer sample
+            return []
+
+        if found and previous is not None and previous.keys == keys:
+            keys = previous.keys
+        self._samples.set(key, CounterSample(keys, array('d', values), ts))
+
+        if not found or previous is None or ts - previous.ts > self._max_gap:
+            return []
+        return rate_metrics(counter_rates(previous, keys, values, ts), ts)
+
+
+# Shared by every request served by this instance
+rate_tracker = RateTracker()
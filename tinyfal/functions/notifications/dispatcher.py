@@ -0,0 +1,287 @@
+"""
+Batched delivery of push notifications to every device of a user.
+
+Notifications are queued on a NotificationDispatcher and delivered together by flush():
+every (notification, device) pair becomes one FCM message, sent in send_each calls of up to
+FCM_BATCH_LIMIT messages. Device tokens that FCM reports as unregistered or invalid are
+pruned from the user document, and the notification history documents are written in one
+batched commit.
+
+The messaging backend is injectable, see notifications/fake.py for a local fake.
+firebase_admin.messaging is imported on the first flush, so importing this module stays cheap
+for functions that never send notifications.
+"""
+import time
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from firebase_admin import exceptions, firestore
+from firebase_functions import logger
+
+from database.database import get_db
+from instrumentation.instrumentation import record_read, record_write, span
+from retry.retry import backoff_delays
+from users.settings import invalidate_user_settings
+
+
+# Maximum number of messages per send_each call, and of writes per Firestore batch
+FCM_BATCH_LIMIT = 500
+FIRESTORE_BATCH_LIMIT = 500
+
+# FCM errors worth another attempt; anything else (bad token, bad payload) fails at once
+TRANSIENT_FCM_ERRORS = (
+    exceptions.UnavailableError,
+    exceptions.InternalError,
+    exceptions.DeadlineExceededError,
+    exceptions.ResourceExhaustedError,
+)
+
+DELIVERY_ATTEMPTS = 3
+
+
+def invalid_token_errors() -> Tuple[type, ...]:
+    """FCM errors meaning the device token will never work again."""
+    from firebase_admin import messaging
+
+    return (
+        messaging.UnregisteredError,
+        messaging.SenderIdMismatchError,
+        exceptions.InvalidArgumentError,
+    )
+
+
+@firestore.transactional
+def _prune_primary(transaction, user_ref, tokens: List[str]) -> None:
+    """Remove dead tokens from a user document, clearing fcmToken if it is one of them."""
+    snapshot = user_ref.get(transaction=transaction, field_paths=['fcmToken'])
+    update: Dict[str, Any] = {'fcmTokens': firestore.ArrayRemove(tokens)}
+    if (snapshot.to_dict() or {}).get('fcmToken') in tokens:
+        update['fcmToken'] = ''
+    transaction.update(user_ref, update)
+
+
+def device_tokens(user_settings: Dict[str, Any]) -> List[str]:
+    """
+    Get every FCM device token of a user.
+    The app stores its current token in `fcmToken`; further devices are listed in `fcmTokens`.
+
+    Args:
+        user_settings: The user document data
+
+    Returns:
+        Distinct non-empty tokens, `fcmToken` first
+    """
+    tokens = [user_settings.get('fcmToken')]
+    extra = user_settings.get('fcmTokens')
+    if isinstance(extra, list):
+        tokens.extend(extra)
+    return list(dict.fromkeys(token for token in tokens if isinstance(token, str) and token))
+
+
+class PushNotification:
+    """
+    A notification for one user, delivered to all of their devices
+
+    Attributes:
+        user_id: Recipient
+        title: Notification title
+        body: Notification body
+        data: FCM data payload (string values)
+        history: Extra fields stored on the notification history document
+    """
+
+    __slots__ = ('user_id', 'title', 'body', 'data', 'history')
+
+    def __init__(self, user_id: str, title: str, body: str, data: Optional[Dict[str, str]] = None,
+                 history: Optional[Dict[str, Any]] = None):
+        self.user_id = user_id
+        self.title = title
+        self.body = body
+        self.data = data or {}
+        self.history = history or {}
+
+
+class DeliveryReport:
+    """
+    Outcome of a flush
+
+    Attributes:
+        sent: Messages FCM accepted
+        failed: Messages that failed for good
+        pruned: Device tokens removed from user documents
+        stored: Notification history documents written
+    """
+
+    __slots__ = ('sent', 'failed', 'pruned', 'stored')
+
+    def __init__(self):
+        self.sent = 0
+        self.failed = 0
+        self.pruned = 0
+        self.stored = 0
+
+
+class NotificationDispatcher:
+    """
+    Queue of push notifications delivered in batches
+
+    Args:
+        db: Firestore client (defaults to the shared client on flush)
+        backend: Object with a send_each(messages) method (defaults to firebase_admin.messaging)
+        attempts: Maximum delivery attempts for messages failing with transient errors
+        sleep: Sleep function used between attempts, replaceable for tests
+    """
+
+    def __init__(self, db=None, backend=None, attempts: int = DELIVERY_ATTEMPTS,
+                 sleep: Callable[[float], None] = time.sleep):
+        self._db = db
+        self._backend = backend
+        self._attempts = attempts
+        self._sleep = sleep
+        self._pending: List[Tuple[PushNotification, List[str]]] = []
+        # user_id -> the token stored in `fcmToken`, cleared rather than array-removed when pruned
+        self._primary: Dict[str, Optional[str]] = {}
+
+    def add(self, notification: PushNotification, user_settings: Dict[str, Any]) -> bool:
+        """
+        Queue a notification for every device of its recipient
+
+        Args:
+            notification: The notification
+            user_settings: The recipient's user document data
+
+        Returns:
+            False if the recipient has no device to deliver to
+        """
+        tokens = device_tokens(user_settings)
+        if not tokens:
+            return False
+        self._primary[notification.user_id] = user_settings.get('fcmToken')
+        self._pending.append((notification, tokens))
+        return True
+
+    def __len__(self) -> int:
+        return len(self._pending)
+
+    def flush(self) -> DeliveryReport:
+        """
+        Deliver every queued notification, prune dead device tokens and store the history
+
+        Returns:
+            The delivery report
+        """
+        pending, self._pending = self._pending, []
+        primary, self._primary = self._primary, {}
+        report = DeliveryReport()
+        if not pending:
+            return report
+
+        from firebase_admin import messaging
+
+        db = self._db or get_db()
+
+        messages = []
+        owners = []
+        for notification, tokens in pending:
+            for token in tokens:
+                messages.append(messaging.Message(
+                    notification=messaging.Notification(title=notification.title, body=notification.body),
+                    data=notification.data,
+                    token=token,
+                ))
+                owners.append((notification.user_id, token))
+
+        with span('fcm_send'):
+            invalid = self._send(messages, owners, report)
+        with span('token_prune'):
+            report.pruned = self._prune(db, invalid, primary)
+        with span('notification_store'):
+            report.stored = self._store(db, [notification for notification, _ in pending])
+        return report
+
+    def _send(self, messages: List[Any], owners: List[Tuple[str, str]], report: DeliveryReport) -> Dict[str, List[str]]:
+        """Send messages in chunks, retrying transient failures. Returns user_id -> invalid tokens."""
+        from firebase_admin import messaging
+
+        backend = self._backend or messaging
+        invalid_errors = invalid_token_errors()
+        invalid: Dict[str, List[str]] = {}
+        todo = list(range(len(messages)))
+        delays = backoff_delays(self._attempts)
+
+        while todo:
+            retry = []
+            for chunk_start in range(0, len(todo), FCM_BATCH_LIMIT):
+                chunk = todo[chunk_start:chunk_start + FCM_BATCH_LIMIT]
+                try:
+                    responses = backend.send_each([messages[index] for index in chunk]).responses
+                except TRANSIENT_FCM_ERRORS as e:
+                    logger.warn(f"FCM batch failed, will retry: {str(e)}")
+                    retry.extend(chunk)
+                    continue
+
+                for index, response in zip(chunk, responses):
+                    if response.success:
+                        report.sent += 1
+                    elif isinstance(response.exception, invalid_errors):
+                        user_id, token = owners[index]
+                        invalid.setdefault(user_id, []).append(token)
+                        report.failed += 1
+                    elif isinstance(response.exception, TRANSIENT_FCM_ERRORS):
+                        retry.append(index)
+                    else:
+                        logger.error(f"FCM message failed: {str(response.exception)}")
+                        report.failed += 1
+
+            if not retry:
+                break
+            delay = next(delays, None)
+            if delay is None:
+                logger.error(f"Giving up on {len(retry)} FCM messages after {self._attempts} attempts")
+                report.failed += len(retry)
+                break
+            self._sleep(delay)
+            todo = retry
+
+        if report.sent:
+            logger.info(f"Sent {report.sent} FCM messages ({report.failed} failed)")
+        return invalid
+
+    def _prune(self, db, invalid: Dict[str, List[str]], primary: Dict[str, Optional[str]]) -> int:
+        """Remove dead device tokens from the user documents."""
+        pruned = 0
+        for user_id, tokens in invalid.items():
+            tokens = list(dict.fromkeys(tokens))
+            user_ref = db.collection('users').document(user_id)
+            try:
+                # The app rewrites fcmToken on its next start; clear it so it is not retried until then.
+                # The settings the token came from may be cached, so only clear it if it was not replaced since
+                if primary.get(user_id) in tokens:
+                    _prune_primary(db.transaction(), user_ref, tokens)
+                    record_read()
+                else:
+                    user_ref.update({'fcmTokens': firestore.ArrayRemove(tokens)})
+                record_write()
+                invalidate_user_settings(user_id)
+                pruned += len(tokens)
+                logger.info(f"Pruned {len(tokens)} invalid FCM tokens for user: {user_id}")
+            except Exception as e:
+                logger.error(f"Failed to prune FCM tokens for user {user_id}: {str(e)}")
+        return pruned
+
+    def _store(self, db, notifications: List[PushNotification]) -> int:
+        """Write the notification history documents in batched commits."""
+        stored = 0
+        for chunk_start in range(0, len(notifications), FIRESTORE_BATCH_LIMIT):
+            chunk = notifications[chunk_start:chunk_start + FIRESTORE_BATCH_LIMIT]
+            write_batch = db.batch()
+            for notification in chunk:
+                write_batch.set(db.collection('users').document(notification.user_id).collection('notifications').document(), {
+                    'title': notification.title,
+                    'body': notification.body,
+                    'timestamp': firestore.SERVER_TIMESTAMP,
+                    **notification.history,
+                })
+            write_batch.commit()
+            record_write(len(chunk))
+            stored += len(chunk)
+        return stored
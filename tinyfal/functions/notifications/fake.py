@@ -0,0 +1,77 @@
+"""
+In-memory stand-in for firebase_admin.messaging, for local runs and tests.
+
+    backend = FakeMessaging(invalid_tokens={'dead-token'})
+    dispatcher = NotificationDispatcher(db=db, backend=backend)
+
+Every message is recorded in `sent` (or `rejected`); nothing leaves the process.
+"""
+from typing import Any, Iterable, List, Optional
+
+from firebase_admin import exceptions, messaging
+
+
+class FakeSendResponse:
+    """
+    Mirrors messaging.SendResponse
+    """
+
+    __slots__ = ('message_id', 'exception')
+
+    def __init__(self, message_id: Optional[str] = None, exception: Optional[Exception] = None):
+        self.message_id = message_id
+        self.exception = exception
+
+    @property
+    def success(self) -> bool:
+        return self.exception is None
+
+
+class FakeBatchResponse:
+    """
+    Mirrors messaging.BatchResponse
+    """
+
+    def __init__(self, responses: List[FakeSendResponse]):
+        self.responses = responses
+
+    @property
+    def success_count(self) -> int:
+        return sum(1 for response in self.responses if response.success)
+
+    @property
+    def failure_count(self) -> int:
+        return len(self.responses) - self.success_count
+
+
+class FakeMessaging:
+    """
+    Fake messaging backend
+
+    Args:
+        invalid_tokens: Tokens answered with UnregisteredError
+        unavailable_tokens: Tokens answered with UnavailableError once, then accepted
+    """
+
+    def __init__(self, invalid_tokens: Iterable[str] = (), unavailable_tokens: Iterable[str] = ()):
+        self.invalid_tokens = set(invalid_tokens)
+        self.unavailable_tokens = set(unavailable_tokens)
+        self.sent: List[Any] = []
+        self.rejected: List[Any] = []
+        self.calls = 0
+
+    def send_each(self, messages: List[Any], dry_run: bool = False) -> FakeBatchResponse:
+        self.calls += 1
+        responses = []
+        for message in messages:
+            token = message.token
+            if token in self.invalid_tokens:
+                self.rejected.append(message)
+                responses.append(FakeSendResponse(exception=messaging.UnregisteredError("Requested entity was not found.")))
+            elif token in self.unavailable_tokens:
+                self.unavailable_tokens.discard(token)
+                responses.append(FakeSendResponse(exception=exceptions.UnavailableError("Service unavailable")))
+            else:
+                self.sent.append(message)
+                responses.append(FakeSendResponse(message_id=f"projects/fake/messages/{len(self.sent)}"))
+        return FakeBatchResponse(responses)
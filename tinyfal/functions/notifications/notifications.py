@@ -1,205 +1,368 @@
-from firebase_functions import firestore_fn, logger
-from firebase_admin import firestore, messaging
-from typing import Dict, Any
+from firebase_functions import logger
+from typing import Dict, Any, List, Optional, Tuple, Union
+import time
 
 # Import our models functions
-from models.models import extract_cpu_available_percent, extract_available_memory_percent
+from models.models import MetricsData, as_batch
 
-def send_cpu_threshold_notification(
-    user_id: str, 
-    resource_name: str, 
-    current_cpu: float, 
-    threshold: float, 
-    fcm_token: str
-) -> bool:
+# Import alert rule and state functionality
+from alerts.rules import CompiledRule, rules_for_user
+from alerts.state import FIRE, RESOLVE, AlertState, advance, load_states, commit_transitions
+from alerts.digest import digest_event, digest_enabled, add_events, take_digest, schedule_delivery
+
+# Import database and user settings functionality
+from database.database import get_db
+from instrumentation.instrumentation import span
+from users.settings import get_user_settings
+
+# Import notification delivery functionality
+from notifications.dispatcher import NotificationDispatcher, PushNotification, device_tokens
+
+
+def build_rule_notification(
+    user_id: str,
+    resource_name: str,
+    rule: CompiledRule,
+    value: float,
+    resolved: bool = False
+) -> PushNotification:
     """
-    Sends a push notification when CPU usage falls below the specified threshold.
+    Builds the push notification of an alert rule that fired or resolved.
     
     Args:
         user_id: The user's unique identifier
         resource_name: The name of the resource being monitored
-        current_cpu: Current CPU available percentage
-        threshold: The threshold percentage that was breached
-        fcm_token: Firebase Cloud Messaging token for the user's device
+        rule: The rule that fired or resolved
+        value: Current value of the rule metric
+        resolved: Whether this is the resolve notification of a firing rule
     
     Returns:
-        bool: True if notification was sent successfully, False otherwise
+        PushNotification: The notification, ready to be queued on a dispatcher
     """
-    try:
-        # Create notification title and body
-        title = f"⚠️ CPU Alert - {resource_name}"
-        body = f"CPU available has dropped to {current_cpu:.1f}% (below {threshold:.1f}% threshold)"
-        
-        # Create the message
-        message = messaging.Message(
-            notification=messaging.Notification(
-                title=title,
-                body=body,
-            ),
-            data={
-                'type': 'cpu_alert',
-                'resource_name': resource_name,
-                'current_cpu': str(current_cpu),
-                'threshold': str(threshold),
-                'user_id': user_id,
-            },
-            token=fcm_token,
-        )
-        
-        # Send the message
-        response = messaging.send(message)
-        logger.info(f"CPU threshold notification sent successfully. Message ID: {response}")
-        
-        # Store notification in Firestore for history
-        db = firestore.client()
-        notification_data = {
-            'title': title,
-            'body': body,
-            'timestamp': firestore.SERVER_TIMESTAMP,
-            'type': 'cpu_alert',
+    return build_event_notification(user_id, digest_event('', resource_name, rule, value, resolved, time.time()))
+
+
+def _event_label(event: Dict[str, Any]) -> str:
+    return {'cpu_alert': 'CPU', 'ram_alert': 'RAM'}.get(event['type'], event['label'])
+
+
+def _event_type(event: Dict[str, Any]) -> str:
+    return f"{event['type']}_resolved" if event['resolved'] else event['type']
+
+
+def build_event_notification(user_id: str, event: Dict[str, Any]) -> PushNotification:
+    """
+    Builds the push notification of a single alert transition.
+    
+    Args:
+        user_id: The user's unique identifier
+        event: The transition, as built by alerts.digest.digest_event
+    
+    Returns:
+        PushNotification: The notification, ready to be queued on a dispatcher
+    """
+    # Create notification title and body
+    label = _event_label(event)
+    resource_name = event['resource_name']
+    value = event['value']
+    if event['resolved']:
+        title = f"✅ {label} Resolved - {resource_name}"
+        body = f"{event['label']} is back to {value:g}{event['unit']}"
+    else:
+        icon = '🔴' if event['type'] == 'ram_alert' else '⚠️'
+        title = f"{icon} {label} Alert - {resource_name}"
+        body = f"{event['label']} is {value:g}{event['unit']} ({event['wording']} {event['threshold']:g}{event['unit']} threshold)"
+    notification_type = _event_type(event)
+    
+    return PushNotification(
+        user_id,
+        title,
+        body,
+        data={
+            'type': notification_type,
+            'rule_id': event['rule_id'],
+            'metric': event['metric'],
             'resource_name': resource_name,
-            'current_cpu': current_cpu,
-            'threshold': threshold,
-        }
-        
-        db.collection('users').document(user_id).collection('notifications').add(notification_data)
-        logger.info(f"CPU alert notification stored in Firestore for user: {user_id}")
-        
-        return True
-        
-    except Exception as e:
-        logger.error(f"Failed to send CPU threshold notification: {str(e)}")
-        return False
+            'value': str(value),
+            'threshold': str(event['threshold']),
+            'user_id': user_id,
+        },
+        history={
+            'type': notification_type,
+            'rule_id': event['rule_id'],
+            'metric': event['metric'],
+            'resource_id': event['resource_id'],
+            'resource_name': resource_name,
+            'value': value,
+            'threshold': event['threshold'],
+        },
+    )
 
 
-def send_ram_threshold_notification(
-    user_id: str, 
-    resource_name: str, 
-    current_ram: float, 
-    threshold: float, 
-    fcm_token: str
-) -> bool:
+def build_digest_notification(user_id: str, events: List[Dict[str, Any]]) -> PushNotification:
     """
-    Sends a push notification when RAM usage exceeds the specified threshold.
+    Builds one push notification summarizing the alert transitions of a digest window.
+    A digest with a single event is sent as that event's own notification.
     
     Args:
         user_id: The user's unique identifier
-        resource_name: The name of the resource being monitored
-        current_ram: Current RAM usage percentage
-        threshold: The threshold percentage that was breached
-        fcm_token: Firebase Cloud Messaging token for the user's device
+        events: The transitions of the window, oldest first
     
     Returns:
-        bool: True if notification was sent successfully, False otherwise
+        PushNotification: The notification; its history document keeps every event
     """
-    try:
-        # Create notification title and body
-        title = f"🔴 RAM Alert - {resource_name}"
-        body = f"RAM usage has reached {current_ram:.1f}% (above {threshold:.1f}% threshold)"
-        
-        # Create the message
-        message = messaging.Message(
-            notification=messaging.Notification(
-                title=title,
-                body=body,
-            ),
-            data={
-                'type': 'ram_alert',
-                'resource_name': resource_name,
-                'current_ram': str(current_ram),
-                'threshold': str(threshold),
-                'user_id': user_id,
-            },
-            token=fcm_token,
-        )
-        
-        # Send the message
-        response = messaging.send(message)
-        logger.info(f"RAM threshold notification sent successfully. Message ID: {response}")
-        
-        # Store notification in Firestore for history
-        db = firestore.client()
-        notification_data = {
-            'title': title,
-            'body': body,
-            'timestamp': firestore.SERVER_TIMESTAMP,
-            'type': 'ram_alert',
+    if len(events) == 1:
+        return build_event_notification(user_id, events[0])
+    
+    # One line per (rule, fired/resolved), listing the affected servers
+    groups: Dict[tuple, List[Dict[str, Any]]] = {}
+    for event in events:
+        groups.setdefault((event['rule_id'], event['resolved']), []).append(event)
+    
+    lines = []
+    for (_, resolved), group in groups.items():
+        first = group[0]
+        names = list(dict.fromkeys(event['resource_name'] for event in group))
+        shown = ', '.join(names[:3]) + (f" (+{len(names) - 3} more)" if len(names) > 3 else '')
+        servers = f"{len(names)} server{'s' if len(names) != 1 else ''}"
+        if resolved:
+            lines.append(f"{servers} back to normal ({first['label']}): {shown}")
+        else:
+            lines.append(f"{servers} {first['wording']} {_event_label(first)} threshold ({first['threshold']:g}{first['unit']}): {shown}")
+    
+    resources = {event['resource_id'] or event['resource_name'] for event in events}
+    if len(groups) == 1:
+        first = events[0]
+        icon = '✅' if first['resolved'] else ('🔴' if first['type'] == 'ram_alert' else '⚠️')
+        title = f"{icon} {_event_label(first)} {'Resolved' if first['resolved'] else 'Alert'} - {len(resources)} servers"
+    else:
+        title = f"⚠️ {len(events)} alerts on {len(resources)} servers"
+    
+    return PushNotification(
+        user_id,
+        title,
+        '\n'.join(lines),
+        data={
+            'type': 'alert_digest',
+            'events': str(len(events)),
+            'user_id': user_id,
+        },
+        history={
+            'type': 'alert_digest',
+            'events': events,
+        },
+    )
+
+
+def _format_duration(seconds: float) -> str:
+    minutes = int(seconds // 60)
+    if minutes < 60:
+        return f"{max(minutes, 1)} min"
+    hours, minutes = divmod(minutes, 60)
+    return f"{hours} h {minutes} min" if minutes else f"{hours} h"
+
+
+def build_offline_notification(user_id: str, resources: List[Tuple[str, str]]) -> PushNotification:
+    """
+    Builds the push notification of resources that stopped reporting.
+    
+    Args:
+        user_id: The user's unique identifier
+        resources: (resource_id, resource_name) of every resource found offline in one sweep
+    
+    Returns:
+        PushNotification: One notification for all the resources
+    """
+    names = [name for _, name in resources]
+    if len(names) == 1:
+        title = f"🔌 Offline - {names[0]}"
+        body = f"{names[0]} stopped sending data"
+    else:
+        shown = ', '.join(names[:3]) + (f" (+{len(names) - 3} more)" if len(names) > 3 else '')
+        title = f"🔌 Offline - {len(names)} servers"
+        body = f"{len(names)} servers stopped sending data: {shown}"
+    
+    return PushNotification(
+        user_id,
+        title,
+        body,
+        data={
+            'type': 'resource_offline',
+            'resource_ids': ','.join(resource_id for resource_id, _ in resources),
+            'user_id': user_id,
+        },
+        history={
+            'type': 'resource_offline',
+            'resources': [{'resource_id': resource_id, 'resource_name': name} for resource_id, name in resources],
+        },
+    )
+
+
+def build_online_notification(user_id: str, resource_id: str, resource_name: str, offline_seconds: Optional[float]) -> PushNotification:
+    """
+    Builds the push notification of a resource that reports again after an outage.
+    
+    Args:
+        user_id: The user's unique identifier
+        resource_id: The resource's unique identifier
+        resource_name: The name of the resource
+        offline_seconds: Length of the outage, if known
+    
+    Returns:
+        PushNotification: The notification
+    """
+    body = f"{resource_name} is sending data again"
+    if offline_seconds is not None:
+        body += f" after {_format_duration(offline_seconds)}"
+    
+    return PushNotification(
+        user_id,
+        f"✅ Back online - {resource_name}",
+        body,
+        data={
+            'type': 'resource_online',
+            'resource_id': resource_id,
             'resource_name': resource_name,
-            'current_ram': current_ram,
-            'threshold': threshold,
-        }
-        
-        db.collection('users').document(user_id).collection('notifications').add(notification_data)
-        logger.info(f"RAM alert notification stored in Firestore for user: {user_id}")
-        
-        return True
-        
-    except Exception as e:
-        logger.error(f"Failed to send RAM threshold notification: {str(e)}")
-        return False
+            'user_id': user_id,
+        },
+        history={
+            'type': 'resource_online',
+            'resource_id': resource_id,
+            'resource_name': resource_name,
+            'offline_seconds': offline_seconds,
+        },
+    )
+
+
+def offline_notifications_enabled(user_settings: Dict[str, Any]) -> bool:
+    """Whether a user wants offline and back online notifications."""
+    return bool(user_settings.get('notificationsEnabled', True) and user_settings.get('offlineNotificationsEnabled', True))
+
+
+def send_alert_digest(user_id: str) -> None:
+    """
+    Closes the open alert digest of a user and delivers it as a single notification.
+    
+    Args:
+        user_id: The user's unique identifier
+    """
+    db = get_db()
+    events = take_digest(db, user_id)
+    if not events:
+        return
+    
+    user_settings = get_user_settings(db, user_id) or {}
+    if not user_settings.get('notificationsEnabled', True):
+        logger.info(f"Notifications disabled for user: {user_id}, dropping digest of {len(events)} alerts")
+        return
+    
+    dispatcher = NotificationDispatcher(db=db)
+    if dispatcher.add(build_digest_notification(user_id, events), user_settings):
+        dispatcher.flush()
+        logger.info(f"Alert digest of {len(events)} events delivered to user: {user_id}")
 
 
 def check_and_send_threshold_alerts(
     user_id: str, 
     resource_id: str, 
     resource_name: str, 
-    available_cpu_percent: int,
-    available_memory_percent: int,
-    user_settings: Dict[str, Any]
+    metrics: Union[MetricsData, Dict[str, float]],
+    user_settings: Dict[str, Any],
+    now: Optional[float] = None,
+    dispatcher: Optional[NotificationDispatcher] = None
 ) -> None:
     """
-    Checks resource metrics against user-defined thresholds and sends alerts if needed.
+    Evaluates the user's alert rules against a metrics batch and sends alerts if needed.
     
     Args:
         user_id: The user's unique identifier
         resource_id: The resource's unique identifier
         resource_name: The name of the resource being monitored
-        available_cpu_percent: Already extracted CPU available percentage
-        available_memory_percent: Already extracted memory available percentage
-        user_settings: Dictionary containing user notification preferences
+        metrics: The resource metrics (list of metric dictionaries or a MetricsBatch), or the
+            values extracted from them at ingest (see alerts.rules.alert_values)
+        user_settings: Dictionary containing user notification preferences and alert rules
+        now: Evaluation time (unix seconds), defaults to the current time
+        dispatcher: Dispatcher to queue notifications on. When omitted, transitions go to the
+            user's alert digest (or are delivered before returning if digests are disabled)
     """
     try:
-        # Get user's FCM token
-        fcm_token = user_settings.get('fcmToken')
-        if not fcm_token:
+        # Get user's FCM device tokens
+        if not device_tokens(user_settings):
             logger.warning(f"No FCM token found for user: {user_id}")
             return
         
-        logger.info(f"Checking thresholds for user {user_id}, resource {resource_id} ({resource_name})")
-
         # Check if notifications are enabled
         notifications_enabled = user_settings.get('notificationsEnabled', True)
         if not notifications_enabled:
             logger.info(f"Notifications disabled for user: {user_id}")
             return
         
-        # Check CPU threshold
-        cpu_notifications_enabled = user_settings.get('cpuNotificationsEnabled', False)
-        if cpu_notifications_enabled:
-            cpu_threshold = user_settings.get('cpuThreshold', 10.0)  # Default 10%
-            
-            logger.info(f"CPU available: {available_cpu_percent}% for resource {resource_name}")
-            
-            if available_cpu_percent < cpu_threshold:
-                logger.info(f"CPU threshold breached for resource {resource_name}: {available_cpu_percent}% < {cpu_threshold}%")
-                send_cpu_threshold_notification(
-                    user_id, resource_name, available_cpu_percent, cpu_threshold, fcm_token
-                )
+        with span('rules'):
+            rule_set = rules_for_user(user_id, user_settings)
+        if not rule_set:
+            return
+        
+        logger.info(f"Checking {len(rule_set)} alert rules for user {user_id}, resource {resource_id} ({resource_name})")
+        
+        now = time.time() if now is None else now
+        
+        # Steady state: cached states, no Firestore or FCM traffic unless a rule changes state
+        db = get_db()
+        with span('state_read'):
+            states = load_states(db, user_id, resource_id)
+        results = {}
+        advanced = {}
+        transitions = []
+        
+        with span('evaluate'):
+            if isinstance(metrics, dict):
+                rule_results = rule_set.evaluate_values(resource_id, metrics)
+            else:
+                rule_results = rule_set.evaluate(resource_id, as_batch(metrics))
+            for result in rule_results:
+                rule = result.rule
+                # Advance a copy: a transition only reaches the cache once it is committed
+                state = states[rule.id].copy() if rule.id in states else AlertState()
+                transition = advance(state, rule, result.value, result.breached, now)
+                if transition is None:
+                    states[rule.id] = state
+                else:
+                    results[rule.id] = result
+                    advanced[rule.id] = state
+                    transitions.append((rule.id, transition))
+        
+        if not transitions:
+            return
+        
+        events = []
+        with span('state_write'):
+            committed = commit_transitions(db, user_id, resource_id, states, advanced, transitions)
+        for rule_id, transition in committed:
+            result = results[rule_id]
+            rule = result.rule
+            if transition == FIRE:
+                logger.info(f"Alert rule {rule.id} fired for resource {resource_name}: {rule.metric} = {result.value} {rule.op} {rule.threshold}")
+            else:
+                logger.info(f"Alert rule {rule.id} resolved for resource {resource_name}: {rule.metric} = {result.value}")
+            events.append(digest_event(resource_id, resource_name, rule, result.value, transition == RESOLVE, now))
+        
+        if not events:
+            return
+        
+        # Transitions of all the user's resources within the window become a single push
+        if dispatcher is None and digest_enabled():
+            with span('digest'):
+                if add_events(db, user_id, events, now):
+                    schedule_delivery(user_id, send_alert_digest)
+            return
         
-        # Check RAM threshold
-        ram_notifications_enabled = user_settings.get('ramNotificationsEnabled', False)
-        if ram_notifications_enabled:
-            ram_threshold = user_settings.get('ramThreshold', 85.0)  # Default 85%
-            
-            # Convert available memory to usage percentage
-            current_ram_usage = 100 - available_memory_percent
-            logger.info(f"RAM usage: {current_ram_usage}% for resource {resource_name}")
-            
-            if current_ram_usage > ram_threshold:
-                logger.info(f"RAM threshold breached for resource {resource_name}: {current_ram_usage}% > {ram_threshold}%")
-                send_ram_threshold_notification(
-                    user_id, resource_name, current_ram_usage, ram_threshold, fcm_token
-                )
+        deliver_now = dispatcher is None
+        if deliver_now:
+            dispatcher = NotificationDispatcher(db=db)
+        for event in events:
+            dispatcher.add(build_event_notification(user_id, event), user_settings)
+        if deliver_now:
+            dispatcher.flush()
                 
     except Exception as e:
         logger.error(f"Error checking thresholds for user {user_id}, resource {resource_id}: {str(e)}")
@@ -0,0 +1 @@
+# Reports package for Tinyfal Firebase Functions
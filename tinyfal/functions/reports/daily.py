@@ -0,0 +1,174 @@
+"""
+Daily report email: uptime, peak CPU, RAM and disk per resource, and alert counts.
+
+Users opt in with `dailyReportEnabled: true` on their user document (`locale` picks the
+language). The report makes one cursor-paged pass over those users; for each page, the users'
+resources and the day's notification history are read in parallel, two queries per user. The
+per-resource figures come from the `daily_summary` the daily compaction stores on each resource
+document, so no history or rollup documents are read and cost grows with the number of users,
+not with resources times queries. Each page of reports is handed to MailClient.send_many.
+"""
+import os
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from typing import Any, Dict, Iterator, List, Optional
+
+from firebase_functions import logger
+from google.cloud.firestore_v1.field_path import FieldPath
+
+from instrumentation.instrumentation import record_read
+from mailing.mailing import MailClient, MailMessage, render_daily_summary_email
+
+
+DAILY_REPORT_PAGE_SIZE = int(os.environ.get('DAILY_REPORT_PAGE_SIZE', '100'))
+DAILY_REPORT_WORKERS = int(os.environ.get('DAILY_REPORT_WORKERS', '16'))
+
+
+def _report_user_pages(db) -> Iterator[List[Any]]:
+    """Yield pages of users who opted in to the daily report, following a document id cursor."""
+    base_query = (
+        db.collection('users')
+        .where('dailyReportEnabled', '==', True)
+        .order_by(FieldPath.document_id())
+        .select(['email', 'locale'])
+        .limit(DAILY_REPORT_PAGE_SIZE)
+    )
+
+    cursor = None
+    while True:
+        page_query = base_query.start_after(cursor) if cursor is not None else base_query
+        page = list(page_query.stream())
+        record_read(len(page))
+        if not page:
+            return
+        yield page
+        if len(page) < DAILY_REPORT_PAGE_SIZE:
+            return
+        cursor = page[-1]
+
+
+def count_fired_alerts(notifications: List[Dict[str, Any]]) -> Dict[str, int]:
+    """
+    Count the alerts that fired, per resource, in notification history documents.
+    Documents written before history kept the resource id are counted by resource name.
+
+    Args:
+        notifications: History documents, single alerts or alert digests
+
+    Returns:
+        Resource id (or name) -> number of alerts fired
+    """
+    counts: Dict[str, int] = {}
+    for notification in notifications:
+        notification_type = notification.get('type') or ''
+        if notification_type == 'alert_digest':
+            events = [event for event in notification.get('events') or [] if not event.get('resolved')]
+        elif notification_type.endswith('_alert'):
+            events = [notification]
+        else:
+            continue
+        for event in events:
+            key = event.get('resource_id') or event.get('resource_name') or ''
+            counts[key] = counts.get(key, 0) + 1
+    return counts
+
+
+def build_user_report(db, user_id: str, day_start: datetime) -> Dict[str, Any]:
+    """
+    Gather the report data of one user
+
+    Args:
+        db: Firestore client
+        user_id: The user
+        day_start: Start of the reported UTC day
+
+    Returns:
+        Template data for mailing.render_daily_summary_email
+    """
+    user_ref = db.collection('users').document(user_id)
+    day = day_start.strftime('%Y-%m-%d')
+
+    resource_docs = list(user_ref.collection('resources').select(['title', 'daily_summary']).stream())
+    notification_docs = list(
+        user_ref.collection('notifications')
+        .where('timestamp', '>=', day_start)
+        .where('timestamp', '<', day_start + timedelta(days=1))
+        .select(['type', 'resource_id', 'resource_name', 'events'])
+        .stream()
+    )
+    record_read(max(1, len(resource_docs)) + max(1, len(notification_docs)))
+
+    alerts = count_fired_alerts([doc.to_dict() or {} for doc in notification_docs])
+
+    resources = []
+    for resource_doc in resource_docs:
+        data = resource_doc.to_dict() or {}
+        title = data.get('title', resource_doc.id)
+        summary = data.get('daily_summary') or {}
+        # A resource that did not report during the day has no summary for it
+        if summary.get('day') != day:
+            summary = {}
+        resources.append({
+            'title': title,
+            'uptime': summary.get('uptime'),
+            'cpu_max': summary.get('cpu_max'),
+            'mem_max': summary.get('mem_max'),
+            'disk_max': summary.get('disk_max'),
+            'alerts': alerts.get(resource_doc.id, 0) + (alerts.get(title, 0) if title != resource_doc.id else 0),
+        })
+    resources.sort(key=lambda resource: str(resource['title']).lower())
+
+    return {
+        'day': day,
+        'resources': resources,
+        'alert_total': sum(resource['alerts'] for resource in resources),
+    }
+
+
+def _report_message(db, user_doc, day_start: datetime) -> Optional[MailMessage]:
+    user = user_doc.to_dict() or {}
+    email = user.get('email')
+    if not email:
+        return None
+    report = build_user_report(db, user_doc.id, day_start)
+    if not report['resources']:
+        return None
+    subject, html_content = render_daily_summary_email(report, user.get('locale'))
+    return MailMessage(email, subject, html_content)
+
+
+def send_daily_reports(db, day: datetime, client: MailClient) -> int:
+    """
+    Send the daily report of every user who opted in
+
+    Args:
+        db: Firestore client
+        day: Any time within the UTC day to report on (timezone aware)
+        client: Mail client the reports are sent through
+
+    Returns:
+        Number of reports the mail API accepted
+    """
+    day_start = datetime.fromtimestamp(int(day.timestamp()) - int(day.timestamp()) % 86400, tz=timezone.utc)
+    sent = 0
+    with ThreadPoolExecutor(max_workers=DAILY_REPORT_WORKERS) as executor:
+        for page in _report_user_pages(db):
+            futures = [executor.submit(_report_message, db, user_doc, day_start) for user_doc in page]
+            messages = []
+            for user_doc, future in zip(page, futures):
+                try:
+                    message = future.result()
+                except Exception as e:
+                    logger.error(f"Failed to build daily report for user_id: {user_doc.id}. Error: {str(e)}")
+                    continue
+                if message is not None:
+                    messages.append(message)
+
+            for message, result in zip(messages, client.send_many(messages)):
+                if isinstance(result, Exception):
+                    logger.error(f"Failed to send daily report to {message.to}: {str(result)}")
+                elif result.status_code != 200:
+                    logger.error(f"Failed to send daily report to {message.to}. Status: {result.status_code}, Response: {result.text}")
+                else:
+                    sent += 1
+    return sent
@@ -0,0 +1 @@
+# Retry package for Tinyfal Firebase Functions
@@ -0,0 +1,57 @@
+"""
+Retries with exponential backoff and full jitter for calls to external services
+"""
+import random
+import time
+from typing import Any, Callable, Iterator, Tuple, Type
+
+
+def backoff_delays(attempts: int, base_delay: float = 0.5, max_delay: float = 8.0) -> Iterator[float]:
+    """
+    Yield the delays to wait between attempts ("full jitter": uniform in [0, base * 2^n], capped)
+
+    Args:
+        attempts: Total number of attempts (yields attempts - 1 delays)
+        base_delay: Delay bound before the first retry, in seconds
+        max_delay: Upper bound of any single delay, in seconds
+    """
+    for retry in range(attempts - 1):
+        yield random.uniform(0, min(max_delay, base_delay * (2 ** retry)))
+
+
+def call_with_retries(
+    fn: Callable[..., Any],
+    *args: Any,
+    attempts: int = 3,
+    base_delay: float = 0.5,
+    max_delay: float = 8.0,
+    retry_on: Tuple[Type[BaseException], ...] = (Exception,),
+    sleep: Callable[[float], None] = time.sleep,
+    **kwargs: Any
+) -> Any:
+    """
+    Call a function, retrying on the given exceptions with jittered exponential backoff
+
+    Args:
+        fn: The function to call
+        attempts: Maximum number of calls
+        base_delay: Delay bound before the first retry, in seconds
+        max_delay: Upper bound of any single delay, in seconds
+        retry_on: Exception types worth retrying; anything else is raised immediately
+        sleep: Sleep function, replaceable for tests
+
+    Returns:
+        The function result
+
+    Raises:
+        The last exception once every attempt failed
+    """
+    delays = backoff_delays(attempts, base_delay, max_delay)
+    while True:
+        try:
+            return fn(*args, **kwargs)
+        except retry_on:
+            delay = next(delays, None)
+            if delay is None:
+                raise
+            sleep(delay)
@@ -0,0 +1 @@
+# Tokens package for Tinyfal Firebase Functions
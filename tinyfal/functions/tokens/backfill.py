@@ -0,0 +1,83 @@
+"""
+Backfill the tokens/{sha256(token)} index from the existing resources.
+
+Run once from the functions directory with application default credentials:
+
+    python -m tokens.backfill [--dry-run]
+
+It is idempotent, so it can be re-run safely after a partial failure.
+
+Run it after the functions and firestore.indexes.json are deployed. Until it has completed,
+ingest finds unindexed tokens through the `resources.token` override, so keep that override
+and TOKEN_LEGACY_LOOKUP on; turn the lookup off once the backfill is done, then drop the override.
+"""
+import argparse
+
+from firebase_admin import initialize_app, firestore
+
+from tokens.tokens import TOKENS_COLLECTION, INDEXED_FIELDS, hash_token, index_entry, read_plan
+
+
+# Firestore batches accept at most 500 writes
+BATCH_SIZE = 500
+
+
+def backfill_token_index(db, dry_run: bool = False) -> int:
+    """
+    Write an index entry for every resource that has a token
+
+    Args:
+        db: Firestore client
+        dry_run: Count the entries without writing them
+
+    Returns:
+        Number of index entries written (or that would be written)
+    """
+    tokens = db.collection(TOKENS_COLLECTION)
+    batch = db.batch()
+    pending = 0
+    written = 0
+    plans = {}
+
+    # Only the indexed fields are needed, the metrics payload can be large
+    for resource_doc in db.collection_group('resources').select(['token', *INDEXED_FIELDS]).stream():
+        resource_data = resource_doc.to_dict() or {}
+        token = resource_data.get('token')
+        if not token:
+            continue
+
+        written += 1
+        if dry_run:
+            continue
+
+        user_id = resource_doc.reference.parent.parent.id
+        if user_id not in plans:
+            plans[user_id] = read_plan(db, user_id)
+
+        batch.set(tokens.document(hash_token(token)), index_entry(
+            user_id,
+            resource_doc.id,
+            resource_data,
+            plans[user_id],
+        ))
+        pending += 1
+
+        if pending == BATCH_SIZE:
+            batch.commit()
+            batch = db.batch()
+            pending = 0
+
+    if pending:
+        batch.commit()
+
+    return written
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Populate the token index for existing resources")
+    parser.add_argument('--dry-run', action='store_true', help="count resources without writing")
+    args = parser.parse_args()
+
+    initialize_app()
+    count = backfill_token_index(firestore.client(), dry_run=args.dry_run)
+    print(f"{'Would write' if args.dry_run else 'Wrote'} {count} token index entries")
@@ -0,0 +1,362 @@
+"""
+Resolution of ingest tokens to the resource they authorize.
+
+Tokens are indexed in a top level `tokens/{sha256(token)}` collection holding the owning
+user_id and resource_id, so a lookup is a single point read and raw tokens are never queried.
+The entry also carries the resource title, projection overrides, offline deadline and plan, which
+is everything ingest needs to know about a resource, so ingest never reads the resource document itself.
+
+Resolved tokens are cached per instance. An index change only invalidates the cache of the
+instance running the trigger, so positive entries are kept for TOKEN_CACHE_TTL_SECONDS only:
+that bounds how long a rotated token keeps being accepted by other warm instances. Writes to a
+deleted resource fail in ingest and drop the stale entry at once.
+
+The plan sets the ingest rate limits, so it never comes from a client-writable document: it is read
+from users/{user_id}/billing/plan, which only the backend writes, whenever an entry is built, and
+copied into every entry of the user when that document changes (sync_token_plans).
+
+Deploy order: resources that existed before the index have no entry until tokens/backfill.py has
+run, so while TOKEN_LEGACY_LOOKUP is on an index miss falls back to the former collection group
+query on `resources.token` and writes the missing entry. That query needs the `resources.token`
+override of firestore.indexes.json. Deploy the indexes and functions, run the backfill, then
+set TOKEN_LEGACY_LOOKUP=0, and only after that drop the `token` override.
+"""
+import hashlib
+import os
+from typing import Any, Dict, Iterable, Optional
+
+from firebase_functions import logger
+from firebase_admin import firestore
+from google.cloud.firestore_v1.field_path import FieldPath
+
+from cache.cache import TTLCache
+from instrumentation.instrumentation import record_read, record_write
+
+
+TOKENS_COLLECTION = 'tokens'
+
+# Cache sizing and lifetimes, overridable through the functions environment (.env). The positive
+# TTL is how long a revoked or rotated token may still be accepted by other instances
+TOKEN_CACHE_MAX_SIZE = int(os.environ.get('TOKEN_CACHE_MAX_SIZE', '10000'))
+TOKEN_CACHE_TTL_SECONDS = float(os.environ.get('TOKEN_CACHE_TTL_SECONDS', '60'))
+TOKEN_CACHE_NEGATIVE_TTL_SECONDS = float(os.environ.get('TOKEN_CACHE_NEGATIVE_TTL_SECONDS', '30'))
+
+# Fall back to the collection group query on resources.token on an index miss (see the deploy order above)
+TOKEN_LEGACY_LOOKUP = os.environ.get('TOKEN_LEGACY_LOOKUP', '1') != '0'
+
+# Resource fields copied into the index entry
+INDEXED_FIELDS = ('title', 'projection', 'offline_after')
+
+# users/{user_id}/billing/plan holds the `plan` of the user; clients can read but not write it
+BILLING_COLLECTION = 'billing'
+PLAN_DOCUMENT = 'plan'
+
+# Firestore batches accept at most 500 writes
+PLAN_BATCH_SIZE = 500
+
+# Maps sha256(token) -> TokenOwner, or None for tokens known to be invalid
+token_cache = TTLCache(
+    max_size=TOKEN_CACHE_MAX_SIZE,
+    ttl=TOKEN_CACHE_TTL_SECONDS,
+    negative_ttl=TOKEN_CACHE_NEGATIVE_TTL_SECONDS,
+)
+
+
+class TokenOwner:
+    """
+    The resource an ingest token authorizes
+
+    Attributes:
+        user_id: Owner of the resource
+        resource_id: The resource
+        title: Resource title (the resource id when it has none)
+        projection: The resource `projection` override map, if any
+        offline_after: The resource `offline_after` deadline in seconds, if any
+        plan: The plan of the owner, which sets its ingest rate limits (see ingestion/ratelimit.py)
+    """
+
+    __slots__ = ('user_id', 'resource_id', 'title', 'projection', 'offline_after', 'plan')
+
+    def __init__(self, user_id: str, resource_id: str, title: Optional[str] = None, projection: Optional[Dict[str, Any]] = None,
+                 offline_after: Optional[float] = None, plan: Optional[str] = None):
+        self.user_id = user_id
+        self.resource_id = resource_id
+        self.title = title or resource_id
+        self.projection = projection
+        self.offline_after = offline_after
+        self.plan = plan
+
+
+def hash_token(token: str) -> str:
+    """
+    Get the index key of a token
+
+    Args:
+        token: The raw bearer token
+
+    Returns:
+        Hex encoded SHA-256 digest of the token
+    """
+    return hashlib.sha256(token.encode('utf-8')).hexdigest()
+
+
+def resolve_token(db, token: str) -> Optional[TokenOwner]:
+    """
+    Find the user and resource that correspond to an ingest token.
+    Warm instances answer from the token cache; misses do a point read on the token index.
+
+    Args:
+        db: Firestore client
+        token: The bearer token sent by the agent
+
+    Returns:
+        The TokenOwner, or None if the token does not belong to any resource
+    """
+    token_hash = hash_token(token)
+
+    found, owner = token_cache.get(token_hash)
+    if found:
+        return owner
+
+    index_doc = db.collection(TOKENS_COLLECTION).document(token_hash).get()
+    record_read()
+    index_data = index_doc.to_dict() if index_doc.exists else None
+
+    if not index_data or not index_data.get('user_id') or not index_data.get('resource_id'):
+        owner = _legacy_owner(db, token, token_hash)
+        if owner is None:
+            token_cache.set_negative(token_hash)
+        else:
+            token_cache.set(token_hash, owner)
+        return owner
+
+    owner = _owner_of(index_data)
+    token_cache.set(token_hash, owner)
+    return owner
+
+
+def resolve_tokens(db, tokens: Iterable[str]) -> Dict[str, Optional[TokenOwner]]:
+    """
+    Find the owners of many ingest tokens: cached tokens are answered from the token cache and
+    every other one is read in a single multi-get on the token index
+
+    Args:
+        db: Firestore client
+        tokens: The bearer tokens
+
+    Returns:
+        Token -> TokenOwner, or None for tokens that do not belong to any resource
+    """
+    owners: Dict[str, Optional[TokenOwner]] = {}
+    missing: Dict[str, str] = {}
+    for token in set(tokens):
+        token_hash = hash_token(token)
+        found, owner = token_cache.get(token_hash)
+        if found:
+            owners[token] = owner
+        else:
+            missing[token_hash] = token
+
+    if not missing:
+        return owners
+
+    index = db.collection(TOKENS_COLLECTION)
+    snapshots = db.get_all([index.document(token_hash) for token_hash in missing])
+    for snapshot in snapshots:
+        index_data = snapshot.to_dict() if snapshot.exists else None
+        token_hash = snapshot.id
+        if not index_data or not index_data.get('user_id') or not index_data.get('resource_id'):
+            owner = owners[missing[token_hash]] = _legacy_owner(db, missing[token_hash], token_hash)
+            if owner is None:
+                token_cache.set_negative(token_hash)
+            else:
+                token_cache.set(token_hash, owner)
+        else:
+            owner = owners[missing[token_hash]] = _owner_of(index_data)
+            token_cache.set(token_hash, owner)
+    record_read(len(missing))
+    return owners
+
+
+def _legacy_owner(db, token: str, token_hash: str) -> Optional[TokenOwner]:
+    """
+    Find the owner of a token that has no index entry with the collection group query on
+    resources.token, and write the entry it should have had
+
+    Args:
+        db: Firestore client
+        token: The bearer token
+        token_hash: hash_token(token)
+
+    Returns:
+        The TokenOwner, or None if no resource has the token or the fallback is off
+    """
+    if not TOKEN_LEGACY_LOOKUP:
+        return None
+
+    query = db.collection_group('resources').where('token', '==', token).select(['token', *INDEXED_FIELDS]).limit(1)
+    resource_docs = list(query.stream())
+    record_read(max(len(resource_docs), 1))
+    if not resource_docs:
+        return None
+
+    resource_doc = resource_docs[0]
+    user_id = resource_doc.reference.parent.parent.id
+    entry = index_entry(user_id, resource_doc.id, resource_doc.to_dict() or {}, read_plan(db, user_id))
+    db.collection(TOKENS_COLLECTION).document(token_hash).set(entry)
+    record_write()
+    logger.info(f"Token index entry backfilled for user_id: {user_id}, resource_id: {resource_doc.id}")
+    return _owner_of(entry)
+
+
+def _owner_of(index_data: Dict[str, Any]) -> TokenOwner:
+    return TokenOwner(
+        index_data['user_id'],
+        index_data['resource_id'],
+        title=index_data.get('title'),
+        projection=index_data.get('projection'),
+        offline_after=index_data.get('offline_after'),
+        plan=index_data.get('plan'),
+    )
+
+
+def invalidate_token(token: Optional[str]) -> None:
+    """
+    Drop a token from the cache of this instance
+
+    Args:
+        token: The token to forget (ignored if empty)
+    """
+    if token:
+        token_cache.invalidate(hash_token(token))
+        logger.info(f"Token cache entry invalidated for token: {token[:4]}...")
+
+
+def plan_ref(db, user_id: str):
+    """Get the reference of the billing document holding the plan of a user."""
+    return db.collection('users').document(user_id).collection(BILLING_COLLECTION).document(PLAN_DOCUMENT)
+
+
+def read_plan(db, user_id: str) -> Optional[str]:
+    """
+    Read the plan of a user
+
+    Args:
+        db: Firestore client
+        user_id: The user
+
+    Returns:
+        The plan, or None for the default plan
+    """
+    plan_doc = plan_ref(db, user_id).get()
+    record_read()
+    plan = (plan_doc.to_dict() or {}).get('plan') if plan_doc.exists else None
+    return plan if isinstance(plan, str) and plan else None
+
+
+def index_entry(user_id: str, resource_id: str, resource_data: Dict[str, Any], plan: Optional[str] = None) -> Dict[str, Any]:
+    """
+    Build the token index entry of a resource
+
+    Args:
+        user_id: Owner of the resource
+        resource_id: The resource
+        resource_data: The resource document data
+        plan: The plan of the owner (see read_plan)
+
+    Returns:
+        The index document data
+    """
+    entry = {
+        'user_id': user_id,
+        'resource_id': resource_id,
+        'updated_at': firestore.SERVER_TIMESTAMP,
+    }
+    for field in INDEXED_FIELDS:
+        if resource_data.get(field) is not None:
+            entry[field] = resource_data[field]
+    if plan is not None:
+        entry['plan'] = plan
+    return entry
+
+
+def sync_token_index(
+    db,
+    user_id: str,
+    resource_id: str,
+    before: Dict[str, Any],
+    after: Dict[str, Any]
+) -> None:
+    """
+    Bring the token index in line with a resource write.
+    Creation sets the new entry, deletion removes the old one and rotation does both atomically.
+    Changes of the indexed fields rewrite the entry in place.
+
+    Args:
+        db: Firestore client
+        user_id: Owner of the resource
+        resource_id: The resource that was written
+        before: Resource data before the write (empty on creation)
+        after: Resource data after the write (empty on deletion)
+    """
+    old_token = before.get('token')
+    new_token = after.get('token')
+
+    # Most writes come from ingest itself and leave every indexed field untouched
+    if old_token == new_token and all(before.get(field) == after.get(field) for field in INDEXED_FIELDS):
+        return
+
+    batch = db.batch()
+    tokens = db.collection(TOKENS_COLLECTION)
+
+    if old_token and old_token != new_token:
+        batch.delete(tokens.document(hash_token(old_token)))
+
+    if new_token:
+        batch.set(tokens.document(hash_token(new_token)), index_entry(user_id, resource_id, after, read_plan(db, user_id)))
+
+    batch.commit()
+
+    invalidate_token(old_token)
+    invalidate_token(new_token)
+
+    logger.info(f"Token index updated for user_id: {user_id}, resource_id: {resource_id}")
+
+
+def sync_token_plans(db, user_id: str, plan: Optional[str]) -> int:
+    """
+    Copy the plan of a user into the index entry of every token of the user
+
+    Args:
+        db: Firestore client
+        user_id: The user whose billing plan document was written
+        plan: The new plan, or None for the default plan
+
+    Returns:
+        The number of index entries updated
+    """
+    value = plan if plan is not None else firestore.DELETE_FIELD
+    updated = 0
+    batch = db.batch()
+    pending = 0
+
+    # Only the references are needed
+    entries = db.collection(TOKENS_COLLECTION).where('user_id', '==', user_id).select([FieldPath.document_id()])
+    for entry in entries.stream():
+        record_read()
+        batch.update(entry.reference, {'plan': value, 'updated_at': firestore.SERVER_TIMESTAMP})
+        token_cache.invalidate(entry.id)
+        pending += 1
+        updated += 1
+        if pending == PLAN_BATCH_SIZE:
+            batch.commit()
+            record_write(pending)
+            batch = db.batch()
+            pending = 0
+
+    if pending:
+        batch.commit()
+        record_write(pending)
+
+    logger.info(f"Token index plan set to {plan} for user_id: {user_id} ({updated} entries)")
+    return updated
@@ -0,0 +1 @@
+# Users package for Tinyfal Firebase Functions
@@ -0,0 +1,122 @@
+"""
+Instance-local cache of user settings (notification preferences, alert rules, device tokens).
+
+Alert evaluation needs the user document on every resource write, but it changes rarely. Entries
+are kept for USER_SETTINGS_CACHE_TTL_SECONDS and bounded in number. Each function runs on its
+own instances, so an invalidation made by the users/{user_id} trigger would only reach that
+trigger's instance. Instead the trigger stamps the user document update time as
+`settings_version` on the user's resources. Alert evaluation reads the resource document for
+free, sees the newer version and reloads the settings on every instance, without a read while
+nothing changes.
+"""
+import os
+from typing import Any, Dict, Optional
+
+from firebase_functions import logger
+from google.cloud.firestore_v1.field_path import FieldPath
+
+from alerts.rules import RULE_SETTINGS
+from cache.cache import TTLCache
+from instrumentation.instrumentation import record_read, record_write
+
+
+USER_SETTINGS_CACHE_MAX_SIZE = int(os.environ.get('USER_SETTINGS_CACHE_MAX_SIZE', '10000'))
+USER_SETTINGS_CACHE_TTL_SECONDS = float(os.environ.get('USER_SETTINGS_CACHE_TTL_SECONDS', '600'))
+USER_SETTINGS_CACHE_NEGATIVE_TTL_SECONDS = float(os.environ.get('USER_SETTINGS_CACHE_NEGATIVE_TTL_SECONDS', '60'))
+
+# User fields alert evaluation and delivery depend on; changes to other fields are ignored
+ALERT_SETTINGS = RULE_SETTINGS + ('notificationsEnabled', 'offlineNotificationsEnabled', 'fcmToken', 'fcmTokens')
+
+# Firestore batches accept at most 500 writes
+STAMP_BATCH_SIZE = 500
+
+# Maps user_id -> (settings version, settings), or None for users that do not exist
+settings_cache = TTLCache(
+    max_size=USER_SETTINGS_CACHE_MAX_SIZE,
+    ttl=USER_SETTINGS_CACHE_TTL_SECONDS,
+    negative_ttl=USER_SETTINGS_CACHE_NEGATIVE_TTL_SECONDS,
+)
+
+
+def get_user_settings(db, user_id: str, version: Any = None) -> Optional[Dict[str, Any]]:
+    """
+    Get the settings of a user, from the cache when they are fresh
+
+    Args:
+        db: Firestore client
+        user_id: The user
+        version: `settings_version` of the resource being evaluated, if known. A version newer
+            than the cached one forces a reload
+
+    Returns:
+        The user document data, or None if the user does not exist
+    """
+    found, entry = settings_cache.get(user_id)
+    if found:
+        if entry is None:
+            return None
+        cached_version, settings = entry
+        if version is None or cached_version is None or version <= cached_version:
+            return settings
+
+    user_doc = db.collection('users').document(user_id).get()
+    record_read()
+    if not user_doc.exists:
+        settings_cache.set_negative(user_id)
+        return None
+
+    settings = user_doc.to_dict() or {}
+    settings_cache.set(user_id, (user_doc.update_time, settings))
+    return settings
+
+
+def remember_user_settings(user_id: str, settings: Dict[str, Any], version: Any) -> None:
+    """Store settings known to be current, e.g. from a trigger event."""
+    settings_cache.set(user_id, (version, settings))
+
+
+def invalidate_user_settings(user_id: str) -> None:
+    """Drop the cached settings of a user on this instance."""
+    settings_cache.invalidate(user_id)
+
+
+def settings_changed(before: Dict[str, Any], after: Dict[str, Any]) -> bool:
+    """Whether a user document write changed anything alert evaluation depends on."""
+    return any(before.get(field) != after.get(field) for field in ALERT_SETTINGS)
+
+
+def stamp_settings_version(db, user_id: str, version: Any) -> int:
+    """
+    Write `settings_version` on every resource of a user so that all instances reload
+    the settings on their next evaluation
+
+    Args:
+        db: Firestore client
+        user_id: The user
+        version: Update time of the user document
+
+    Returns:
+        Number of resources stamped
+    """
+    stamped = 0
+    batch = db.batch()
+    pending = 0
+
+    # Only the references are needed
+    for resource_doc in db.collection('users').document(user_id).collection('resources').select([FieldPath.document_id()]).stream():
+        record_read()
+        batch.update(resource_doc.reference, {'settings_version': version})
+        pending += 1
+        stamped += 1
+        if pending == STAMP_BATCH_SIZE:
+            batch.commit()
+            record_write(pending)
+            batch = db.batch()
+            pending = 0
+
+    if pending:
+        batch.commit()
+        record_write(pending)
+
+    logger.info(f"Settings version stamped on {stamped} resources for user: {user_id}")
+    return stamped